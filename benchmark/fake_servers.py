@@ -0,0 +1,394 @@
+""" Local stand-ins for Raven, the meal booking system and an SMTP server,
+used to benchmark the program without touching the real services.
+"""
+
+import BaseHTTPServer
+import Cookie
+import hashlib
+import SocketServer
+import threading
+import time
+import urlparse
+from datetime import datetime
+
+RAVEN_PATH = '/auth/login.html'
+BOOKING_PATH = '/index.php'
+BOOKED_MARKER = 'Other dietary or non-dietary requirements'
+
+
+class TrafficCounter:
+    """ Thread-safe count of the requests and bytes handled by the servers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def record(self, bytes_received, bytes_sent, requests=1):
+        with self._lock:
+            self.requests += requests
+            self.bytes_received += bytes_received
+            self.bytes_sent += bytes_sent
+
+    def as_dict(self):
+        with self._lock:
+            return {'requests': self.requests,
+                    'bytes_received': self.bytes_received,
+                    'bytes_sent': self.bytes_sent}
+
+
+class FakeCaius:
+    """ Shared state for the fake Raven and booking system servers: which
+    sessions exist, which events exist, and who is booked in to what.
+    """
+
+    def __init__(self, event_count=10, attendee_count=50, latency=0,
+                 opening_time=None, capacity=None, names=None,
+                 shows_places_remaining=True):
+        """ Construct a new FakeCaius.
+        :param event_count: number of events in the booking system
+        :param attendee_count: number of attendees listed for each event
+        :param latency: seconds to wait before responding to each request
+        :param opening_time: time (in seconds since the epoch) before which
+            booking forms are refused, or None if booking is always open
+        :param capacity: number of bookings each event on each date accepts,
+            or None for no limit
+        :param names: dictionary mapping crsids to the names listed in
+            attendee lists for users once they're booked in, or None if
+            booked users aren't listed
+        :param shows_places_remaining: if True, event pages say how many
+            places are left (when there's a limit)
+        """
+        self.event_count = event_count
+        self.attendee_count = attendee_count
+        self.latency = latency
+        self.opening_time = opening_time
+        self.capacity = capacity
+        self.names = names or {}
+        self.shows_places_remaining = shows_places_remaining
+        self.counter = TrafficCounter()
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._bookings = set()
+
+    def create_session(self, crsid):
+        """
+        :return: String for a new session token for `crsid`
+        """
+        with self._lock:
+            token = 'session-%d-%s' % (len(self._sessions), crsid)
+            self._sessions[token] = crsid
+            return token
+
+    def crsid_for_session(self, token):
+        """
+        :return: crsid the session `token` belongs to, or None
+        """
+        with self._lock:
+            return self._sessions.get(token)
+
+    def book(self, crsid, event_code, date_string):
+        with self._lock:
+            self._bookings.add((crsid, event_code, date_string))
+
+    def is_booking_open(self):
+        return self.opening_time is None or time.time() >= self.opening_time
+
+    def places_remaining(self, event_code, date_string):
+        """
+        :return: number of places left in the event on the date, or None if
+            there's no limit
+        """
+        if self.capacity is None:
+            return None
+        with self._lock:
+            booked = sum(1 for _, booked_code, booked_date in self._bookings
+                         if (booked_code, booked_date) ==
+                         (event_code, date_string))
+        return max(0, self.capacity - booked)
+
+    def is_booked(self, crsid, event_code, date_string):
+        with self._lock:
+            return (crsid, event_code, date_string) in self._bookings
+
+    def booked_names(self, event_code, date_string):
+        """
+        :return: list of the names of users booked in to the event on the
+            date, for those whose names are known
+        """
+        with self._lock:
+            return sorted(self.names[crsid]
+                          for crsid, booked_code, booked_date in self._bookings
+                          if (booked_code, booked_date) ==
+                          (event_code, date_string) and crsid in self.names)
+
+    def is_event_running(self, event_code, date_string):
+        """ Events each run on six days of the week. """
+        weekday = datetime.strptime(date_string, '%Y-%m-%d').weekday()
+        return (event_code + weekday) % 7 != 0
+
+    def event_name(self, event_code):
+        """ The first event is 'First Hall', the rest are numbered. """
+        if event_code == 1:
+            return 'First Hall'
+        return 'Event %d' % event_code
+
+
+class _CountingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Base request handler, recording traffic and applying latency. """
+
+    protocol_version = 'HTTP/1.1'
+    fake_caius = None
+
+    def _read_form(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        self._bytes_received += length
+        return dict(urlparse.parse_qsl(body))
+
+    def _session_crsid(self):
+        cookie = Cookie.SimpleCookie(self.headers.get('Cookie', ''))
+        if 'session' not in cookie:
+            return None
+        return self.fake_caius.crsid_for_session(cookie['session'].value)
+
+    def _respond(self, status, body='', headers=()):
+        time.sleep(self.fake_caius.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        header_bytes = len(self.requestline) + len(str(self.headers))
+        self.fake_caius.counter.record(
+            header_bytes + self._bytes_received, len(body))
+
+    def handle_one_request(self):
+        self._bytes_received = 0
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _RavenHandler(_CountingHandler):
+    """ Emulates the Raven login form. """
+
+    def do_GET(self):
+        self._respond(200, '<html><body>'
+                           '<form method="post" action="%s">'
+                           '<input type="text" name="userid" />'
+                           '<input type="password" name="pwd" />'
+                           '<input type="submit" value="Login" />'
+                           '</form></body></html>' % RAVEN_PATH)
+
+    def do_POST(self):
+        form = self._read_form()
+        crsid = form.get('userid')
+        if not crsid or not form.get('pwd'):
+            self.do_GET()
+            return
+        token = self.fake_caius.create_session(crsid)
+        self._respond(200, '<html><body>Logged in</body></html>',
+                      [('Set-Cookie', 'session=%s; Path=/' % token)])
+
+
+class _BookingHandler(_CountingHandler):
+    """ Emulates mealbookings.cai.cam.ac.uk/index.php. """
+
+    raven_url = None
+
+    def do_GET(self):
+        crsid = self._session_crsid()
+        if crsid is None:
+            self._respond(302, headers=[('Location', self.raven_url)])
+            return
+        query = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        if 'event' in query:
+            body = self._event_html(crsid, int(query['event']), query['date'])
+        else:
+            body = self._index_html()
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self._respond(304, headers=[('ETag', etag)])
+        else:
+            self._respond(200, body, [('ETag', etag)])
+
+    def do_POST(self):
+        crsid = self._session_crsid()
+        if crsid is None:
+            self._respond(302, headers=[('Location', self.raven_url)])
+            return
+        form = self._read_form()
+        query = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        event_code, date_string = int(query['event']), query['date']
+        if not self.fake_caius.is_booking_open():
+            self._respond(200, '<html><body>Booking has not opened yet'
+                               '</body></html>')
+            return
+        if 'confirm' not in form:
+            self._respond(200, '<html><body><form method="post" action="%s">'
+                               '<input type="hidden" name="confirm" '
+                               'value="1" />'
+                               '<input type="submit" value="Confirm" />'
+                               '</form></body></html>' % self.path)
+            return
+        self.fake_caius.book(crsid, event_code, date_string)
+        self._respond(200, self._event_html(crsid, event_code, date_string))
+
+    def _index_html(self):
+        event_cells = []
+        for event_code in range(1, self.fake_caius.event_count + 1):
+            event_name = self.fake_caius.event_name(event_code)
+            event_cells.append('<tr><td><a href="index.php?event=%d">%s</a>'
+                               '</td></tr>' % (event_code, event_name))
+        event_cells = ''.join(event_cells)
+        return ('<html><body><table class="list"><tr><td>Bookings</td></tr>'
+                '</table><table class="list">%s</table></body></html>'
+                % event_cells)
+
+    def _event_html(self, crsid, event_code, date_string):
+        if not self.fake_caius.is_event_running(event_code, date_string):
+            return ('<html><body>%s is not running on %s</body></html>'
+                    % (self.fake_caius.event_name(event_code), date_string))
+        attendee_names = ['Attendee%d, A' % number for number in
+                          range(self.fake_caius.attendee_count)]
+        attendee_names.extend(self.fake_caius.booked_names(event_code,
+                                                           date_string))
+        attendee_cells = ''.join('<tr><td>%s</td></tr>' % name
+                                 for name in attendee_names)
+        places_remaining = self.fake_caius.places_remaining(event_code,
+                                                            date_string)
+        if self.fake_caius.is_booked(crsid, event_code, date_string):
+            form = ('<form method="post" action="%s">%s '
+                    '<input type="text" name="requirements" />'
+                    '<input type="submit" value="Update" /></form>'
+                    % (self.path, BOOKED_MARKER))
+        elif places_remaining == 0:
+            form = 'This event is full'
+        else:
+            form = ('<form method="post" action="%s">'
+                    '<input type="submit" value="Book" /></form>' % self.path)
+        if (places_remaining is not None and
+                self.fake_caius.shows_places_remaining):
+            form = '%d places remaining %s' % (places_remaining, form)
+        return ('<html><body><table class="list">%s</table>'
+                '<div class="menu">Soup\r\n  Main course  \r\nPudding</div>'
+                '%s</body></html>' % (attendee_cells, form))
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _SMTPHandler(SocketServer.StreamRequestHandler):
+    """ Minimal SMTP server, accepting any login and discarding every
+    message.
+    """
+
+    sink = None
+
+    def handle(self):
+        self._reply('220 localhost fake SMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            self.sink.counter.record(len(line), 0, requests=0)
+            command = line.strip().upper()
+            if command.startswith('EHLO') or command.startswith('HELO'):
+                self._reply('250-localhost\r\n250 AUTH PLAIN LOGIN')
+            elif command.startswith('AUTH PLAIN'):
+                self._reply('235 Authenticated')
+            elif command.startswith('AUTH LOGIN'):
+                self._reply('334 VXNlcm5hbWU6')
+                self.rfile.readline()
+                self._reply('334 UGFzc3dvcmQ6')
+                self.rfile.readline()
+                self._reply('235 Authenticated')
+            elif command == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                self._read_message()
+                self._reply('250 Queued')
+            elif command == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('250 OK')
+
+    def _read_message(self):
+        message_bytes = 0
+        while True:
+            line = self.rfile.readline()
+            if not line or line in ('.\r\n', '.\n'):
+                break
+            message_bytes += len(line)
+        self.sink.record_message(message_bytes)
+
+    def _reply(self, reply):
+        self.wfile.write(reply + '\r\n')
+        self.sink.counter.record(0, len(reply) + 2, requests=0)
+
+
+class SMTPSink:
+    """ Local SMTP server that accepts and discards every message. """
+
+    def __init__(self):
+        self.counter = TrafficCounter()
+        self.messages = 0
+        self._lock = threading.Lock()
+        class SMTPHandler(_SMTPHandler):
+            pass
+        SMTPHandler.sink = self
+        self._server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0),
+                                                       SMTPHandler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+
+    def record_message(self, message_bytes):
+        with self._lock:
+            self.messages += 1
+        self.counter.record(message_bytes, 0)
+
+    def start(self):
+        _start_thread(self._server.serve_forever)
+
+    def stop(self):
+        self._server.shutdown()
+
+
+def start_fake_caius(fake_caius):
+    """ Start the fake Raven and booking system servers, on separate ports so
+    that they count as separate hosts.
+    :param fake_caius: FakeCaius instance for the servers to share
+    :return: tuple of (raven_url, booking_service_url, servers)
+    """
+    class RavenHandler(_RavenHandler):
+        pass
+    RavenHandler.fake_caius = fake_caius
+    raven_server = _ThreadingHTTPServer(('127.0.0.1', 0), RavenHandler)
+    raven_url = 'http://127.0.0.1:%d%s' % (raven_server.server_address[1],
+                                           RAVEN_PATH)
+
+    class BookingHandler(_BookingHandler):
+        pass
+    BookingHandler.fake_caius = fake_caius
+    BookingHandler.raven_url = raven_url
+    booking_server = _ThreadingHTTPServer(('127.0.0.1', 0), BookingHandler)
+    booking_service_url = 'http://127.0.0.1:%d%s' % (
+        booking_server.server_address[1], BOOKING_PATH)
+
+    for server in (raven_server, booking_server):
+        _start_thread(server.serve_forever)
+    return raven_url, booking_service_url, [raven_server, booking_server]
+
+
+def _start_thread(target):
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
\ No newline at end of file
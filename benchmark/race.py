@@ -0,0 +1,104 @@
+""" Benchmark race mode against local stand-ins for Raven and the meal booking
+system, which refuse bookings until a fixed opening time, writing the
+per-user booking latencies as JSON.
+
+Usage: `python -m benchmark.race [options]` from the repository root.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+import main
+from benchmark import fake_servers, run
+from configuration import Configuration
+from service import booking_service, raven_service
+
+
+def run_race(arguments):
+    """ Prepare every user's booking, then race to book them all once the
+    fake booking system opens.
+    :param arguments: argparse.Namespace containing the benchmark parameters
+    :return: dictionary of benchmark results
+    """
+    opening_time = time.time() + arguments.lead_time
+    fake_caius = fake_servers.FakeCaius(arguments.events, arguments.attendees,
+                                        arguments.latency, opening_time,
+                                        names=run._user_names(arguments))
+    raven_url, booking_service_url, servers = fake_servers.start_fake_caius(
+        fake_caius)
+    raven_service.RAVEN_URL = raven_url
+    booking_service.BOOKING_SERVICE_URL = booking_service_url
+
+    temporary_directory = tempfile.mkdtemp()
+    try:
+        configuration_file_path = os.path.join(temporary_directory,
+                                               'configuration.json')
+        with open(configuration_file_path, 'w') as configuration_file:
+            json.dump(run._configuration_dict(arguments), configuration_file)
+        configuration = Configuration(configuration_file_path)
+        main._authenticate_services(configuration)
+        users = configuration.users
+        date_to_book = date.today() + timedelta(days=3)
+        results = main._race_bookings(users, date_to_book, opening_time,
+                                      configuration.booking_workers)
+        finish_time = time.time()
+    finally:
+        shutil.rmtree(temporary_directory)
+        for server in servers:
+            server.shutdown()
+
+    latencies = dict((str(user), latency * 1000)
+                     for user, (_, latency) in zip(users, results))
+    return {
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'parameters': vars(arguments),
+        'bookings_made': len([booking for booking, _ in results
+                              if booking is not None]),
+        'latency_ms': latencies,
+        'max_latency_ms': max(latencies.values()) if latencies else 0,
+        'finished_after_opening_ms': (finish_time - opening_time) * 1000,
+        'requests': fake_caius.counter.as_dict()['requests']
+    }
+
+
+def _parse_arguments():
+    """
+    :return: argparse.Namespace containing the benchmark parameters
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark race mode against local fake servers that '
+                    'open booking at a fixed time.')
+    parser.add_argument('--users', type=int, default=20,
+                        help='number of users in the configuration')
+    parser.add_argument('--events', type=int, default=10,
+                        help='number of events in the booking system')
+    parser.add_argument('--attendees', type=int, default=50,
+                        help='number of attendees listed for each event')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds each fake server takes to respond')
+    parser.add_argument('--lead-time', type=float, default=5,
+                        help='seconds from starting until booking opens')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='users logged in, prepared and submitted '
+                             'concurrently')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='use the keep-alive transport')
+    parser.add_argument('--names', action='store_true',
+                        help='give each user a name')
+    parser.add_argument('--output', default='race_results.json',
+                        help='path to write the JSON results to')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    race_arguments = _parse_arguments()
+    results = run_race(race_arguments)
+    with open(race_arguments.output, 'w') as output_file:
+        json.dump(results, output_file, indent=4, sort_keys=True)
+    json.dump(results, sys.stdout, indent=4, sort_keys=True)
+    sys.stdout.write('\n')
\ No newline at end of file
@@ -0,0 +1,178 @@
+""" Benchmark a full booking and report run against local stand-ins for Raven,
+the meal booking system and the SMTP server, writing the results as JSON.
+
+Usage: `python -m benchmark.run [options]` from the repository root.
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+import main
+from benchmark import fake_servers
+from configuration import Configuration
+from service import booking_service, email_service, raven_service
+
+
+def run_benchmark(arguments):
+    """ Run the program end to end against fake servers.
+    :param arguments: argparse.Namespace containing the benchmark parameters
+    :return: dictionary of benchmark results
+    """
+    fake_caius = fake_servers.FakeCaius(arguments.events, arguments.attendees,
+                                        arguments.latency,
+                                        capacity=arguments.capacity,
+                                        names=_user_names(arguments))
+    raven_url, booking_service_url, servers = fake_servers.start_fake_caius(
+        fake_caius)
+    smtp_sink = fake_servers.SMTPSink()
+    smtp_sink.start()
+
+    raven_service.RAVEN_URL = raven_url
+    booking_service.BOOKING_SERVICE_URL = booking_service_url
+    email_service.SMTP_SERVER = '127.0.0.1'
+    email_service.SMTP_PORT = smtp_sink.port
+    email_service.SMTP_USE_TLS = False
+
+    temporary_directory = tempfile.mkdtemp()
+    try:
+        configuration_file_path = os.path.join(temporary_directory,
+                                               'configuration.json')
+        with open(configuration_file_path, 'w') as configuration_file:
+            json.dump(_configuration_dict(arguments), configuration_file)
+        configuration = Configuration(configuration_file_path)
+
+        phase_times = {}
+        start_time = time.time()
+        phase_start_time = start_time
+        main._authenticate_services(configuration)
+        phase_times['authenticate'] = time.time() - phase_start_time
+
+        phase_start_time = time.time()
+        users = configuration.users
+        phase_times['load_users'] = time.time() - phase_start_time
+
+        phase_start_time = time.time()
+        main._prefetch(users, [3], 0, configuration.prefetch_workers,
+                       configuration.max_requests_per_second)
+        phase_times['prefetch'] = time.time() - phase_start_time
+
+        phase_start_time = time.time()
+        main._make_user_bookings(users, 3, configuration.booking_workers)
+        phase_times['bookings'] = time.time() - phase_start_time
+
+        phase_start_time = time.time()
+        main._send_user_reports(users, 0, configuration.report_workers)
+        phase_times['reports'] = time.time() - phase_start_time
+        wall_time = time.time() - start_time
+    finally:
+        shutil.rmtree(temporary_directory)
+        for server in servers:
+            server.shutdown()
+        smtp_sink.stop()
+
+    http_traffic = fake_caius.counter.as_dict()
+    smtp_traffic = smtp_sink.counter.as_dict()
+    return {
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'parameters': vars(arguments),
+        'wall_time': wall_time,
+        'phase_times': phase_times,
+        'requests': http_traffic['requests'],
+        'emails_sent': smtp_sink.messages,
+        'bytes_transferred': {
+            'http_received': http_traffic['bytes_received'],
+            'http_sent': http_traffic['bytes_sent'],
+            'smtp_received': smtp_traffic['bytes_received'],
+            'smtp_sent': smtp_traffic['bytes_sent']
+        },
+        # ru_maxrss is in kilobytes on Linux.
+        'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def _user_names(arguments):
+    """
+    :return: dictionary mapping each benchmark user's crsid to their name, or
+        an empty dictionary if users aren't given names
+    """
+    if not arguments.names:
+        return {}
+    return dict(('bench%d' % number, 'Bench%d, B' % number)
+                for number in range(arguments.users))
+
+
+def _configuration_dict(arguments):
+    """
+    :return: configuration dictionary (as would be loaded from a configuration
+        file) for the benchmark users
+    """
+    day_strings = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+    names = _user_names(arguments)
+    users = []
+    for number in range(arguments.users):
+        user = {
+            'crsid': 'bench%d' % number,
+            'password': 'password',
+            'friends': ['attendee1,', 'attendee2,'],
+            'events': dict((day_string, 'first')
+                           for day_string in day_strings)
+        }
+        if user['crsid'] in names:
+            user['name'] = names[user['crsid']]
+        users.append(user)
+    return {
+        'default_crsid': 'benchdefault',
+        'default_password': 'password',
+        'gmail_username': 'bench@example.com',
+        'gmail_password': 'password',
+        'booking_workers': arguments.workers,
+        'report_workers': arguments.workers,
+        'prefetch_workers': arguments.workers,
+        'keep_alive': arguments.keep_alive,
+        'users': users
+    }
+
+
+def _parse_arguments():
+    """
+    :return: argparse.Namespace containing the benchmark parameters
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark a booking and report run against local fake '
+                    'servers.')
+    parser.add_argument('--users', type=int, default=20,
+                        help='number of users in the configuration')
+    parser.add_argument('--events', type=int, default=10,
+                        help='number of events in the booking system')
+    parser.add_argument('--attendees', type=int, default=50,
+                        help='number of attendees listed for each event')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds each fake server takes to respond')
+    parser.add_argument('--capacity', type=int,
+                        help='number of bookings each event accepts per day '
+                             '(default unlimited)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='booking, report and prefetch worker threads')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='use the keep-alive transport')
+    parser.add_argument('--names', action='store_true',
+                        help='give each user a name, so bookings can be '
+                             'resolved from attendee lists')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='path to write the JSON results to')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    benchmark_arguments = _parse_arguments()
+    results = run_benchmark(benchmark_arguments)
+    with open(benchmark_arguments.output, 'w') as output_file:
+        json.dump(results, output_file, indent=4, sort_keys=True)
+    json.dump(results, sys.stdout, indent=4, sort_keys=True)
+    sys.stdout.write('\n')
\ No newline at end of file
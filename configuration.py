@@ -1,4 +1,7 @@
+import hashlib
 import json
+import zlib
+from datetime import datetime
 from error import ConfigurationError
 from model.user import User
 from service import booking_service
@@ -15,6 +18,7 @@ class Configuration:
         :raises: ConfigurationError if the configuration file can't be loaded,
             or is not in the correct format
         """
+        self._configuration_file_path = configuration_file_path
         try:
             with open(configuration_file_path, 'r') as configuration_file:
                 json_string = configuration_file.read().replace('\n', '')
@@ -23,11 +27,50 @@ class Configuration:
             self._default_password = self._json_data['default_password']
             self._gmail_username = self._json_data['gmail_username']
             self._gmail_password = self._json_data['gmail_password']
+            self._booking_workers = int(self._json_data.get('booking_workers',
+                                                            1))
+            self._report_workers = int(self._json_data.get('report_workers',
+                                                           1))
+            self._cache_file = self._json_data.get('cache_file')
+            self._session_directory = self._json_data.get(
+                'session_directory')
+            self._keep_alive = bool(self._json_data.get('keep_alive', False))
+            self._prefetch_workers = int(self._json_data.get(
+                'prefetch_workers', 1))
+            self._max_requests_per_second = _get_positive_rate(
+                self._json_data, 'max_requests_per_second')
+            self._users_file = self._json_data.get('users_file')
+            self._connect_timeout = float(self._json_data.get(
+                'connect_timeout', 10))
+            self._read_timeout = float(self._json_data.get('read_timeout',
+                                                           30))
+            self._host_requests_per_second = _get_positive_rate(
+                self._json_data, 'host_requests_per_second')
+            self._fetch_retries = int(self._json_data.get('fetch_retries', 3))
+            self._booking_time = _parse_time_of_day(self._json_data.get(
+                'booking_time', '00:05'))
+            self._report_time = _parse_time_of_day(self._json_data.get(
+                'report_time', '07:00'))
+            self._status_port = self._json_data.get('status_port')
             self._users = None
+            # Maps the hash of each user entry to the User loaded from it,
+            # for this configuration's users and those of the configuration
+            # it was reloaded from.
+            self._users_by_hash = {}
+            self._previous_users_by_hash = {}
+            # Maps each user's crsid to their password, once recorded by
+            # `record_credentials()`.
+            self._credentials = None
+            # Lowercased names given by more than one user, once found.
+            self._shared_names = None
+            self._event_names = None
+            self._preference_index = {}
         except IOError:
             raise ConfigurationError('Cannot load configuration file')
         except KeyError:
             raise ConfigurationError('Incorrect configuration file format')
+        except ValueError:
+            raise ConfigurationError('Incorrect configuration file format')
 
     def _handle_booking_preferences_dict(self, booking_preferences_dict):
         """ Converts a standard textual representation of booking preferences
@@ -36,24 +79,40 @@ class Configuration:
             codes (eg. 'mon', 'tue', ...) to a string describing the event the
             user wishes to book in to
         :return: list, indexed by day index (0 for Sunday, 1 for Monday, ...)
-            where the elements are lists of Event instances that match the
+            where the elements are tuples of Event instances that match the
             user's booking preferences
         """
         day_strings = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
-        available_events = booking_service.get_available_events()
 
-        booking_preferences = [[] for _ in range(7)]
+        booking_preferences = [() for _ in range(7)]
         for user_day_string in booking_preferences_dict:
             if user_day_string.lower() in day_strings:
                 day_index = day_strings.index(user_day_string.lower())
                 user_event_string = booking_preferences_dict[user_day_string]
-
-                def predicate(event):
-                    return user_event_string.lower() in event.name.lower()
-                matching_events = filter(predicate, available_events)
-                booking_preferences[day_index] = matching_events
+                booking_preferences[day_index] = self._get_matching_events(
+                    user_event_string)
         return booking_preferences
 
+    def _get_matching_events(self, event_string):
+        """ Find the events matching a booking preference. Results are indexed
+        by preference, so each distinct preference is only matched once, and
+        users with the same preference share the same tuple.
+        :param event_string: string describing the event the user wishes to
+            book in to
+        :return: tuple of Event instances whose names contain `event_string`
+            (case-insensitively)
+        """
+        event_string = event_string.lower()
+        if event_string not in self._preference_index:
+            if self._event_names is None:
+                self._event_names = [
+                    (event, event.name.lower())
+                    for event in booking_service.get_available_events()]
+            self._preference_index[event_string] = tuple(
+                event for event, event_name in self._event_names
+                if event_string in event_name)
+        return self._preference_index[event_string]
+
     @property
     def default_crsid(self):
         return self._default_crsid
@@ -70,6 +129,111 @@ class Configuration:
     def gmail_password(self):
         return self._gmail_password
 
+    @property
+    def booking_workers(self):
+        """
+        :return: int, maximum number of bookings to make concurrently
+        """
+        return self._booking_workers
+
+    @property
+    def report_workers(self):
+        """
+        :return: int, maximum number of reports to generate concurrently
+        """
+        return self._report_workers
+
+    @property
+    def cache_file(self):
+        """
+        :return: path to the file to persist lookups between runs in, or None
+            if lookups shouldn't be persisted
+        """
+        return self._cache_file
+
+    @property
+    def session_directory(self):
+        """
+        :return: path to the directory to persist Raven sessions in, or None
+            if sessions shouldn't be persisted
+        """
+        return self._session_directory
+
+    @property
+    def keep_alive(self):
+        """
+        :return: bool, True if read-only requests should be made over
+            persistent, pooled connections
+        """
+        return self._keep_alive
+
+    @property
+    def prefetch_workers(self):
+        """
+        :return: int, maximum number of pages to prefetch concurrently
+        """
+        return self._prefetch_workers
+
+    @property
+    def max_requests_per_second(self):
+        """
+        :return: maximum rate to prefetch pages at, or None for no limit
+        """
+        return self._max_requests_per_second
+
+    @property
+    def connect_timeout(self):
+        """
+        :return: float, seconds to wait for a connection before giving up
+        """
+        return self._connect_timeout
+
+    @property
+    def read_timeout(self):
+        """
+        :return: float, seconds to wait for a response before giving up
+        """
+        return self._read_timeout
+
+    @property
+    def host_requests_per_second(self):
+        """
+        :return: maximum average rate to make requests to each host at, or
+            None for no limit
+        """
+        return self._host_requests_per_second
+
+    @property
+    def fetch_retries(self):
+        """
+        :return: int, number of times to retry a failed page fetch
+        """
+        return self._fetch_retries
+
+    @property
+    def booking_time(self):
+        """
+        :return: datetime.time instance for the time of day the daemon makes
+            bookings at
+        """
+        return self._booking_time
+
+    @property
+    def report_time(self):
+        """
+        :return: datetime.time instance for the time of day the daemon sends
+            reports at
+        """
+        return self._report_time
+
+    @property
+    def status_port(self):
+        """
+        :return: int, local port for the daemon to serve its status on, or
+            None if it shouldn't
+        """
+        return self._status_port
+
     @property
     def users(self):
         """ Get the list of users for this system configuration
@@ -77,19 +241,235 @@ class Configuration:
         :raises: ConfigurationError if the supplied configuration file isn't
             in the correct format
         """
-        if self._users is not None:
-            return self._users
-        try:
-            self._users = []
+        if self._users is None:
+            users = []
+            for user_data in self._iter_user_data():
+                entry_hash = _hash_user_data(user_data)
+                user = self._create_user(user_data, entry_hash)
+                self._users_by_hash[entry_hash] = user
+                users.append(user)
+            self._users = users
+            # Users that weren't reused are no longer needed.
+            self._previous_users_by_hash = {}
+        return self._users
+
+    def record_credentials(self):
+        """ Record the crsid and password of every user, so that `reload()`
+        can find the users whose sessions are stale even if users are only
+        ever streamed (eg. from a `users_file`, or in batches), and the file
+        has since changed.
+        :raises: ConfigurationError if the supplied configuration file or users
+            file isn't in the correct format
+        """
+        credentials = {}
+        for user_data in self._iter_user_data():
+            try:
+                credentials[user_data['crsid']] = user_data['password']
+            except KeyError:
+                raise ConfigurationError('Incorrect configuration file format')
+        self._credentials = credentials
+
+    def reload(self):
+        """ Load the configuration file again. If this configuration's users
+        have been loaded, the User instances (and resolved preferences) of
+        users whose entries haven't changed are reused, so only changed or
+        added users are created. Stale users are found from the credentials
+        recorded by `record_credentials()` (which is called on the reloaded
+        configuration, ready for the next reload) or, failing that, from the
+        loaded users.
+        :return: tuple of (configuration, stale_crsids), where
+            `configuration` is the reloaded Configuration, and `stale_crsids`
+            is the set of crsids of users that have been removed, or whose
+            password has changed, so their sessions should be discarded
+        :raises: ConfigurationError if the configuration file can't be loaded,
+            or is not in the correct format
+        """
+        configuration = Configuration(self._configuration_file_path)
+        configuration.record_credentials()
+        if self._credentials is not None:
+            previous_credentials = self._credentials
+        elif self._users is not None:
+            previous_credentials = dict((user.crsid, user.password)
+                                        for user in self._users)
+        else:
+            previous_credentials = {}
+        stale_crsids = set(
+            crsid for crsid, password in previous_credentials.items()
+            if configuration._credentials.get(crsid) != password)
+        if self._users is None:
+            return configuration, stale_crsids
+        if (self._event_names is not None and
+                [(event.code, event.name) for event, _ in self._event_names] ==
+                [(event.code, event.name)
+                 for event in booking_service.get_available_events()]):
+            # Preferences resolved against the same events are still valid.
+            configuration._event_names = self._event_names
+            configuration._preference_index = self._preference_index
+            configuration._previous_users_by_hash = self._users_by_hash
+        # Load the users now, so they're checked before the reload is used.
+        configuration.users
+        return configuration, stale_crsids
+
+    def iter_users(self, shard_count=1, shard_index=0):
+        """ Lazily load each user for this system configuration. If the
+        configuration specifies a `users_file` (with one JSON user per line),
+        users are read from it one at a time, so the whole roster is never
+        held in memory.
+        :param shard_count: number of shards to partition users between
+        :param shard_index: index of the shard to load users for, between 0
+            and `shard_count` - 1. Each user always belongs to the same shard
+        :return: generator of User instances
+        :raises: ConfigurationError if the supplied configuration file or users
+            file isn't in the correct format
+        """
+        for user_data in self._iter_user_data():
+            if _get_shard_index(user_data, shard_count) == shard_index:
+                yield self._create_user(user_data, _hash_user_data(user_data))
+
+    def iter_user_batches(self, batch_size=None, shard_count=1,
+                          shard_index=0):
+        """ Lazily load the users for this system configuration in batches.
+        :param batch_size: maximum number of users in each batch, or None to
+            load every user in a single batch
+        :param shard_count: number of shards to partition users between
+        :param shard_index: index of the shard to load users for, between 0
+            and `shard_count` - 1
+        :return: generator of lists of User instances
+        :raises: ConfigurationError if the supplied configuration file or users
+            file isn't in the correct format
+        """
+        if batch_size is None:
+            if shard_count == 1:
+                yield self.users
+            else:
+                yield list(self.iter_users(shard_count, shard_index))
+            return
+        batch = []
+        for user in self.iter_users(shard_count, shard_index):
+            batch.append(user)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    def _iter_user_data(self):
+        """
+        :return: generator of the dictionaries describing each user
+        :raises: ConfigurationError if the users can't be loaded
+        """
+        if self._users_file is None:
+            if 'users' not in self._json_data:
+                raise ConfigurationError('Incorrect configuration file format')
             for user_data in self._json_data['users']:
-                crsid = user_data['crsid']
-                password = user_data['password']
-                friends = user_data['friends']
-                booking_preferences_dict = user_data['events']
-                booking_preferences = self._handle_booking_preferences_dict(
-                    booking_preferences_dict)
-                self._users.append(User(crsid, password, friends,
-                                        booking_preferences))
-            return self._users
+                yield user_data
+            return
+        try:
+            with open(self._users_file, 'r') as users_file:
+                for line in users_file:
+                    if len(line.strip()) > 0:
+                        yield json.loads(line)
+        except IOError:
+            raise ConfigurationError('Cannot load users file')
+        except ValueError:
+            raise ConfigurationError('Incorrect users file format')
+
+    def _create_user(self, user_data, entry_hash):
+        """
+        :param user_data: dictionary describing a user, as in the `users` list
+            of the configuration file
+        :param entry_hash: hash of `user_data`, as returned by
+            `_hash_user_data()`
+        :return: User instance described by `user_data`, reused from the
+            configuration this was reloaded from if the entry is unchanged
+        :raises: ConfigurationError if `user_data` isn't in the correct format
+        """
+        name = self._get_unique_name(user_data)
+        previous_user = self._previous_users_by_hash.get(entry_hash)
+        if previous_user is not None and previous_user.name == name:
+            return previous_user
+        try:
+            crsid = user_data['crsid']
+            password = user_data['password']
+            friends = user_data['friends']
+            booking_preferences_dict = user_data['events']
+            booking_preferences = self._handle_booking_preferences_dict(
+                booking_preferences_dict)
+            return User(crsid, password, friends, booking_preferences, name)
         except KeyError:
-            raise ConfigurationError('Incorrect configuration file format')
\ No newline at end of file
+            raise ConfigurationError('Incorrect configuration file format')
+
+    def _get_unique_name(self, user_data):
+        """ A name given by more than one user can't tell their bookings
+        apart in attendee lists, so it's ignored.
+        :param user_data: dictionary describing a user
+        :return: the user's name, or None if it isn't given or is shared with
+            another user
+        :raises: ConfigurationError if the users can't be loaded
+        """
+        name = user_data.get('name')
+        if name is None:
+            return None
+        if self._shared_names is None:
+            name_counts = {}
+            for other_user_data in self._iter_user_data():
+                other_name = other_user_data.get('name')
+                if other_name is not None:
+                    other_name = other_name.lower()
+                    name_counts[other_name] = name_counts.get(other_name,
+                                                              0) + 1
+            self._shared_names = set(other_name for other_name, count
+                                     in name_counts.items() if count > 1)
+        if name.lower() in self._shared_names:
+            return None
+        return name
+
+
+def _hash_user_data(user_data):
+    """
+    :param user_data: dictionary describing a user
+    :return: String for a hash of `user_data`, which only changes if the
+        entry does
+    """
+    return hashlib.sha1(json.dumps(user_data, sort_keys=True)).hexdigest()
+
+
+def _get_positive_rate(json_data, key):
+    """
+    :param json_data: dictionary loaded from the configuration file
+    :param key: String for the key of an optional rate (per second)
+    :return: float for the rate, or None if it isn't given
+    :raises: ConfigurationError if the rate isn't a positive number
+    """
+    rate = json_data.get(key)
+    if rate is None:
+        return None
+    rate = float(rate)
+    if rate <= 0:
+        raise ConfigurationError('%s must be positive' % key)
+    return rate
+
+
+def _parse_time_of_day(time_string):
+    """
+    :param time_string: String for a time of day, in the format HH:MM
+    :return: datetime.time instance for `time_string`
+    :raises: ValueError if `time_string` isn't in the correct format
+    """
+    return datetime.strptime(time_string, '%H:%M').time()
+
+
+def _get_shard_index(user_data, shard_count):
+    """ Deterministically assign a user to a shard, based on their crsid.
+    :param user_data: dictionary describing a user
+    :param shard_count: number of shards to partition users between
+    :return: index of the shard the user belongs to
+    :raises: ConfigurationError if `user_data` isn't in the correct format
+    """
+    if shard_count == 1:
+        return 0
+    try:
+        crsid = user_data['crsid']
+    except KeyError:
+        raise ConfigurationError('Incorrect configuration file format')
+    return (zlib.crc32(crsid.encode('utf-8')) & 0xffffffff) % shard_count
\ No newline at end of file
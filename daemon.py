@@ -0,0 +1,378 @@
+""" Runs the booking and report phases every day, at the times given in the
+configuration, within a single long-running process. Configuration, Raven
+sessions and the persistent cache stay warm between runs, the configuration
+file is reloaded when it changes, and the status of the last runs can be
+served locally as JSON.
+
+Usage: `python daemon.py <configuration_file> [options]`.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from datetime import date, datetime, timedelta
+import main
+from configuration import Configuration
+from error import ConfigurationError
+from service import booking_service, email_service, instrumentation
+from service import raven_service, report_service, throttle
+
+# How often (in seconds) to check whether the configuration file has changed.
+RELOAD_INTERVAL = 10
+PHASES = ('bookings', 'reports')
+
+
+class Daemon:
+    """ Schedules the booking and report phases, and records the outcome of
+    each run for the status endpoint.
+    """
+
+    def __init__(self, arguments):
+        """ Construct a new Daemon.
+        :param arguments: argparse.Namespace containing the command line
+            arguments
+        """
+        self._arguments = arguments
+        self._configuration = None
+        self._configuration_mtime = None
+        self._started_at = time.time()
+        self._next_runs = {}
+        self._last_runs = {}
+        self._lock = threading.Lock()
+
+    def run(self):
+        """ Load the configuration, then run each phase at its scheduled time,
+        forever.
+        :raises: ConfigurationError if the configuration can't be loaded
+        """
+        self._load_configuration()
+        main._authenticate_services(self._configuration)
+        if self._configuration.status_port is not None:
+            instrumentation.enable()
+            _start_status_server(self, self._configuration.status_port)
+        now = datetime.now()
+        for phase in PHASES:
+            self._set_next_run(phase, self._get_run_after(phase, now))
+        while True:
+            with self._lock:
+                phase = min(PHASES, key=lambda phase: self._next_runs[phase])
+                run_at = self._next_runs[phase]
+            if not self._wait_until(time.mktime(run_at.timetuple())):
+                # The schedule may have changed.
+                continue
+            now = datetime.now()
+            if now - run_at > timedelta(days=1):
+                # Don't catch up on runs missed while not running.
+                _log('Skipping %s scheduled for %s' % (phase,
+                                                       run_at.isoformat()))
+                self._set_next_run(phase, self._get_run_after(phase, now))
+            else:
+                self._run_phase(phase)
+                self._set_next_run(phase, self._get_run_after(phase, run_at))
+
+    def status(self):
+        """
+        :return: JSON-serialisable dictionary describing the daemon, its
+            schedule and the outcome of the last run of each phase
+        """
+        with self._lock:
+            return {
+                'started_at': _format_time(self._started_at),
+                'configuration_loaded_at': _format_time(
+                    self._configuration_mtime),
+                'next_runs': dict((phase, run_at.isoformat()) for
+                                  phase, run_at in self._next_runs.items()),
+                'last_runs': dict(self._last_runs)
+            }
+
+    def _get_run_after(self, phase, after):
+        """
+        :param phase: String naming the phase, as in PHASES
+        :param after: datetime.datetime to find the next run after
+        :return: datetime.datetime of the first time `phase` is scheduled to
+            run after `after`
+        """
+        run_at = datetime.combine(after.date(),
+                                  _get_time_of_day(self._configuration, phase))
+        if run_at <= after:
+            run_at += timedelta(days=1)
+        return run_at
+
+    def _set_next_run(self, phase, run_at):
+        """ Schedule the next run of `phase`. Each phase keeps its own next
+        run, so a phase that falls due while another is running still runs
+        (late) once that run finishes, rather than being skipped.
+        :param phase: String naming the phase, as in PHASES
+        :param run_at: datetime.datetime to run `phase` at
+        """
+        with self._lock:
+            self._next_runs[phase] = run_at
+
+    def _wait_until(self, run_at):
+        """ Sleep until `run_at`, reloading the configuration if it changes.
+        :param run_at: time to wait until, in seconds since the epoch
+        :return: bool, True if `run_at` was reached, or False if the
+            configuration was reloaded first (so the schedule may have changed)
+        """
+        while time.time() < run_at:
+            time.sleep(max(0, min(RELOAD_INTERVAL, run_at - time.time())))
+            if self._reload_if_changed():
+                return False
+        return True
+
+    def _run_phase(self, phase):
+        """ Run `phase` for every user, recording its outcome.
+        :param phase: String naming the phase, as in PHASES
+        """
+        _log('Running %s' % phase)
+        instrumentation.reset()
+        configuration = self._configuration
+        # Pages are fetched afresh for each run, but persistently cached
+        # values and Raven sessions are reused. Reopening the cache evicts
+        # values for past dates.
+        booking_service.clear_page_caches()
+        main._open_cache(configuration, self._arguments)
+        booking_days = main._booking_days(self._arguments)
+        date_for_report = date.today()
+        start_time = time.time()
+        step_times = {}
+        error = None
+        try:
+            user_batches = configuration.iter_user_batches(
+                self._arguments.batch_size)
+            for users in user_batches:
+                if phase == 'bookings':
+                    self._run_bookings(configuration, users, booking_days,
+                                       step_times)
+                else:
+                    self._run_reports(configuration, users, step_times)
+        except Exception:
+            error = traceback.format_exc()
+            _log('%s failed:\n%s' % (phase, error))
+        if phase == 'reports':
+            report_service.discard_date(date_for_report)
+
+        last_run = {
+            'started_at': _format_time(start_time),
+            'wall_time': time.time() - start_time,
+            'step_times': step_times,
+            'error': error
+        }
+        if instrumentation.is_enabled():
+            last_run['metrics'] = instrumentation.get_report()
+        with self._lock:
+            self._last_runs[phase] = last_run
+        _log('Finished %s in %.1fs' % (phase, last_run['wall_time']))
+
+    def _run_bookings(self, configuration, users, booking_days, step_times):
+        """ Prefetch the pages needed for, then make, `users`' bookings.
+        :param configuration: Configuration instance for system configuration
+        :param users: list of User instances to make bookings for
+        :param booking_days: list of how many days in advance to book
+        :param step_times: dictionary to add the time taken by each step to
+        """
+        with _Step(step_times, 'prefetch'):
+            rate_limiter = throttle.RateLimiter(
+                configuration.max_requests_per_second)
+            main._prefetch_events(users, booking_days, None,
+                                  configuration.prefetch_workers,
+                                  rate_limiter)
+        with _Step(step_times, 'bookings'):
+            main._make_scheduled_bookings(users, booking_days,
+                                          configuration.booking_workers)
+
+    def _run_reports(self, configuration, users, step_times):
+        """ Prefetch the pages needed for, then send, `users`' reports.
+        :param configuration: Configuration instance for system configuration
+        :param users: list of User instances to send reports to
+        :param step_times: dictionary to add the time taken by each step to
+        """
+        with _Step(step_times, 'prefetch'):
+            main._prefetch(users, [], 0, configuration.prefetch_workers,
+                           configuration.max_requests_per_second)
+        with _Step(step_times, 'reports'):
+            main._send_user_reports(users, 0, configuration.report_workers)
+
+    def _load_configuration(self):
+        """ Load the configuration file.
+        :raises: ConfigurationError if the configuration can't be loaded
+        """
+        configuration_file_path = self._arguments.configuration_file
+        mtime = os.path.getmtime(configuration_file_path)
+        self._configuration = Configuration(configuration_file_path)
+        self._configuration.record_credentials()
+        with self._lock:
+            self._configuration_mtime = mtime
+
+    def _reload_if_changed(self):
+        """ Reload the configuration file if it has been modified. Unchanged
+        users are kept, along with their Raven sessions. The sessions of
+        removed users (and users whose password has changed) are discarded,
+        and the default browser is only replaced if the default credentials
+        have changed. A configuration that can't be loaded is ignored, and
+        the previous one kept.
+        :return: bool, True if the configuration was reloaded
+        """
+        configuration_file_path = self._arguments.configuration_file
+        previous_configuration = self._configuration
+        try:
+            mtime = os.path.getmtime(configuration_file_path)
+            if mtime == self._configuration_mtime:
+                return False
+            configuration, stale_crsids = previous_configuration.reload()
+        except OSError as error:
+            _log('Not reloading configuration: %s' % error)
+            return False
+        except ConfigurationError as error:
+            _log('Not reloading configuration: %s' % error)
+            # Don't retry until the file changes again.
+            with self._lock:
+                self._configuration_mtime = mtime
+            return False
+        except Exception:
+            # Eg. the event list couldn't be fetched. Retry next time.
+            _log('Not reloading configuration:\n%s' % traceback.format_exc())
+            return False
+
+        self._configuration = configuration
+        with self._lock:
+            self._configuration_mtime = mtime
+        now = datetime.now()
+        for phase in PHASES:
+            # Reschedule phases whose time of day has changed.
+            if (_get_time_of_day(configuration, phase) !=
+                    _get_time_of_day(previous_configuration, phase)):
+                self._set_next_run(phase, self._get_run_after(phase, now))
+        for crsid in stale_crsids:
+            booking_service.discard_user(crsid)
+        if ((configuration.default_crsid, configuration.default_password) !=
+                (previous_configuration.default_crsid,
+                 previous_configuration.default_password)):
+            raven_service.set_default_credentials(
+                configuration.default_crsid, configuration.default_password)
+        email_service.set_email_credentials(configuration.gmail_username,
+                                            configuration.gmail_password)
+        _log('Reloaded configuration')
+        return True
+
+
+class _Step:
+    """ Times the block it's used as the context manager for, adding the
+    duration to a dictionary of step times.
+    """
+
+    def __init__(self, step_times, name):
+        self._step_times = step_times
+        self._name = name
+        self._start_time = None
+
+    def __enter__(self):
+        self._start_time = time.time()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        duration = time.time() - self._start_time
+        self._step_times[self._name] = (
+            self._step_times.get(self._name, 0) + duration)
+        return False
+
+
+class _StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the daemon's status as JSON. """
+
+    daemon = None
+
+    def do_GET(self):
+        body = json.dumps(self.daemon.status(), indent=4, sort_keys=True)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def _start_status_server(daemon, port):
+    """ Serve `daemon`'s status on localhost, from a background thread.
+    :param daemon: Daemon instance to serve the status of
+    :param port: local port to serve the status on
+    """
+    class StatusHandler(_StatusHandler):
+        pass
+    StatusHandler.daemon = daemon
+    server = _ThreadingHTTPServer(('127.0.0.1', port), StatusHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def _get_time_of_day(configuration, phase):
+    """
+    :param configuration: Configuration instance for system configuration
+    :param phase: String naming the phase, as in PHASES
+    :return: datetime.time instance for the time `phase` runs each day
+    """
+    if phase == 'bookings':
+        return configuration.booking_time
+    return configuration.report_time
+
+
+def _format_time(timestamp):
+    """
+    :param timestamp: time in seconds since the epoch, or None
+    :return: String for `timestamp` in ISO 8601 format (local time), or None
+    """
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp).isoformat()
+
+
+def _log(message):
+    """ Write `message` to standard output, with a timestamp. """
+    sys.stdout.write('[%s] %s\n' % (datetime.now().isoformat(), message))
+    sys.stdout.flush()
+
+
+def _parse_arguments():
+    """
+    :return: argparse.Namespace containing the command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Book into Caius hall and send booking/menu email '
+                    'notifications every day, as a long-running process.')
+    parser.add_argument('configuration_file',
+                        help='path to configuration file. See '
+                             '`configuration.example` for an example')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='don\'t use or update the persistent cache')
+    parser.add_argument('--book-from', type=int, default=3, metavar='DAYS',
+                        help='book from DAYS days in advance (default 3)')
+    parser.add_argument('--book-to', type=int, metavar='DAYS',
+                        help='book up to and including DAYS days in advance '
+                             '(defaults to --book-from)')
+    parser.add_argument('--batch-size', type=int, metavar='USERS',
+                        help='load and process users in batches of USERS, '
+                             'so memory use stays flat for large rosters')
+    parser.set_defaults(refresh_cache=False, record=None, replay=None)
+    arguments = parser.parse_args()
+    if (arguments.book_to is not None and
+            arguments.book_to < arguments.book_from):
+        parser.error('--book-to must be at least --book-from')
+    return arguments
+
+
+if __name__ == '__main__':
+    Daemon(_parse_arguments()).run()
\ No newline at end of file
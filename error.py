@@ -7,4 +7,8 @@ class BookingServiceError(Exception):
 
 
 class ConfigurationError(Exception):
+    pass
+
+
+class ServiceUnavailableError(Exception):
     pass
\ No newline at end of file
@@ -1,48 +1,595 @@
-import sys
-from datetime import date, timedelta
+import argparse
+import json
+import multiprocessing
+import time
+from datetime import date, datetime, timedelta
+from multiprocessing.pool import ThreadPool
 from configuration import Configuration
-from service import raven_service, email_service
+from error import BookingServiceError, ServiceUnavailableError
+from service import booking_service, cache_service, raven_service
+from service import email_service, instrumentation, report_service
+from service import throttle, transport
 
 
 def main():
-    configuration_file_path = sys.argv[1]
-    configuration = Configuration(configuration_file_path)
-    _authenticate_services(configuration)
-    _make_user_bookings(configuration.users, 3)
-    _send_user_reports(configuration.users, 0)
+    arguments = _parse_arguments()
+    if _is_profiling(arguments):
+        instrumentation.enable()
+    process_pool = None
+    if arguments.processes is not None:
+        # Fork the worker processes before any threads, connections or locks
+        # exist, as they wouldn't be safe to use in the workers.
+        process_pool = multiprocessing.Pool(arguments.processes)
+    with instrumentation.span('phase.load_configuration'):
+        configuration = Configuration(arguments.configuration_file)
+    with instrumentation.span('phase.authenticate'):
+        _authenticate_services(configuration, arguments)
+    _open_cache(configuration, arguments)
+    if arguments.snapshot is not None:
+        with open(arguments.snapshot, 'r') as snapshot_file:
+            booking_service.load_snapshot(json.load(snapshot_file))
 
+    if arguments.write_snapshot is not None:
+        snapshot = _create_snapshot(configuration, arguments)
+        with open(arguments.write_snapshot, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+    elif arguments.processes is not None:
+        _run_process_pool(configuration, arguments, process_pool)
+    elif arguments.race_at is not None:
+        users = list(configuration.iter_users(arguments.shards,
+                                              arguments.shard_index))
+        date_to_book = date.today() + timedelta(days=arguments.book_from)
+        results = _race_bookings(users, date_to_book, arguments.race_at,
+                                 configuration.booking_workers)
+        for user, (booking, latency) in zip(users, results):
+            print('%s: %s (%d ms)' % (user, booking, latency * 1000))
+    else:
+        _run_users(configuration, arguments, arguments.shards,
+                   arguments.shard_index)
+    if _is_profiling(arguments):
+        _write_profile(arguments)
 
-def _authenticate_services(configuration):
+
+def _run_users(configuration, arguments, shard_count=1, shard_index=0):
+    """ Run the prefetch, booking and report phases for the users in one
+    shard of the configuration, in batches.
+    :param configuration: Configuration instance for system configuration
+    :param arguments: argparse.Namespace containing the command line arguments
+    :param shard_count: number of shards users are partitioned between
+    :param shard_index: index of the shard to run
+    """
+    booking_days = _booking_days(arguments)
+    user_batches = configuration.iter_user_batches(arguments.batch_size,
+                                                   shard_count, shard_index)
+    for users in user_batches:
+        _run_user_batch(configuration, users, booking_days)
+        if arguments.batch_size is not None:
+            # Free per-user state, so memory use doesn't grow with the roster.
+            for user in users:
+                booking_service.discard_user(user.crsid)
+
+
+def _create_snapshot(configuration, arguments):
+    """ Fetch the event list and every event page needed by any user, to be
+    shared between shards.
+    :param configuration: Configuration instance for system configuration
+    :param arguments: argparse.Namespace containing the command line arguments
+    :return: snapshot returned by `booking_service.export_snapshot()`
+    """
+    with instrumentation.span('phase.snapshot'):
+        rate_limiter = throttle.RateLimiter(
+            configuration.max_requests_per_second)
+        _prefetch_events(configuration.iter_users(), _booking_days(arguments),
+                         0, configuration.prefetch_workers, rate_limiter)
+        return booking_service.export_snapshot()
+
+
+def _run_process_pool(configuration, arguments, pool):
+    """ Run every shard in its own process, sharing a snapshot of the event
+    data (fetched once, by this process) with each of them.
+    :param configuration: Configuration instance for system configuration
+    :param arguments: argparse.Namespace containing the command line arguments
+    :param pool: multiprocessing.Pool instance with a worker process for
+        each shard, forked before this process started any threads
+    """
+    try:
+        snapshot = _create_snapshot(configuration, arguments)
+        shards = [(arguments, shard_index, snapshot)
+                  for shard_index in range(arguments.processes)]
+        pool.map(_run_shard, shards)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _run_shard(shard):
+    """ Run a single shard, within a worker process.
+    :param shard: tuple of (arguments, shard_index, snapshot), where
+        `arguments` is the argparse.Namespace containing the command line
+        arguments, and `snapshot` is the shared event data
+    """
+    arguments, shard_index, snapshot = shard
+    # Worker processes are reused if there are more shards than workers.
+    instrumentation.reset()
+    configuration = Configuration(arguments.configuration_file)
+    _authenticate_services(configuration, arguments)
+    _open_cache(configuration, arguments)
+    booking_service.load_snapshot(snapshot)
+    _run_users(configuration, arguments, arguments.processes, shard_index)
+    if _is_profiling(arguments):
+        _write_profile(arguments, shard_index)
+
+
+def _run_user_batch(configuration, users, booking_days):
+    """ Run the prefetch, booking and report phases for `users`.
+    :param configuration: Configuration instance for system configuration
+    :param users: list of User instances to run the phases for
+    :param booking_days: list of how many days in advance to book
+    """
+    with instrumentation.span('phase.prefetch'):
+        _prefetch(users, booking_days, 0, configuration.prefetch_workers,
+                  configuration.max_requests_per_second)
+    with instrumentation.span('phase.bookings'):
+        _make_scheduled_bookings(users, booking_days,
+                                 configuration.booking_workers)
+    if 0 in booking_days:
+        # Today's attendee lists were read before today's bookings were made,
+        # so read them again for the reports.
+        booking_service.discard_date_pages(date.today())
+        report_service.discard_date(date.today())
+        with instrumentation.span('phase.prefetch'):
+            _prefetch(users, [], 0, configuration.prefetch_workers,
+                      configuration.max_requests_per_second)
+    with instrumentation.span('phase.reports'):
+        _send_user_reports(users, 0, configuration.report_workers)
+
+
+def _parse_arguments():
+    """
+    :return: argparse.Namespace containing the command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Automate booking into Caius hall, and send booking/menu '
+                    'email notifications.')
+    parser.add_argument('configuration_file',
+                        help='path to configuration file. See '
+                             '`configuration.example` for an example')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='don\'t use or update the persistent cache')
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help='ignore existing values in the persistent '
+                             'cache, refreshing them all')
+    parser.add_argument('--book-from', type=int, default=3, metavar='DAYS',
+                        help='book from DAYS days in advance (default 3)')
+    parser.add_argument('--book-to', type=int, metavar='DAYS',
+                        help='book up to and including DAYS days in advance '
+                             '(defaults to --book-from)')
+    parser.add_argument('--batch-size', type=int, metavar='USERS',
+                        help='load and process users in batches of USERS, '
+                             'so memory use stays flat for large rosters')
+    parser.add_argument('--shards', type=int, default=1, metavar='N',
+                        help='partition users into N shards, and only run '
+                             'the shard given by --shard-index')
+    parser.add_argument('--shard-index', type=int, default=0, metavar='I',
+                        help='index (from 0) of the shard to run')
+    parser.add_argument('--processes', type=int, metavar='N',
+                        help='run N shards at once, each in its own process, '
+                             'sharing event data fetched once')
+    parser.add_argument('--write-snapshot', metavar='PATH',
+                        help='fetch the event data needed by every user, '
+                             'write it to PATH for shards to share, and exit')
+    parser.add_argument('--snapshot', metavar='PATH',
+                        help='load shared event data written by '
+                             '--write-snapshot')
+    parser.add_argument('--race-at', type=_parse_opening_time,
+                        metavar='HH:MM[:SS]',
+                        help='log every user in and open their booking forms '
+                             'now, then submit every booking at once at this '
+                             'time today, for the day given by --book-from. '
+                             'Reports are not sent')
+    parser.add_argument('--record', metavar='PATH',
+                        help='record every page fetched to the archive at '
+                             'PATH, for replaying with --replay')
+    parser.add_argument('--replay', metavar='PATH',
+                        help='serve every page from the archive recorded at '
+                             'PATH rather than the network, without using '
+                             'the persistent cache or sending emails')
+    parser.add_argument('--profile', action='store_true',
+                        help='print a summary of fetches, cache hits and '
+                             'timings at the end of the run')
+    parser.add_argument('--profile-json', metavar='PATH',
+                        help='write the run profile to PATH as JSON')
+    parser.add_argument('--profile-trace', metavar='PATH',
+                        help='write the run\'s timed spans to PATH in the '
+                             'Chrome trace event format')
+    arguments = parser.parse_args()
+    if arguments.shards < 1:
+        parser.error('--shards must be at least 1')
+    if not 0 <= arguments.shard_index < arguments.shards:
+        parser.error('--shard-index must be between 0 and --shards - 1')
+    if arguments.processes is not None and arguments.processes < 1:
+        parser.error('--processes must be at least 1')
+    if (arguments.book_to is not None and
+            arguments.book_to < arguments.book_from):
+        parser.error('--book-to must be at least --book-from')
+    if arguments.race_at is not None and arguments.book_to is not None:
+        parser.error('--book-to can\'t be used with --race-at, which only '
+                     'books the day given by --book-from')
+    return arguments
+
+
+def _parse_opening_time(time_string):
+    """
+    :param time_string: String for a time today, in the format HH:MM or
+        HH:MM:SS
+    :return: float, the time as seconds since the epoch
+    :raises: argparse.ArgumentTypeError if `time_string` isn't a valid time
+    """
+    for time_format in ('%H:%M:%S', '%H:%M'):
+        try:
+            opening_time = datetime.strptime(time_string, time_format).time()
+        except ValueError:
+            continue
+        opening_datetime = datetime.combine(date.today(), opening_time)
+        return time.mktime(opening_datetime.timetuple())
+    raise argparse.ArgumentTypeError('Invalid time: %s' % time_string)
+
+
+def _booking_days(arguments):
+    """
+    :param arguments: argparse.Namespace containing the command line arguments
+    :return: list of how many days in advance to book, for each day in the
+        booking window requested by `arguments`
+    """
+    if arguments.book_to is None:
+        return [arguments.book_from]
+    return range(arguments.book_from, arguments.book_to + 1)
+
+
+def _is_profiling(arguments):
+    """
+    :param arguments: argparse.Namespace containing the command line arguments
+    :return: bool, True if `arguments` request a profile of the run
+    """
+    return (arguments.profile or arguments.profile_json is not None or
+            arguments.profile_trace is not None)
+
+
+def _write_profile(arguments, shard_index=None):
+    """ Output the run profile, as requested by `arguments`. Each worker
+    process outputs its own shard's profile, to paths suffixed with the
+    shard index.
+    :param arguments: argparse.Namespace containing the command line arguments
+    :param shard_index: index of the shard run by this worker process, or
+        None for the main process
+    """
+    suffix = ''
+    if shard_index is not None:
+        suffix = '.shard%d' % shard_index
+    if arguments.profile:
+        if shard_index is not None:
+            print('Shard %d:' % shard_index)
+        print(instrumentation.summary())
+    if arguments.profile_json is not None:
+        instrumentation.write_json(arguments.profile_json + suffix)
+    if arguments.profile_trace is not None:
+        instrumentation.write_chrome_trace(arguments.profile_trace + suffix)
+
+
+def _open_cache(configuration, arguments):
+    """ Open the persistent cache for booking_service lookups, if one is
+    configured and it hasn't been disabled by `arguments`. Recorded and
+    replayed runs never use it, so every page is recorded (unconditionally)
+    and every value is read from the recorded pages.
+    :param configuration: Configuration instance for system configuration
+    :param arguments: argparse.Namespace containing the command line arguments
+    """
+    if (configuration.cache_file is None or arguments.no_cache or
+            arguments.record is not None or arguments.replay is not None):
+        return
+    cache_service.open_cache(configuration.cache_file, date.today(),
+                             arguments.refresh_cache)
+
+
+def _authenticate_services(configuration, arguments=None):
     """ Use `configuration` to authenticate raven_service and email_service.
     :param configuration: Configuration instance for system configuration
+    :param arguments: argparse.Namespace containing the command line
+        arguments, or None. Requests to record or replay pages are taken from
+        it
     """
+    if arguments is not None and arguments.replay is not None:
+        # Replayed pages need no retries or rate limiting, and nothing
+        # should reach the outside world.
+        transport.set_transport(transport.ReplayTransport(
+            arguments.replay, raven_service.get_browser_crsid))
+        email_service.set_dry_run(True)
+    else:
+        if configuration.keep_alive:
+            request_transport = transport.KeepAliveTransport(
+                configuration.connect_timeout, configuration.read_timeout)
+        else:
+            request_transport = transport.BrowserTransport(
+                configuration.read_timeout)
+        if arguments is not None and arguments.record is not None:
+            request_transport = transport.RecordingTransport(
+                request_transport, arguments.record,
+                raven_service.get_browser_crsid)
+        transport.set_transport(transport.ResilientTransport(
+            request_transport, configuration.host_requests_per_second,
+            configuration.fetch_retries))
+    if (configuration.session_directory is not None and
+            (arguments is None or
+             (arguments.record is None and arguments.replay is None))):
+        # Recorded runs always log in, so that replayed runs can too.
+        raven_service.set_session_directory(configuration.session_directory)
     raven_service.set_default_credentials(configuration.default_crsid,
                                           configuration.default_password)
     email_service.set_email_credentials(configuration.gmail_username,
                                         configuration.gmail_password)
 
 
-def _make_user_bookings(users, days_in_advance):
-    """ Create bookings for each user in `users`.
+def _prefetch(users, booking_days, report_days_in_advance, max_workers=1,
+              max_rate=None):
+    """ Plan every page the booking and report phases will need, and fetch
+    them concurrently into the booking_service caches, so that neither phase
+    blocks on the network for lookups.
+    :param users: list of User instances the run is for
+    :param booking_days: list of how many days in advance bookings will be
+        made for
+    :param report_days_in_advance: how far in advance reports will be for
+    :param max_workers: maximum number of pages to fetch concurrently
+    :param max_rate: maximum number of fetches to start per second, or None
+        for no limit
+    """
+    date_for_report = date.today() + timedelta(days=report_days_in_advance)
+    rate_limiter = throttle.RateLimiter(max_rate)
+    _prefetch_events(users, booking_days, report_days_in_advance, max_workers,
+                     rate_limiter)
+
+    def log_in_user(user):
+        raven_service.get_authenticated_browser(user.crsid, user.password)
+
+    def prefetch_booking(event_user):
+        event, user = event_user
+        booking_service.get_booking(event, user, date_for_report)
+
+    # Only bookings that can't be resolved from the (now fetched) attendee
+    # lists need each user's own page, so only users with bookings to make
+    # or check need to log in.
+    unresolved_bookings = booking_service.get_unresolved_bookings(
+        users, date_for_report)
+    users_to_log_in = set(user for user, _, _ in
+                          _booking_jobs(users, _dates_to_book(booking_days)))
+    users_to_log_in.update(user for _, user in unresolved_bookings)
+    _run_rate_limited(log_in_user,
+                      [user for user in users if user in users_to_log_in],
+                      max_workers, rate_limiter)
+    _run_rate_limited(prefetch_booking, unresolved_bookings, max_workers,
+                      rate_limiter)
+
+
+def _prefetch_events(users, booking_days, report_days_in_advance,
+                     max_workers, rate_limiter):
+    """ Fetch every event page the booking and report phases will need for
+    `users` into the booking_service caches.
+    :param users: iterable of User instances the run is for
+    :param booking_days: list of how many days in advance bookings will be
+        made for
+    :param report_days_in_advance: how far in advance reports will be for, or
+        None if no reports will be sent
+    :param max_workers: maximum number of pages to fetch concurrently
+    :param rate_limiter: throttle.RateLimiter instance limiting fetches
+    """
+    # Reports need every event on the report date, and bookings need each
+    # user's preferred events on each booking date. Events shared between
+    # users or dates are only fetched once.
+    event_dates = set()
+    if report_days_in_advance is not None:
+        date_for_report = date.today() + timedelta(
+            days=report_days_in_advance)
+        event_dates.update((event, date_for_report) for event
+                           in booking_service.get_available_events())
+    for _, date_to_book, events in _booking_jobs(users,
+                                                 _dates_to_book(booking_days)):
+        for event in events:
+            event_dates.add((event, date_to_book))
+
+    def prefetch_event(event_date):
+        booking_service.prefetch_event(*event_date)
+
+    _run_rate_limited(prefetch_event, list(event_dates), max_workers,
+                      rate_limiter)
+
+
+def _run_rate_limited(function, items, max_workers, rate_limiter):
+    """ Call `function` on each of `items`, using up to `max_workers` threads,
+    with calls started no faster than `rate_limiter` allows.
+    :return: list of the results of each call, in the order of `items`
+    """
+    def call_rate_limited(item):
+        rate_limiter.wait()
+        return _skip_if_unavailable(function, item)
+
+    pool = ThreadPool(max(1, max_workers))
+    try:
+        return pool.map(call_rate_limited, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _dates_to_book(booking_days):
+    """
+    :param booking_days: list of how many days in advance to book
+    :return: list of datetime.date instances for each day in `booking_days`
+    """
+    return [date.today() + timedelta(days=days_in_advance)
+            for days_in_advance in booking_days]
+
+
+def _booking_jobs(users, dates_to_book):
+    """ Find every booking to attempt for `users` over `dates_to_book`. Both
+    prefetching and booking are planned from these jobs.
     :param users: list of Users to create bookings for
-    :param days_in_advance: how far in advance to book
-    :return: list of Booking instances containing all booked events
+    :param dates_to_book: list of datetime.date instances for the days to
+        book
+    :return: list of (user, date, events) tuples, one for each user and date
+        where the user wishes to book in to one of `events`
     """
-    date_to_book = date.today() + timedelta(days=days_in_advance)
-    bookings = []
+    booking_jobs = []
     for user in users:
-        bookings.append(user.create_booking(date_to_book))
-    return bookings
+        for date_to_book in dates_to_book:
+            events = user.booking_preferences_for(date_to_book)
+            if len(events) > 0:
+                booking_jobs.append((user, date_to_book, events))
+    return booking_jobs
 
 
-def _send_user_reports(users, days_in_advance):
-    """ Send reports to each user in `users`.
+def _make_user_bookings(users, days_in_advance, max_workers=1):
+    """ Create bookings for each user in `users`, making up to `max_workers`
+    bookings concurrently.
+    :param users: list of Users to create bookings for
+    :param days_in_advance: how far in advance to book
+    :param max_workers: maximum number of bookings to make concurrently
+    :return: tuple of (bookings, timings). `bookings` is a list of the Booking
+        instance (or None) made for each user, and `timings` is a list of the
+        time taken in seconds to book each user, both in the order of `users`
+    """
+    bookings, timings = _make_scheduled_bookings(users, [days_in_advance],
+                                                 max_workers)
+    return [user_bookings[0] for user_bookings in bookings], timings
+
+
+def _make_scheduled_bookings(users, booking_days, max_workers=1):
+    """ Create bookings for each user in `users` on each day in
+    `booking_days`, in a single pass sharing sessions and caches. The
+    bookings made are those planned by `_booking_jobs()` (as prefetched).
+    Different users are booked concurrently, and each user's days are booked
+    in turn.
+    :param users: list of Users to create bookings for
+    :param booking_days: list of how many days in advance to book
+    :param max_workers: maximum number of users to book concurrently
+    :return: tuple of (bookings, timings). `bookings` is a list containing,
+        for each user, a list of the Booking instance (or None) made for each
+        day in `booking_days`. `timings` is a list of the time taken in
+        seconds to book each user. Both are in the order of `users`
+    """
+    dates_to_book = _dates_to_book(booking_days)
+    user_dates = {}
+    for user, date_to_book, _ in _booking_jobs(users, dates_to_book):
+        user_dates.setdefault(user, []).append(date_to_book)
+
+    def book_user(user):
+        start_time = time.time()
+        user_bookings = dict(
+            (date_to_book, _skip_if_unavailable(user.create_booking,
+                                                date_to_book))
+            for date_to_book in user_dates.get(user, []))
+        return ([user_bookings.get(date_to_book)
+                 for date_to_book in dates_to_book],
+                time.time() - start_time)
+
+    pool = ThreadPool(max(1, max_workers))
+    try:
+        results = pool.map(book_user, users)
+    finally:
+        pool.close()
+        pool.join()
+    bookings = [booking for booking, _ in results]
+    timings = [timing for _, timing in results]
+    for timing in timings:
+        instrumentation.observe('booking.user_seconds', timing)
+    return bookings, timings
+
+
+def _race_bookings(users, date_to_book, opening_time, max_workers=1):
+    """ Book each user in `users` as soon as booking opens. Every user is
+    logged in and has their booking form opened beforehand, then bookings
+    are submitted concurrently (up to `max_workers` at once) at
+    `opening_time`. If a user's submission fails, their remaining preferred
+    events are tried in turn.
+    :param users: list of Users to create bookings for
+    :param date_to_book: datetime.date instance for the day to book
+    :param opening_time: float, time (in seconds since the epoch) booking
+        opens at
+    :param max_workers: maximum number of users to log in, prepare or
+        submit bookings for concurrently
+    :return: list containing a tuple of (booking, latency) for each user, in
+        the order of `users`. `booking` is the Booking instance made (or
+        None), and `latency` is the time in seconds from submitting the
+        booking (at `opening_time`, or at once if it has passed) until it was
+        made
+    """
+    pool = ThreadPool(max(1, min(len(users), max_workers)))
+    try:
+        with instrumentation.span('phase.race_prepare'):
+            prepared_bookings = pool.map(
+                lambda user: _skip_if_unavailable(user.prepare_booking,
+                                                  date_to_book), users)
+
+        def submit_booking(user_prepared_booking):
+            user, prepared_booking = user_prepared_booking
+            # Sleep most of the wait, then spin for the rest, as sleeping
+            # can overshoot.
+            while time.time() < opening_time:
+                time.sleep(max(0, min(opening_time - time.time() - 0.01, 1)))
+            start_time = time.time()
+            if prepared_booking is None:
+                return None, time.time() - start_time
+            event, browser = prepared_booking
+            try:
+                booking = booking_service.submit_booking(event, user,
+                                                         date_to_book, browser)
+            except BookingServiceError:
+                booking = _skip_if_unavailable(user.create_booking,
+                                               date_to_book, (event,))
+            except ServiceUnavailableError:
+                booking = None
+            latency = time.time() - start_time
+            instrumentation.observe('race.latency_seconds', latency)
+            return booking, latency
+
+        with instrumentation.span('phase.race_submit'):
+            return pool.map(submit_booking, zip(users, prepared_bookings))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _send_user_reports(users, days_in_advance, max_workers=1):
+    """ Send reports to each user in `users`. Reports are generated
+    concurrently, then all sent over a single email session.
     :param users: list of User instances to send reports to
     :param days_in_advance: how many days in advance the reports should be for
+    :param max_workers: maximum number of reports to generate concurrently
     """
     date_for_report = date.today() + timedelta(days=days_in_advance)
-    for user in users:
-        user.email_report(date_for_report)
+
+    def generate_report(user):
+        return _skip_if_unavailable(user.report_html, date_for_report)
+
+    pool = ThreadPool(max(1, max_workers))
+    try:
+        reports = pool.map(generate_report, users)
+    finally:
+        pool.close()
+        pool.join()
+    email_service.send_emails([(user, report) for user, report
+                               in zip(users, reports) if report is not None])
+
+
+def _skip_if_unavailable(function, *arguments):
+    """ Call `function`, giving up on the call (rather than the whole run) if
+    a service it needs is refusing requests, as it keeps failing.
+    :param function: function to call with `arguments`
+    :return: the result of `function`, or None if a service was unavailable
+    """
+    try:
+        return function(*arguments)
+    except ServiceUnavailableError:
+        instrumentation.increment('run.skipped_unavailable')
+        return None
 
 
 if __name__ == '__main__':
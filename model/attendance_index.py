@@ -0,0 +1,92 @@
+import re
+
+
+class AttendanceIndex:
+    """ An AttendanceIndex records who is attending each event on a single
+    date, indexed by name so that many people's friends can be looked up
+    without rescanning every attendee list.
+    """
+
+    def __init__(self, event_attendees, incomplete_event_codes=()):
+        """ Construct a new AttendanceIndex.
+        :param event_attendees: list of (event, attendee_names) tuples, where
+            `event` is an Event instance and `attendee_names` is the list of
+            Strings for the names of people attending it
+        :param incomplete_event_codes: codes of events whose attendee lists
+            don't show the names of every attendee
+        """
+        self._event_attendees = event_attendees
+        self._incomplete_event_codes = set(incomplete_event_codes)
+        # Maps each lowercased name to the (event_index, name_index) positions
+        # it appears at within `event_attendees`.
+        self._name_positions = {}
+        for event_index, (_, attendee_names) in enumerate(event_attendees):
+            for name_index, name in enumerate(attendee_names):
+                positions = self._name_positions.setdefault(name.lower(), [])
+                positions.append((event_index, name_index))
+
+    @property
+    def events(self):
+        """
+        :return: list of Event instances covered by this index
+        """
+        return [event for event, _ in self._event_attendees]
+
+    def is_attendee_list_complete(self, event):
+        """
+        :param event: Event instance covered by this index
+        :return: bool, True if every attendee of `event` is listed by name
+        """
+        return event.code not in self._incomplete_event_codes
+
+    def attendance_counts(self, name):
+        """ Count how many times `name` appears in each event's attendee list.
+        :param name: String for the name to look up (case-insensitive, and
+            matched exactly)
+        :return: dictionary mapping event codes to the number of times `name`
+            is listed, for events where it's listed at least once
+        """
+        attendance_counts = {}
+        for event_index, _ in self._name_positions.get(name.lower(), []):
+            event_code = self._event_attendees[event_index][0].code
+            attendance_counts[event_code] = (
+                attendance_counts.get(event_code, 0) + 1)
+        return attendance_counts
+
+    @staticmethod
+    def compile_friend_matcher(friends):
+        """ Compile a matcher for the names of `friends`, for use with
+        `friends_attending()`.
+        :param friends: list of Strings for the names of friends. An attendee
+            matches if any of these appear (case-insensitively) in their name
+        :return: compiled regular expression matching lowercased names, or
+            None if `friends` is empty
+        """
+        if len(friends) == 0:
+            return None
+        return re.compile('|'.join(re.escape(friend.lower())
+                                   for friend in friends))
+
+    def friends_attending(self, friend_matcher):
+        """ Find the events that friends are attending.
+        :param friend_matcher: matcher returned by `compile_friend_matcher()`
+        :return: list of (event, friend_names) tuples, in event order, for
+            each event that at least one friend is attending. `friend_names`
+            is the list of names of friends attending, in attendee list order
+        """
+        if friend_matcher is None:
+            return []
+        positions = []
+        for name, name_positions in self._name_positions.items():
+            if friend_matcher.search(name):
+                positions.extend(name_positions)
+        positions.sort()
+
+        friends_attending = []
+        for event_index, name_index in positions:
+            event, attendee_names = self._event_attendees[event_index]
+            if (len(friends_attending) == 0 or
+                    friends_attending[-1][0] is not event):
+                friends_attending.append((event, []))
+            friends_attending[-1][1].append(attendee_names[name_index])
+        return friends_attending
\ No newline at end of file
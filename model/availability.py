@@ -0,0 +1,77 @@
+import threading
+
+
+class Availability:
+    """ An Availability records which events can accept bookings on a single
+    date, and how many places each has left, as seen by the default browser.
+    Places are reserved as this run books users in, so later users aren't
+    sent to events the run has already filled.
+    """
+
+    def __init__(self):
+        """ Construct a new, empty Availability. Events are added with
+        `add_event()` as they're scraped.
+        """
+        # Maps each event to the number of places left in it, or None if it
+        # has no known limit. Events that can't accept bookings have none.
+        self._places_remaining = {}
+        self._lock = threading.Lock()
+
+    def has_event(self, event):
+        """
+        :param event: Event instance to check
+        :return: bool, True if `event` has been added to this availability
+        """
+        with self._lock:
+            return event in self._places_remaining
+
+    def add_event(self, event, is_bookable, places_remaining=None):
+        """ Record the availability of `event`, unless it's already recorded
+        (so places already reserved aren't lost).
+        :param event: Event instance to record
+        :param is_bookable: bool, True if `event` is occurring and open for
+            booking, or None if it isn't known
+        :param places_remaining: number of places left in `event`, or None if
+            it isn't known
+        """
+        with self._lock:
+            if event not in self._places_remaining:
+                if is_bookable is False:
+                    places_remaining = 0
+                self._places_remaining[event] = places_remaining
+
+    def reserve(self, events):
+        """ Reserve a place in the first of `events` that can accept a
+        booking.
+        :param events: sequence of Event instances, in order of preference,
+            each of which has been added to this availability
+        :return: Event instance a place was reserved in, or None if none of
+            `events` can accept a booking
+        """
+        with self._lock:
+            for event in events:
+                places_remaining = self._places_remaining.get(event, 0)
+                if places_remaining is None:
+                    return event
+                if places_remaining > 0:
+                    self._places_remaining[event] = places_remaining - 1
+                    return event
+        return None
+
+    def release(self, event):
+        """ Give back a place reserved by `reserve()` that wasn't taken up
+        (eg. as the user was already booked in).
+        :param event: Event instance the place was reserved in
+        """
+        with self._lock:
+            places_remaining = self._places_remaining.get(event)
+            if places_remaining is not None:
+                self._places_remaining[event] = places_remaining + 1
+
+    def mark_full(self, event):
+        """ Record that `event` can't accept any more bookings (eg. as it
+        turned a booking away), whatever its page said.
+        :param event: Event instance to mark as full
+        """
+        with self._lock:
+            self._places_remaining[event] = 0
\ No newline at end of file
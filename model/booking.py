@@ -1,8 +1,10 @@
-import re
+class Booking(object):
+    """ A Booking represents a booking for an event that has been made.
+    Bookings are immutable, and compare equal (and hash) by their event, user
+    and date.
+    """
 
-
-class Booking:
-    """ A Booking represents a booking for an event that has been made. """
+    __slots__ = ('_event', '_user', '_date')
 
     def __init__(self, event, user, date):
         """ Construct a new booking.
@@ -37,11 +39,24 @@ class Booking:
         if menu_text is None:
             report_html += r'(no menu found)'
         else:
-            menu_html = re.sub(r'\n', r'<br />', menu_text)
-            report_html += menu_html
+            report_html += menu_text.replace('\n', r'<br />')
         report_html += r'<br /><br />'
         return report_html
 
+    def __eq__(self, other):
+        return (isinstance(other, Booking) and
+                (self._event, self._user, self._date) ==
+                (other._event, other._user, other._date))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self._event, self._user, self._date))
+
+    def __reduce__(self):
+        return Booking, (self._event, self._user, self._date)
+
     def __str__(self):
         """
         :return: String representation of this booking, in the format
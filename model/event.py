@@ -1,8 +1,19 @@
-class Event:
+import threading
+
+# Maps each event code to the single Event instance for it.
+_REGISTRY = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+class Event(object):
     """ An Event represents a (possibly bookable) event that exists within the
-    booking system.
+    booking system. Events are immutable, and compare equal (and hash) by
+    their code, so they can be used directly as cache keys. Use `get_event()`
+    to share a single instance for each code.
     """
 
+    __slots__ = ('_code', '_name')
+
     def __init__(self, code, name):
         """ Construct a new Event instance.
         :param code: event code, used to identify this event within the
@@ -30,9 +41,39 @@ class Event:
         date_string = 'date=%s' % date.strftime('%Y-%m-%d')
         return booking_service_url + '?' + code_string + '&' + date_string
 
+    def __eq__(self, other):
+        return isinstance(other, Event) and self._code == other._code
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._code)
+
+    def __reduce__(self):
+        # Unpickled events are interned too.
+        return get_event, (self._code, self._name)
+
     def __str__(self):
         """
         :return: String representation of this event, in the format
             '<name> [<code>]'
         """
-        return '%s [%d]' % (self.name, self.code)
\ No newline at end of file
+        return '%s [%d]' % (self.name, self.code)
+
+
+def get_event(code, name):
+    """ Get the single Event instance for `code`, creating it if need be.
+    :param code: event code, used to identify the event within the booking
+        system
+    :param name: human-readable name for the event. If it differs from the
+        registered event's name (as the event has been renamed), a new Event
+        replaces the registered one
+    :return: Event instance for `code`
+    """
+    with _REGISTRY_LOCK:
+        event = _REGISTRY.get(code)
+        if event is None or event.name != name:
+            event = Event(code, name)
+            _REGISTRY[code] = event
+        return event
\ No newline at end of file
@@ -0,0 +1,185 @@
+import imp
+import re
+from bs4 import BeautifulSoup, SoupStrainer
+
+
+def _is_installed(module_name):
+    """
+    :return: bool, True if the module `module_name` can be imported
+    """
+    try:
+        imp.find_module(module_name)
+        return True
+    except ImportError:
+        return False
+
+
+# Use the parser Beautiful Soup picks by default (lxml, then html5lib, then
+# html.parser), so pages parse the same as they always have.
+if _is_installed('lxml'):
+    _PARSER = 'lxml'
+elif _is_installed('html5lib'):
+    _PARSER = 'html5lib'
+else:
+    _PARSER = 'html.parser'
+
+# Only the list tables, menu divs and forms of booking system pages are ever
+# read, so the rest of each page is skipped while parsing. html5lib always
+# builds the whole tree.
+_PAGE_STRAINER = None
+if _PARSER != 'html5lib':
+    _PAGE_STRAINER = SoupStrainer(['table', 'div', 'form'])
+_PLACES_REMAINING_PATTERN = re.compile(
+    r'(\d+)\s+(?:places?|spaces?)\s+(?:remaining|left|available)',
+    re.IGNORECASE)
+
+
+def parse_page(html):
+    """ Parse the parts of a booking system page that are used.
+    :param html: String containing the HTML for the page
+    :return: BeautifulSoup instance containing the page's tables, divs and
+        forms
+    """
+    return BeautifulSoup(html, _PARSER, parse_only=_PAGE_STRAINER)
+
+
+class EventPage:
+    """ An EventPage represents the booking system's page for a single event on
+    a single date, parsed once and shared between every lookup for that
+    (event, date) pair.
+    """
+
+    def __init__(self, html):
+        """ Construct a new EventPage from the raw HTML for the page.
+        :param html: String containing the HTML for the event page
+        """
+        self._html = html
+        self._soup = None
+        self._attendee_names = None
+        self._menu_text = None
+        self._menu_text_found = False
+
+    @property
+    def html(self):
+        return self._html
+
+    @property
+    def is_occurring(self):
+        """
+        :return: bool, True if the event described by this page is occurring
+        """
+        return 'not running on' not in self._html
+
+    @property
+    def is_booked(self):
+        """
+        :return: bool, True if the browser that fetched this page is booked in
+            to the event
+        """
+        return 'Other dietary or non-dietary requirements' in self._html
+
+    @property
+    def has_booking_form(self):
+        """
+        :return: bool, True if this page contains a booking form
+        """
+        return len(self._get_soup().find_all('form')) > 0
+
+    @property
+    def is_open(self):
+        """
+        :return: bool, True if the event described by this page is occurring
+            and open for booking (the page has a booking form), or None if it
+            can't be told as the browser that fetched this page is booked in
+            (so the page's only form updates that booking)
+        """
+        if self.is_booked:
+            return None
+        return self.is_occurring and self.has_booking_form
+
+    @property
+    def places_remaining(self):
+        """
+        :return: number of places left in the event described by this page,
+            or None if the page doesn't say
+        """
+        match = _PLACES_REMAINING_PATTERN.search(self._html)
+        if match is None:
+            return None
+        return int(match.group(1))
+
+    @property
+    def attendee_names(self):
+        """
+        :return: list of Strings (names of attendees)
+        """
+        def get_attendee_name(attendee_cell):
+            """
+            :return: the name encapsulated within `attendee_cell`, or None
+            """
+            attendee_text = attendee_cell.get_text()
+            if len(attendee_text) > 0 and attendee_text[0] != '(':
+                return attendee_text
+            return None
+
+        if self._attendee_names is not None:
+            return self._attendee_names
+        attendance_table = self._get_soup().find_all('table',
+                                                     {'class': 'list'})[0]
+        attendee_cells = attendance_table.find_all('td')
+        attendee_names = map(get_attendee_name, attendee_cells)
+        attendee_names = [name for name in attendee_names if name is not None]
+        self._attendee_names = attendee_names
+        return self._attendee_names
+
+    @property
+    def has_hidden_attendees(self):
+        """
+        :return: bool, True if the attendance table contains attendees whose
+            names aren't shown (eg. '(guest)')
+        """
+        attendance_table = self._get_soup().find_all('table',
+                                                     {'class': 'list'})[0]
+        for attendee_cell in attendance_table.find_all('td'):
+            if attendee_cell.get_text().startswith('('):
+                return True
+        return False
+
+    @property
+    def menu_text(self):
+        """
+        :return: String containing the menu (newlines separating items), or
+            None if no menu is found
+        """
+        if self._menu_text_found:
+            return self._menu_text
+        menu_divs = self._get_soup().find_all('div', {'class': 'menu'})
+        if len(menu_divs) == 0:
+            menu_text = None
+        else:
+            menu_text = self._clean_menu_text(menu_divs[0].get_text())
+        self._menu_text = menu_text
+        self._menu_text_found = True
+        return self._menu_text
+
+    def _clean_menu_text(self, menu_text):
+        """ Tidy the raw text of a menu div.
+        :param menu_text: String containing the raw text of the menu div
+        :return: String containing the menu (newlines separating items)
+        """
+        menu_text = menu_text.replace('\r', '\n')
+
+        # Menu text sometimes contains large spans of ' ', so remove them. Also
+        # remove stray spaces at the start/end of a line.
+        menu_text = re.sub(r'  +', '', menu_text)
+        menu_text = re.sub(r' ?\n ?', r'\n', menu_text)
+        menu_text = re.sub(r'(^\n)|(\n$)', r'', menu_text)
+        return menu_text
+
+    def _get_soup(self):
+        """ Parse the page HTML, at most once.
+        :return: BeautifulSoup instance for this page
+        """
+        if self._soup is None:
+            self._soup = parse_page(self._html)
+        return self._soup
\ No newline at end of file
@@ -1,27 +1,38 @@
 from error import BookingServiceError
-from service import booking_service, email_service
+from model.attendance_index import AttendanceIndex
+from service import booking_service, email_service, report_service
 
 
-class User:
+class User(object):
     """ Represents a single user of the system, with a Raven login, booking
-    preferences and friends.
+    preferences and friends. Users are immutable, and compare equal (and
+    hash) by their crsid.
     """
 
-    def __init__(self, crsid, password, friends, booking_preferences):
+    __slots__ = ('_crsid', '_password', '_friends', '_booking_preferences',
+                 '_name', '_friend_matcher')
+
+    def __init__(self, crsid, password, friends, booking_preferences,
+                 name=None):
         """ Construct a new User with the given members.
         :param crsid: crsid for this user, to be used for booking tasks
         :param password: password for this user, to be used for booking tasks
         :param friends: list of strings for the names of people who's
             attendance you wish to be notified of
         :param booking_preferences: list, indexed by day index (0 for Sunday,
-            1 for Monday, ...) where the elements are lists of Event instances
-            that the user wishes to book in to on that day
+            1 for Monday, ...) where the elements are sequences (eg. tuples) of
+            Event instances that the user wishes to book in to on that day
+        :param name: this user's name, as it appears in attendee lists, or None
+            if it isn't known
         :return:
         """
         self._crsid = crsid
         self._password = password
-        self._friends = friends
-        self._booking_preferences = booking_preferences
+        self._friends = tuple(friends)
+        self._booking_preferences = tuple(tuple(events) for events
+                                          in booking_preferences)
+        self._name = name
+        self._friend_matcher = AttendanceIndex.compile_friend_matcher(friends)
 
     @property
     def crsid(self):
@@ -35,16 +46,67 @@ class User:
     def friends(self):
         return self._friends
 
-    def create_booking(self, date):
+    @property
+    def name(self):
+        return self._name
+
+    def booking_preferences_for(self, date):
+        """
+        :param date: datetime.date instance for the day to check
+        :return: sequence of Event instances this user wishes to book in to
+            on `date`, in order of preference
+        """
+        day_index = int(date.strftime('%w'))
+        return self._booking_preferences[day_index]
+
+    def create_booking(self, date, skip_events=()):
         """ Make booking for this user, based on their booking_preferences.
+        Preferences are resolved against the availability snapshot for
+        `date`, so bookings are only attempted for events that can accept
+        them. If an event turns the booking away, the next preference is
+        tried, and the event is marked as full for every user if it has no
+        places left.
         :param date: datetime.date indicating the day the bookings should be
             made for
+        :param skip_events: Event instances not to try (eg. as booking them
+            has already failed)
         :return: Booking instance that was made, or None if no booking was made
         """
-        day_index = int(date.strftime('%w'))
-        for event in self._booking_preferences[day_index]:
+        events = [event for event in self.booking_preferences_for(date)
+                  if event not in skip_events]
+        availability = booking_service.get_availability(date, events)
+        while True:
+            event = availability.reserve(events)
+            if event is None:
+                return None
+            is_place_taken = False
             try:
-                return booking_service.create_booking(event, self, date)
+                browser = booking_service.prepare_booking(event, self, date)
+                booking = booking_service.submit_booking(event, self, date,
+                                                         browser)
+                # If already booked in, the place was already taken.
+                is_place_taken = browser is not None
+                return booking
+            except BookingServiceError:
+                events.remove(event)
+            finally:
+                if not is_place_taken:
+                    availability.release(event)
+            booking_service.recheck_availability(event, date)
+
+    def prepare_booking(self, date):
+        """ Prepare to book this user into the first event in their
+        booking_preferences that's occurring on `date`.
+        :param date: datetime.date indicating the day the booking will be made
+            for
+        :return: tuple of (event, browser) to pass to
+            `booking_service.submit_booking()`, or None if none of the events
+            are occurring
+        """
+        for event in self.booking_preferences_for(date):
+            try:
+                return event, booking_service.prepare_booking(event, self,
+                                                              date)
             except BookingServiceError:
                 # Try the next event
                 continue
@@ -54,70 +116,44 @@ class User:
         """ Email this user their report for `date`.
         :param date: datetime.date instance for the report to reflect
         """
-        date_string = date.strftime('Report for %A, %B %d')
-        email_html = '<h3><i>%s</i></h3>' % date_string
-        email_html += self._bookings_report(date)
-        email_html += self._friend_attendance_report(date)
-        email_html = r'<center>' + email_html + r'</center>'
-        email_service.send_email(self, email_html)
-
-    def _bookings_report(self, date):
-        """ Generate a HTML report containing booking information for `date`.
-        :param date: datetime.date instance for date to check
-        :return: String containing HTML report, describing which events this
-            user's booked in to on `date` (along with menus if they exist)
+        email_service.send_email(self, self.report_html(date))
+
+    def report_html(self, date):
+        """ Generate this user's HTML report for `date`.
+        :param date: datetime.date instance for the report to reflect
+        :return: String containing the HTML for the report
         """
-        report_html = ''
-        bookings = self.get_all_bookings(date)
-        if len(bookings) > 0:
-            for booking in bookings:
-                menu_text = booking_service.get_menu_text(booking.event, date)
-                report_html += booking.html_report(menu_text)
-        else:
-            report_html += r'<i>No bookings</i><br /><br />'
-        return '<h2>~ Bookings ~</h2>' + report_html
-
-    def _friend_attendance_report(self, date):
-        """ Generate a HTML report containing the event attendance for this
-        user's friends.
+        return report_service.render_report(self, date)
+
+    def friends_attending(self, date):
+        """ Find the events this user's friends are attending on `date`.
         :param date: datetime.date instance for date to check
-        :return: String containing HTML report, describing which events each
-            of this user's friends are attending on `date`
+        :return: list of (event, friend_names) tuples, in event order, for
+            each event that at least one friend is attending
         """
-        report_html = ''
-        for event in booking_service.get_available_events():
-            if not booking_service.is_event_occurring(event, date):
-                continue
-            attendees = booking_service.get_attendee_names(event, date)
-
-            def predicate(name):
-                name = name.lower()
-                for friend in self.friends:
-                    if friend.lower() in name:
-                        return True
-                return False
-            friends_attending = filter(predicate, attendees)
-            if len(friends_attending) > 0:
-                report_html += r'<u><b>%s:</u></b><br /><br />' % event.name
-                report_html += r'<br />'.join(friends_attending)
-                report_html += r'<br /><br />'
-        if len(report_html) == 0:
-            report_html += r'<i>No friends in any hall</i>'
-        return '<h2>~ Friends ~</h2>' + report_html
+        attendance_index = booking_service.get_attendance_index(date)
+        return attendance_index.friends_attending(self._friend_matcher)
 
     def get_all_bookings(self, date):
         """ Find all bookings for this user on `date`.
         :param date: datetime.date instance for date to check
         :return: list of Booking instances for all bookings on `date`
         """
-        all_events = booking_service.get_available_events()
-        bookings = []
-        for event in all_events:
-            if booking_service.is_event_occurring(event, date):
-                booking = booking_service.get_booking(event, self, date)
-                if booking is not None:
-                    bookings.append(booking)
-        return bookings
+        return booking_service.get_bookings(self, date)
+
+    def __eq__(self, other):
+        return isinstance(other, User) and self._crsid == other._crsid
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._crsid)
+
+    def __reduce__(self):
+        # The compiled friend matcher is rebuilt, rather than pickled.
+        return User, (self._crsid, self._password, self._friends,
+                      self._booking_preferences, self._name)
 
     def __str__(self):
         """
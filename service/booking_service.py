@@ -1,40 +1,83 @@
+import hashlib
 import re
-from bs4 import BeautifulSoup
+import threading
+from datetime import datetime
 from error import BookingServiceError
+from model.attendance_index import AttendanceIndex
+from model.availability import Availability
 from model.booking import Booking
-from model.event import Event
-from service import raven_service
+from model.event import get_event
+from model.event_page import EventPage, parse_page
+from service import cache_service, instrumentation, raven_service, transport
 
 BOOKING_SERVICE_URL = 'https://www.mealbookings.cai.cam.ac.uk/index.php'
 
 _AVAILABLE_EVENTS_CACHE = None
-_ATTENDEE_NAME_CACHE = {}
-_MENU_TEXT_CACHE = {}
-_EVENT_OCCURRING_CACHE = {}
+_EVENT_PAGE_CACHE = {}
+_ATTENDANCE_INDEX_CACHE = {}
+_AVAILABILITY_CACHE = {}
+_IS_BOOKED_CACHE = {}
+# Keys of event pages found to be unchanged since the values cached from them
+# were read.
+_UNCHANGED_EVENT_PAGES = set()
+_ATTENDANCE_INDEX_LOCK = threading.Lock()
+_AVAILABILITY_LOCK = threading.Lock()
+_AVAILABLE_EVENTS_LOCK = threading.Lock()
+_EVENT_PAGE_LOCKS = {}
+_EVENT_PAGE_LOCKS_LOCK = threading.Lock()
+
+# The default browser is shared by every thread, so guard its use unless the
+# transport is thread-safe.
+_DEFAULT_BROWSER_LOCK = threading.Lock()
+# Similarly, each user's browser may be used by several threads at once (eg.
+# prefetching their bookings), so guard it with a lock for their crsid.
+_USER_BROWSER_LOCKS = {}
+_USER_BROWSER_LOCKS_LOCK = threading.Lock()
 
 
 def get_available_events():
     """ Find all available events.
-    :return: list of Event instances, representing events that exist in the
-        booking system
+    :return: tuple of Event instances, representing events that exist in the
+        booking system. The same tuple is shared by every caller
     """
     global _AVAILABLE_EVENTS_CACHE
-    if _AVAILABLE_EVENTS_CACHE is None:
-        _AVAILABLE_EVENTS_CACHE = []
-        browser = raven_service.get_default_authenticated_browser()
-        hall_html = browser.open(BOOKING_SERVICE_URL).read()
-        hall_soup = BeautifulSoup(hall_html)
-
-        events_table = hall_soup.find_all('table', {"class": "list"})[1]
-        for event_row in events_table.find_all('td'):
-            event_name = event_row.get_text()
-            event_links = event_row.find_all('a')
-            if len(event_links) > 0:
-                event_link = event_links[0].get('href')
-                event_code = int(re.search('\d+', event_link).group(0))
-                event = Event(code=event_code, name=event_name)
-                _AVAILABLE_EVENTS_CACHE.append(event)
-    return _AVAILABLE_EVENTS_CACHE[:]
+    with _AVAILABLE_EVENTS_LOCK:
+        _record_cache_lookup('events', _AVAILABLE_EVENTS_CACHE is not None)
+        if _AVAILABLE_EVENTS_CACHE is None:
+            event_list = cache_service.get('events')
+            if event_list is cache_service.MISSING:
+                # Revalidate any expired list, only parsing the page again if
+                # it has changed.
+                event_list = cache_service.get('events', allow_expired=True)
+                is_expired = event_list is not cache_service.MISSING
+                hall_html = _fetch_page(BOOKING_SERVICE_URL,
+                                        conditional=is_expired)
+                if hall_html is not None:
+                    event_list = _parse_event_list(hall_html)
+                cache_service.put('events', event_list)
+            _AVAILABLE_EVENTS_CACHE = tuple(get_event(code, name)
+                                            for code, name in event_list)
+    return _AVAILABLE_EVENTS_CACHE
+
+
+def _parse_event_list(hall_html):
+    """ Parse the list of events from the booking system's main page.
+    :param hall_html: String containing the HTML for the main page
+    :return: list of (code, name) pairs for each event that exists in the
+        booking system
+    """
+    hall_soup = parse_page(hall_html)
+
+    event_list = []
+    events_table = hall_soup.find_all('table', {"class": "list"})[1]
+    for event_row in events_table.find_all('td'):
+        event_name = event_row.get_text()
+        event_links = event_row.find_all('a')
+        if len(event_links) > 0:
+            event_link = event_links[0].get('href')
+            event_code = int(re.search('\d+', event_link).group(0))
+            event_list.append((event_code, event_name))
+    return event_list
 
 
 def get_attendee_names(event, date):
@@ -44,32 +87,92 @@ def get_attendee_names(event, date):
     :return: list of Strings (names of attendees)
     :raises: BookingServiceError if `event` isn't occurring on `date`
     """
-    def get_attendee_name(attendee_cell):
-        """
-        :return: the name encapsulated within `attendee_cell`, or None
-        """
-        attendee_text = attendee_cell.get_text()
-        if len(attendee_text) > 0 and attendee_text[0] != '(':
-            return attendee_text
-        return None
+    def get_attendee_names_from_page():
+        return _get_occurring_event_page(event, date).attendee_names
 
-    cache_key = (event.code, date)
-    if cache_key not in _ATTENDEE_NAME_CACHE:
-        if not is_event_occurring(event, date):
-            error_string = '%s not occurring on %s' % (str(event), str(date))
-            raise BookingServiceError(error_string)
+    _ensure_event_occurring(event, date)
+    attendee_names = _get_persisted('attendees', event, date,
+                                    get_attendee_names_from_page)
+    return attendee_names[:]
 
-        browser = raven_service.get_default_authenticated_browser()
-        event_url = event.url_for_date(date, BOOKING_SERVICE_URL)
-        event_html = browser.open(event_url).read()
-        event_soup = BeautifulSoup(event_html)
 
-        attendance_table = event_soup.find_all('table', {'class': 'list'})[0]
-        attendee_cells = attendance_table.find_all('td')
-        attendee_names = map(get_attendee_name, attendee_cells)
-        attendee_names = [name for name in attendee_names if name is not None]
-        _ATTENDEE_NAME_CACHE[cache_key] = attendee_names
-    return _ATTENDEE_NAME_CACHE[cache_key][:]
+def has_hidden_attendees(event, date):
+    """ Determine whether any attendees of `event` on `date` aren't listed by
+    name.
+    :param event: Event instance specifying event to check
+    :param date: datetime.date instance specifying the date to check
+    :return: bool, True if some attendees' names are hidden
+    :raises: BookingServiceError if `event` isn't occurring on `date`
+    """
+    def has_hidden_attendees_from_page():
+        return _get_occurring_event_page(event, date).has_hidden_attendees
+
+    _ensure_event_occurring(event, date)
+    return _get_persisted('hidden_attendees', event, date,
+                          has_hidden_attendees_from_page)
+
+
+def get_attendance_index(date):
+    """ Get an index of who is attending each event on `date`. The index is
+    built at most once per date.
+    :param date: datetime.date instance specifying the date to check
+    :return: AttendanceIndex instance covering every event occurring on `date`
+    """
+    with _ATTENDANCE_INDEX_LOCK:
+        _record_cache_lookup('attendance_index',
+                             date in _ATTENDANCE_INDEX_CACHE)
+        if date not in _ATTENDANCE_INDEX_CACHE:
+            event_attendees = []
+            incomplete_event_codes = []
+            for event in get_available_events():
+                if is_event_occurring(event, date):
+                    attendee_names = get_attendee_names(event, date)
+                    event_attendees.append((event, attendee_names))
+                    if has_hidden_attendees(event, date):
+                        incomplete_event_codes.append(event.code)
+            attendance_index = AttendanceIndex(event_attendees,
+                                               incomplete_event_codes)
+            _ATTENDANCE_INDEX_CACHE[date] = attendance_index
+    return _ATTENDANCE_INDEX_CACHE[date]
+
+
+def get_availability(date, events=()):
+    """ Get the snapshot of which events can accept bookings on `date`, and
+    how many places each has left. Each event is scraped from its page (as
+    seen by the default browser) the first time it's needed, and there's a
+    single snapshot per date, so places reserved in it are seen by every
+    user.
+    :param date: datetime.date instance specifying the date to check
+    :param events: Event instances that must be covered by the snapshot
+    :return: Availability instance for `date`
+    """
+    with _AVAILABILITY_LOCK:
+        availability = _AVAILABILITY_CACHE.get(date)
+        if availability is None:
+            availability = Availability()
+            _AVAILABILITY_CACHE[date] = availability
+    for event in events:
+        if not availability.has_event(event):
+            event_page = get_event_page(event, date)
+            availability.add_event(event, event_page.is_open,
+                                   event_page.places_remaining)
+    return availability
+
+
+def recheck_availability(event, date):
+    """ Fetch the page for `event` on `date` again (as seen by the default
+    browser), and mark `event` as full in the availability snapshot for
+    `date` if it can no longer accept bookings. Eg. once a booking has been
+    turned away, as only some users may have been refused.
+    :param event: Event instance for the event to check
+    :param date: datetime.date instance for the date to check
+    """
+    event_url = event.url_for_date(date, BOOKING_SERVICE_URL)
+    event_page = EventPage(_fetch_page(event_url, event.code, date))
+    with _get_event_page_lock((event, date)):
+        _EVENT_PAGE_CACHE[(event, date)] = event_page
+    if event_page.is_open is False or event_page.places_remaining == 0:
+        get_availability(date).mark_full(event)
 
 
 def get_menu_text(event, date):
@@ -80,28 +183,11 @@ def get_menu_text(event, date):
         no menu is found
     :raises: BookingServiceError is `event` isn't occurring on `date`
     """
-    cache_key = (event.code, date)
-    if cache_key not in _MENU_TEXT_CACHE:
-        if not is_event_occurring(event, date):
-            error_string = '%s not occurring on %s' % (str(event), str(date))
-            raise BookingServiceError(error_string)
-        browser = raven_service.get_default_authenticated_browser()
-        event_url = event.url_for_date(date, BOOKING_SERVICE_URL)
-        event_html = browser.open(event_url).read()
-        event_soup = BeautifulSoup(event_html)
+    def get_menu_text_from_page():
+        return _get_occurring_event_page(event, date).menu_text
 
-        menu_divs = event_soup.find_all('div', {'class': 'menu'})
-        if len(menu_divs) == 0:
-            return None
-        menu_text = menu_divs[0].get_text().replace('\r', '\n')
-
-        # Menu text sometimes contains large spans of ' ', so remove them. Also
-        # remove stray spaces at the start/end of a line.
-        menu_text = re.sub(r'  +', '', menu_text)
-        menu_text = re.sub(r' ?\n ?', r'\n', menu_text)
-        menu_text = re.sub(r'(^\n)|(\n$)', r'', menu_text)
-        _MENU_TEXT_CACHE[cache_key] = menu_text
-    return _MENU_TEXT_CACHE[cache_key]
+    _ensure_event_occurring(event, date)
+    return _get_persisted('menu', event, date, get_menu_text_from_page)
 
 
 def is_event_occurring(event, date):
@@ -110,14 +196,195 @@ def is_event_occurring(event, date):
     :param date: datetime.date for the date to check
     :return: bool, True if `event` is occurring on `date`
     """
-    cache_key = (event.code, date)
-    if cache_key not in _EVENT_OCCURRING_CACHE:
-        browser = raven_service.get_default_authenticated_browser()
-        event_url = event.url_for_date(date, BOOKING_SERVICE_URL)
-        event_html = browser.open(event_url).read()
-        event_occurring = 'not running on' not in event_html
-        _EVENT_OCCURRING_CACHE[cache_key] = event_occurring
-    return _EVENT_OCCURRING_CACHE[cache_key]
+    def is_event_occurring_from_page():
+        return get_event_page(event, date).is_occurring
+
+    return _get_persisted('occurring', event, date,
+                          is_event_occurring_from_page)
+
+
+def _get_persisted(kind, event, date, get_value):
+    """ Look up a value in the persistent cache, falling back to `get_value`
+    (and caching its result) if there's no valid cached value.
+    :param kind: String for the kind of value, as used by cache_service
+    :param event: Event instance the value relates to
+    :param date: datetime.date instance the value relates to
+    :param get_value: function taking no arguments, returning the value
+    :return: the cached value, or the result of `get_value()`
+    """
+    value = cache_service.get(kind, event.code, date)
+    if value is cache_service.MISSING:
+        # An expired value can be reused if the page it was read from hasn't
+        # changed since.
+        value = cache_service.get(kind, event.code, date, allow_expired=True)
+        if (value is cache_service.MISSING or
+                _has_event_page_changed(event, date)):
+            value = get_value()
+        cache_service.put(kind, value, event.code, date)
+    return value
+
+
+def _has_event_page_changed(event, date):
+    """ Determine whether the page for `event` on `date` has changed since
+    the values cached from it were read, with a conditional request. A
+    changed page is kept, for the values to be read from.
+    :param event: Event instance for the page to check
+    :param date: datetime.date instance for the page to check
+    :return: bool, True if the page has changed (or has already been fetched
+        during this run)
+    """
+    cache_key = (event, date)
+    with _get_event_page_lock(cache_key):
+        if cache_key in _EVENT_PAGE_CACHE:
+            return True
+        if cache_key not in _UNCHANGED_EVENT_PAGES:
+            event_url = event.url_for_date(date, BOOKING_SERVICE_URL)
+            event_html = _fetch_page(event_url, event.code, date,
+                                     conditional=True)
+            if event_html is not None:
+                _EVENT_PAGE_CACHE[cache_key] = EventPage(event_html)
+                return True
+            _UNCHANGED_EVENT_PAGES.add(cache_key)
+    return False
+
+
+def get_event_page(event, date):
+    """ Get the page for `event` on `date`, as seen by the default browser.
+    Each (event, date) page is fetched at most once.
+    :param event: Event instance for the page to fetch
+    :param date: datetime.date instance for the page to fetch
+    :return: EventPage instance for `event` on `date`
+    """
+    cache_key = (event, date)
+    with _get_event_page_lock(cache_key):
+        _record_cache_lookup('event_page', cache_key in _EVENT_PAGE_CACHE)
+        if cache_key not in _EVENT_PAGE_CACHE:
+            event_url = event.url_for_date(date, BOOKING_SERVICE_URL)
+            event_html = _fetch_page(event_url, event.code, date)
+            _EVENT_PAGE_CACHE[cache_key] = EventPage(event_html)
+    return _EVENT_PAGE_CACHE[cache_key]
+
+
+def _record_cache_lookup(cache_name, is_hit):
+    """ Count a lookup in one of booking_service's in-process caches.
+    :param cache_name: String naming the cache
+    :param is_hit: bool, True if the lookup was a hit
+    """
+    if is_hit:
+        instrumentation.increment('booking_service.%s.hit' % cache_name)
+    else:
+        instrumentation.increment('booking_service.%s.miss' % cache_name)
+
+
+def _get_event_page_lock(cache_key):
+    """
+    :return: threading.Lock instance guarding the fetch of the event page for
+        `cache_key`, so that concurrent lookups share a single fetch
+    """
+    with _EVENT_PAGE_LOCKS_LOCK:
+        if cache_key not in _EVENT_PAGE_LOCKS:
+            _EVENT_PAGE_LOCKS[cache_key] = threading.Lock()
+        return _EVENT_PAGE_LOCKS[cache_key]
+
+
+def _fetch_page(url, event_code=0, date=None, conditional=False):
+    """ Fetch a page using the default browser's session, storing its
+    validators. If the page has changed, the values cached from it are
+    evicted.
+    :param url: URL of the page to fetch
+    :param event_code: code for the event the page is for
+    :param date: datetime.date instance the page is for, or None
+    :param conditional: if True, only return the page if it has changed
+        since it was last fetched
+    :return: String containing the HTML for the page, or None if
+        `conditional` and the page hasn't changed
+    """
+    validators = cache_service.get_page_validators(url)
+    headers = {}
+    if conditional and validators is not None:
+        etag, last_modified, _ = validators
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+
+    response, html = _read_with_default_browser(url, headers)
+    if response.code == 304:
+        instrumentation.increment('booking_service.pages.not_modified')
+        return None
+    content_hash = hashlib.sha1(html).hexdigest()
+    is_changed = validators is None or validators[2] != content_hash
+    if is_changed:
+        cache_service.evict(event_code, date)
+    cache_service.put_page_validators(url, transport.get_header(response,
+                                                                'ETag'),
+                                      transport.get_header(response,
+                                                           'Last-Modified'),
+                                      content_hash, date)
+    if conditional and not is_changed:
+        instrumentation.increment('booking_service.pages.unchanged')
+        return None
+    return html
+
+
+def _read_with_default_browser(url, headers=None):
+    """ Fetch `url` using the default browser's session.
+    :param url: URL to fetch
+    :param headers: dictionary of extra request headers, or None
+    :return: tuple of (response, html), where `response` is the response
+        returned by `raven_service.read_url()`, and `html` is its contents
+    """
+    browser = raven_service.get_default_authenticated_browser()
+    if transport.get_transport().is_thread_safe:
+        response = raven_service.read_url(browser, url, headers)
+        return response, response.read()
+    with _DEFAULT_BROWSER_LOCK:
+        response = raven_service.read_url(browser, url, headers)
+        return response, response.read()
+
+
+def _read_with_user_browser(user, url):
+    """ Fetch `url` using `user`'s session.
+    :param user: User instance whose session to use
+    :param url: URL to fetch
+    :return: String containing the contents of `url`
+    """
+    browser = raven_service.get_authenticated_browser(user.crsid,
+                                                      user.password)
+    if transport.get_transport().is_thread_safe:
+        return raven_service.read_url(browser, url).read()
+    with _USER_BROWSER_LOCKS_LOCK:
+        lock = _USER_BROWSER_LOCKS.setdefault(user.crsid, threading.Lock())
+    with lock:
+        return raven_service.read_url(browser, url).read()
+
+
+def _get_occurring_event_page(event, date):
+    """ Get the page for `event` on `date`, ensuring the event is occurring.
+    :return: EventPage instance for `event` on `date`
+    :raises: BookingServiceError if `event` isn't occurring on `date`
+    """
+    event_page = get_event_page(event, date)
+    if not event_page.is_occurring:
+        _raise_not_occurring(event, date)
+    return event_page
+
+
+def _ensure_event_occurring(event, date):
+    """
+    :raises: BookingServiceError if `event` isn't occurring on `date`
+    """
+    if not is_event_occurring(event, date):
+        _raise_not_occurring(event, date)
+
+
+def _raise_not_occurring(event, date):
+    """
+    :raises: BookingServiceError describing that `event` isn't occurring on
+        `date`
+    """
+    error_string = '%s not occurring on %s' % (str(event), str(date))
+    raise BookingServiceError(error_string)
 
 
 def create_booking(event, user, date):
@@ -128,20 +395,58 @@ def create_booking(event, user, date):
     :return: Booking instance representing the successful booking
     :raises: BookingServiceError if the booking could not be made
     """
-    if not is_event_occurring(event, date):
-        error_string = '%s not occurring on %s' % (str(event), str(date))
-        raise BookingServiceError(error_string)
+    browser = prepare_booking(event, user, date)
+    return submit_booking(event, user, date, browser)
+
+
+def prepare_booking(event, user, date):
+    """ Log `user` in and open the booking form for `event` on `date`, so
+    that the booking can be made with a single call to `submit_booking()`.
+    The browser returned must not be used for anything else until then.
+    :param event: Event instance for event to book in to
+    :param user: User instance for person to book in
+    :param date: datetime.date instance for date to book
+    :return: mechanize.Browser() instance with the booking form selected, or
+        None if `user` is already booked in
+    :raises: BookingServiceError if `event` isn't occurring on `date`, or
+        `user` can't book in to it (eg. as it's full)
+    """
+    _ensure_event_occurring(event, date)
 
     crsid, password = user.crsid, user.password
     browser = raven_service.get_authenticated_browser(crsid, password)
     event_url = event.url_for_date(date, BOOKING_SERVICE_URL)
-    event_html = browser.open(event_url).read()
-    if 'Other dietary or non-dietary requirements' not in event_html:
+    event_html = raven_service.open_url(browser, event_url).read()
+    event_page = EventPage(event_html)
+    if event_page.is_booked:
+        _IS_BOOKED_CACHE.setdefault(user.crsid, {})[(event, date)] = True
+        return None
+    if not event_page.has_booking_form:
+        error_string = 'Cannot book %s on %s' % (str(event), str(date))
+        raise BookingServiceError(error_string)
+    browser.select_form(nr=0)
+    return browser
+
+
+def submit_booking(event, user, date, browser):
+    """ Make a booking prepared by `prepare_booking()`.
+    :param event: Event instance for event to book in to
+    :param user: User instance for person to book in
+    :param date: datetime.date instance for date to book
+    :param browser: browser returned by `prepare_booking()` for the booking
+    :return: Booking instance representing the successful booking
+    :raises: BookingServiceError if the booking could not be made (eg. as
+        booking hasn't opened yet)
+    """
+    if browser is not None:
         # Not currently booked in, so make booking.
+        response = transport.get_transport().submit(browser)
+        if not EventPage(response.read()).has_booking_form:
+            error_string = 'Could not book %s on %s' % (str(event), str(date))
+            raise BookingServiceError(error_string)
         browser.select_form(nr=0)
-        browser.submit()
-        browser.select_form(nr=0)
-        browser.submit()
+        transport.get_transport().submit(browser)
+    _IS_BOOKED_CACHE.setdefault(user.crsid, {})[(event, date)] = True
     return Booking(event, user, date)
 
 
@@ -154,14 +459,217 @@ def get_booking(event, user, date):
         or None if not
     :raises: BookingServiceError if `event` doesn't take place on `date`.
     """
-    if not is_event_occurring(event, date):
-        error_string = '%s not occurring on %s' % (str(event), str(date))
-        raise BookingServiceError(error_string)
+    _ensure_event_occurring(event, date)
 
-    crsid, password = user.crsid, user.password
-    browser = raven_service.get_authenticated_browser(crsid, password)
-    event_url = event.url_for_date(date, BOOKING_SERVICE_URL)
-    event_html = browser.open(event_url).read()
-    if 'Other dietary or non-dietary requirements' in event_html:
+    user_is_booked_cache = _IS_BOOKED_CACHE.setdefault(user.crsid, {})
+    cache_key = (event, date)
+    _record_cache_lookup('is_booked', cache_key in user_is_booked_cache)
+    if cache_key not in user_is_booked_cache:
+        event_url = event.url_for_date(date, BOOKING_SERVICE_URL)
+        event_html = _read_with_user_browser(user, event_url)
+        user_is_booked_cache[cache_key] = EventPage(event_html).is_booked
+    if user_is_booked_cache[cache_key]:
         return Booking(event, user, date)
-    return None
\ No newline at end of file
+    return None
+
+
+def export_snapshot():
+    """ Export the event list and every event page fetched so far, so that
+    they can be shared with other processes instead of being fetched again.
+    :return: JSON-serialisable snapshot, to be passed to `load_snapshot()`
+    """
+    events = [(event.code, event.name) for event in get_available_events()]
+    event_pages = [(event.code, date.isoformat(), event_page.html)
+                   for (event, date), event_page
+                   in _EVENT_PAGE_CACHE.items()]
+    return {'events': events, 'event_pages': event_pages}
+
+
+def load_snapshot(snapshot):
+    """ Load the event list and event pages exported by `export_snapshot()`
+    into this process's caches.
+    :param snapshot: snapshot returned by `export_snapshot()`
+    """
+    global _AVAILABLE_EVENTS_CACHE
+    with _AVAILABLE_EVENTS_LOCK:
+        _AVAILABLE_EVENTS_CACHE = tuple(get_event(code, name)
+                                        for code, name in snapshot['events'])
+    events = dict((event.code, event) for event in _AVAILABLE_EVENTS_CACHE)
+    for event_code, date_string, event_html in snapshot['event_pages']:
+        date = datetime.strptime(date_string, '%Y-%m-%d').date()
+        _EVENT_PAGE_CACHE[(events[event_code], date)] = EventPage(event_html)
+
+
+def clear_page_caches():
+    """ Forget every page fetched in this process, and everything read from
+    them, so that later lookups see any changes. Persistently cached values
+    (which are revalidated once they expire) and Raven sessions are kept.
+    """
+    global _AVAILABLE_EVENTS_CACHE
+    with _AVAILABLE_EVENTS_LOCK:
+        _AVAILABLE_EVENTS_CACHE = None
+    with _ATTENDANCE_INDEX_LOCK:
+        _ATTENDANCE_INDEX_CACHE.clear()
+    with _AVAILABILITY_LOCK:
+        _AVAILABILITY_CACHE.clear()
+    with _EVENT_PAGE_LOCKS_LOCK:
+        _EVENT_PAGE_CACHE.clear()
+        _UNCHANGED_EVENT_PAGES.clear()
+        _EVENT_PAGE_LOCKS.clear()
+    _IS_BOOKED_CACHE.clear()
+
+
+def discard_date_pages(date):
+    """ Forget the event pages fetched for `date`, and everything read from
+    them (including persistently cached values), so that later lookups fetch
+    them again. Eg. bookings made for `date` since change its attendee lists.
+    :param date: datetime.date instance for the date to forget
+    """
+    with _ATTENDANCE_INDEX_LOCK:
+        _ATTENDANCE_INDEX_CACHE.pop(date, None)
+    with _EVENT_PAGE_LOCKS_LOCK:
+        for cache_key in list(_EVENT_PAGE_CACHE):
+            if cache_key[1] == date:
+                del _EVENT_PAGE_CACHE[cache_key]
+        for cache_key in list(_UNCHANGED_EVENT_PAGES):
+            if cache_key[1] == date:
+                _UNCHANGED_EVENT_PAGES.discard(cache_key)
+    for event in get_available_events():
+        cache_service.evict(event.code, date)
+
+
+def discard_user(crsid):
+    """ Forget everything cached for the user with `crsid`, freeing its
+    memory. Shared (non user-specific) caches are kept.
+    :param crsid: crsid of the user to discard
+    """
+    _IS_BOOKED_CACHE.pop(crsid, None)
+    with _USER_BROWSER_LOCKS_LOCK:
+        _USER_BROWSER_LOCKS.pop(crsid, None)
+    raven_service.discard_browser(crsid)
+
+
+def get_bookings(user, date):
+    """ Find all of `user`'s bookings on `date`.
+    :param user: User instance for user to check
+    :param date: datetime.date instance for date to check
+    :return: list of Booking instances for all bookings on `date`
+    """
+    return get_bookings_for_users([user], date)[0]
+
+
+def get_bookings_for_users(users, date):
+    """ Find all bookings on `date` for each user in `users`. Where a user's
+    name is known, their bookings are read from the shared attendee lists, so
+    each event only needs to be checked as that user if it's ambiguous.
+    :param users: list of User instances for users to check
+    :param date: datetime.date instance for date to check
+    :return: list containing a list of Booking instances for each user, in
+        the order of `users`
+    """
+    attendance_index = get_attendance_index(date)
+    all_bookings = []
+    for user in users:
+        bookings = []
+        for event, is_booked in _resolve_bookings(attendance_index, user):
+            if is_booked is None:
+                booking = get_booking(event, user, date)
+            elif is_booked:
+                booking = Booking(event, user, date)
+            else:
+                booking = None
+            if booking is not None:
+                bookings.append(booking)
+        all_bookings.append(bookings)
+    return all_bookings
+
+
+def get_unresolved_bookings(users, date):
+    """ Find the (event, user) pairs on `date` that can't be resolved from the
+    shared attendee lists, and so must be checked as that user.
+    :param users: list of User instances for users to check
+    :param date: datetime.date instance for date to check
+    :return: list of (event, user) tuples
+    """
+    attendance_index = get_attendance_index(date)
+    unresolved_bookings = []
+    for user in users:
+        for event, is_booked in _resolve_bookings(attendance_index, user):
+            if is_booked is None:
+                unresolved_bookings.append((event, user))
+    return unresolved_bookings
+
+
+def _resolve_bookings(attendance_index, user):
+    """ Determine which events `user` is booked in to from the attendee lists
+    within `attendance_index`.
+    :param attendance_index: AttendanceIndex instance for the date to check
+    :param user: User instance for user to check
+    :return: list of (event, is_booked) tuples for each event in
+        `attendance_index`, where `is_booked` is True or False if the
+        attendee lists determine whether `user` is booked in, or None if not
+    """
+    attendance_counts = {}
+    if user.name is not None:
+        attendance_counts = attendance_index.attendance_counts(user.name)
+
+    resolved_bookings = []
+    for event in attendance_index.events:
+        attendance_count = attendance_counts.get(event.code, 0)
+        if user.name is not None and attendance_count == 1:
+            is_booked = True
+        elif (user.name is not None and attendance_count == 0 and
+                attendance_index.is_attendee_list_complete(event)):
+            is_booked = False
+        else:
+            is_booked = None
+        resolved_bookings.append((event, is_booked))
+    return resolved_bookings
+
+
+def prefetch_event(event, date):
+    """ Warm the caches for `event` on `date`, so that later lookups for it
+    don't need to fetch anything.
+    :param event: Event instance for event to fetch
+    :param date: datetime.date instance for date to fetch
+    """
+    if is_event_occurring(event, date):
+        get_attendee_names(event, date)
+        has_hidden_attendees(event, date)
+        get_menu_text(event, date)
+
+
+def get_attendee_names_async(event, date):
+    """ Asynchronous counterpart to `get_attendee_names()`.
+    :return: multiprocessing.pool.AsyncResult instance for the call
+    """
+    return transport.run_async(get_attendee_names, event, date)
+
+
+def get_menu_text_async(event, date):
+    """ Asynchronous counterpart to `get_menu_text()`.
+    :return: multiprocessing.pool.AsyncResult instance for the call
+    """
+    return transport.run_async(get_menu_text, event, date)
+
+
+def is_event_occurring_async(event, date):
+    """ Asynchronous counterpart to `is_event_occurring()`.
+    :return: multiprocessing.pool.AsyncResult instance for the call
+    """
+    return transport.run_async(is_event_occurring, event, date)
+
+
+def create_booking_async(event, user, date):
+    """ Asynchronous counterpart to `create_booking()`. Only one booking
+    should be in progress for each user at once.
+    :return: multiprocessing.pool.AsyncResult instance for the call
+    """
+    return transport.run_async(create_booking, event, user, date)
+
+
+def get_booking_async(event, user, date):
+    """ Asynchronous counterpart to `get_booking()`.
+    :return: multiprocessing.pool.AsyncResult instance for the call
+    """
+    return transport.run_async(get_booking, event, user, date)
\ No newline at end of file
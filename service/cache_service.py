@@ -0,0 +1,171 @@
+""" Responsible for persisting booking service lookups, and the validators of
+the pages they were read from, between runs.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from service import instrumentation
+
+# How long (in seconds) each kind of cached value remains valid for.
+EVENTS_TTL = 7 * 24 * 60 * 60
+OCCURRING_TTL = 24 * 60 * 60
+MENU_TTL = 24 * 60 * 60
+ATTENDEES_TTL = 15 * 60
+_TTLS = {
+    'events': EVENTS_TTL,
+    'occurring': OCCURRING_TTL,
+    'menu': MENU_TTL,
+    'attendees': ATTENDEES_TTL,
+    'hidden_attendees': ATTENDEES_TTL
+}
+
+# Returned by `get()` when there's no valid cached value, since None is a
+# valid value to cache.
+MISSING = object()
+
+_CONNECTION = None
+_REFRESH = False
+_LOCK = threading.Lock()
+
+
+def open_cache(cache_file_path, today, refresh=False):
+    """ Start persisting lookups to `cache_file_path`, evicting any values for
+    dates before `today`. Any previously opened cache is closed.
+    :param cache_file_path: path to the SQLite database to use as the cache
+    :param today: datetime.date instance for the current day
+    :param refresh: if True, ignore existing cached values (but still store
+        new ones), forcing every lookup to be refreshed
+    """
+    global _CONNECTION, _REFRESH
+    connection = sqlite3.connect(cache_file_path, check_same_thread=False)
+    connection.execute('CREATE TABLE IF NOT EXISTS cache ('
+                       'kind TEXT NOT NULL, '
+                       'event_code INTEGER NOT NULL, '
+                       'date TEXT NOT NULL, '
+                       'value TEXT NOT NULL, '
+                       'stored_at REAL NOT NULL, '
+                       'PRIMARY KEY (kind, event_code, date))')
+    connection.execute('CREATE TABLE IF NOT EXISTS page_validators ('
+                       'url TEXT PRIMARY KEY, '
+                       'date TEXT NOT NULL, '
+                       'etag TEXT, '
+                       'last_modified TEXT, '
+                       'content_hash TEXT NOT NULL)')
+    for table in ('cache', 'page_validators'):
+        connection.execute("DELETE FROM %s WHERE date != '' AND date < ?"
+                           % table, (today.isoformat(),))
+    connection.commit()
+    with _LOCK:
+        previous_connection = _CONNECTION
+        _CONNECTION = connection
+        _REFRESH = refresh
+        if previous_connection is not None:
+            previous_connection.close()
+
+
+def get(kind, event_code=0, date=None, allow_expired=False):
+    """ Get a cached value, if there's one that hasn't expired.
+    :param kind: String for the kind of value (eg. 'menu', 'attendees')
+    :param event_code: code for the event the value relates to
+    :param date: datetime.date instance the value relates to, or None
+    :param allow_expired: if True, return the cached value even if it has
+        expired (eg. so it can be revalidated)
+    :return: the cached value, or MISSING if there is no valid cached value
+    """
+    with _LOCK:
+        if _CONNECTION is None or _REFRESH:
+            return MISSING
+        row = _CONNECTION.execute('SELECT value, stored_at FROM cache '
+                                  'WHERE kind = ? AND event_code = ? '
+                                  'AND date = ?',
+                                  (kind, event_code,
+                                   _date_key(date))).fetchone()
+    if row is None:
+        return MISSING
+    if allow_expired:
+        return json.loads(row[0])
+    if time.time() - row[1] > _TTLS[kind]:
+        instrumentation.increment('cache_service.%s.miss' % kind)
+        return MISSING
+    instrumentation.increment('cache_service.%s.hit' % kind)
+    return json.loads(row[0])
+
+
+def put(kind, value, event_code=0, date=None):
+    """ Cache a value.
+    :param kind: String for the kind of value (eg. 'menu', 'attendees')
+    :param value: JSON-serialisable value to cache
+    :param event_code: code for the event the value relates to
+    :param date: datetime.date instance the value relates to, or None
+    """
+    with _LOCK:
+        if _CONNECTION is None:
+            return
+        _CONNECTION.execute('INSERT OR REPLACE INTO cache '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (kind, event_code, _date_key(date),
+                             json.dumps(value), time.time()))
+        _CONNECTION.commit()
+
+
+def evict(event_code=0, date=None):
+    """ Remove every cached value relating to an event on a date (eg. as the
+    page they were read from has changed).
+    :param event_code: code for the event the values relate to
+    :param date: datetime.date instance the values relate to, or None
+    """
+    with _LOCK:
+        if _CONNECTION is None:
+            return
+        _CONNECTION.execute('DELETE FROM cache '
+                            'WHERE event_code = ? AND date = ?',
+                            (event_code, _date_key(date)))
+        _CONNECTION.commit()
+
+
+def get_page_validators(url):
+    """ Get the validators stored for a page by `put_page_validators()`.
+    :param url: URL of the page
+    :return: tuple of (etag, last_modified, content_hash) for the page, or
+        None if there are none (or the cache is being refreshed)
+    """
+    with _LOCK:
+        if _CONNECTION is None or _REFRESH:
+            return None
+        row = _CONNECTION.execute('SELECT etag, last_modified, content_hash '
+                                  'FROM page_validators WHERE url = ?',
+                                  (url,)).fetchone()
+    if row is None:
+        return None
+    return tuple(row)
+
+
+def put_page_validators(url, etag, last_modified, content_hash, date=None):
+    """ Store the validators for the current version of a page, so that it
+    can be fetched conditionally, and changes to it detected.
+    :param url: URL of the page
+    :param etag: String for the page's ETag header, or None
+    :param last_modified: String for the page's Last-Modified header, or None
+    :param content_hash: String for the hash of the page's content
+    :param date: datetime.date instance the page relates to (so that its
+        validators are evicted along with other values for the date), or None
+    """
+    with _LOCK:
+        if _CONNECTION is None:
+            return
+        _CONNECTION.execute('INSERT OR REPLACE INTO page_validators '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (url, _date_key(date), etag, last_modified,
+                             content_hash))
+        _CONNECTION.commit()
+
+
+def _date_key(date):
+    """
+    :return: String used to key values for `date` within the cache
+    """
+    if date is None:
+        return ''
+    return date.isoformat()
\ No newline at end of file
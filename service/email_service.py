@@ -1,8 +1,15 @@
 import smtplib
+import socket
 import unicodedata
+from service import instrumentation
+
+SMTP_SERVER = 'smtp.gmail.com'
+SMTP_PORT = 587
+SMTP_USE_TLS = True
 
 _USERNAME = None
 _PASSWORD = None
+_DRY_RUN = False
 
 
 def set_email_credentials(username, password):
@@ -15,28 +22,111 @@ def set_email_credentials(username, password):
     _PASSWORD = password
 
 
+def set_dry_run(dry_run):
+    """ Specify whether emails should only be built, and not sent.
+    :param dry_run: bool, True if emails shouldn't be sent
+    """
+    global _DRY_RUN
+    _DRY_RUN = dry_run
+
+
 def send_email(user, body):
     """ Send email to user.
     :param user: User instance to send the email to
     :param body: body for the email (HTML)
+    :return: bool, True unless the email couldn't be sent
+    """
+    return len(send_emails([(user, body)])) == 0
+
+
+def send_emails(emails):
+    """ Send a batch of emails over a single SMTP session, reconnecting if the
+    session is dropped part way through. An email that can't be sent (eg. as
+    its recipient is refused) is skipped, so the rest are still sent.
+    :param emails: list of (user, body) tuples, where `user` is the User
+        instance to send the email to and `body` is the body for the email
+        (HTML)
+    :return: list of User instances whose emails couldn't be sent
+    :raises: smtplib.SMTPException or socket.error if no session can be
+        opened to send the emails
     """
-    SMTP_SERVER = 'smtp.gmail.com'
-    SMTP_PORT = 587
+    failed_users = []
+    session = None
+    try:
+        for user, body in emails:
+            recipient, message = _build_message(user, body)
+            if _DRY_RUN:
+                instrumentation.increment('smtp.emails_not_sent')
+                continue
+            if session is None:
+                session = _open_session()
+            try:
+                try:
+                    _send_message(session, recipient, message)
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    # Session dropped, so retry the message once on a new one.
+                    instrumentation.increment('smtp.reconnects')
+                    session = _open_session()
+                    _send_message(session, recipient, message)
+            except (smtplib.SMTPException, socket.error):
+                instrumentation.increment('smtp.emails_failed')
+                failed_users.append(user)
+                continue
+            instrumentation.increment('smtp.emails_sent')
+    finally:
+        if session is not None:
+            _close_session(session)
+    return failed_users
+
 
+def _build_message(user, body):
+    """ Build the email to send to `user`.
+    :param user: User instance to send the email to
+    :param body: body for the email (HTML)
+    :return: tuple of (recipient, message), where `recipient` is the email
+        address to send to and `message` is the full message (with headers)
+    """
     # Ensure our body is ascii
     body = unicodedata.normalize('NFKD', body).encode('ascii', 'ignore')
 
     recipient = user.crsid + "@cam.ac.uk"
     headers = ['From: CaiusHallHelper <' + _USERNAME + '>',
-                'Subject: CaiusHallHelper',
-                'To: " + recipient',
-                'MIME-Version: 1.0',
-                'Content-Type: text/html']
+               'Subject: CaiusHallHelper',
+               'To: ' + recipient,
+               'MIME-Version: 1.0',
+               'Content-Type: text/html']
     headers = '\r\n'.join(headers)
+    return recipient, headers + '\r\n\r\n' + body
+
+
+def _send_message(session, recipient, message):
+    """ Send `message` to `recipient` over `session`.
+    :param session: smtplib.SMTP instance to send the message over
+    :param recipient: email address to send to
+    :param message: full message (with headers) to send
+    """
+    with instrumentation.span('smtp.send'):
+        session.sendmail(_USERNAME, recipient, message)
+
 
-    session = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-    session.ehlo()
-    session.starttls()
-    session.login(_USERNAME, _PASSWORD)
-    session.sendmail(_USERNAME, recipient, headers + '\r\n\r\n' + body)
-    session.quit()
\ No newline at end of file
+def _open_session():
+    """ Open a new authenticated SMTP session.
+    :return: smtplib.SMTP instance, ready to send emails
+    """
+    with instrumentation.span('smtp.connect'):
+        session = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
+        session.ehlo()
+        if SMTP_USE_TLS:
+            session.starttls()
+        session.login(_USERNAME, _PASSWORD)
+    return session
+
+
+def _close_session(session):
+    """ Close `session`, ignoring any failure to do so cleanly.
+    :param session: smtplib.SMTP instance to close
+    """
+    try:
+        session.quit()
+    except (smtplib.SMTPException, socket.error):
+        session.close()
\ No newline at end of file
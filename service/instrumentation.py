@@ -0,0 +1,171 @@
+""" Responsible for recording counters, timings and spans describing a run.
+Recording is disabled by default, and is close to free until `enable()` is
+called.
+"""
+
+import json
+import os
+import threading
+import time
+
+_ENABLED = False
+_LOCK = threading.Lock()
+_START_TIME = None
+_COUNTERS = {}
+_HISTOGRAMS = {}
+_SPANS = []
+
+
+class _Span:
+    """ Times the block it's used as the context manager for, recording the
+    duration in the histogram of the same name.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._start_time = None
+
+    def __enter__(self):
+        self._start_time = time.time()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        duration = time.time() - self._start_time
+        with _LOCK:
+            _HISTOGRAMS.setdefault(self._name, []).append(duration)
+            _SPANS.append((self._name, self._start_time, duration,
+                           threading.current_thread().ident))
+        return False
+
+
+class _NullSpan:
+    """ Stand-in for _Span while recording is disabled. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable():
+    """ Start recording. """
+    global _ENABLED, _START_TIME
+    _START_TIME = time.time()
+    _ENABLED = True
+
+
+def is_enabled():
+    """
+    :return: bool, True if recording is enabled
+    """
+    return _ENABLED
+
+
+def increment(name, amount=1):
+    """ Increment the counter `name` by `amount`. """
+    if not _ENABLED:
+        return
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + amount
+
+
+def observe(name, value):
+    """ Record `value` in the histogram `name`. """
+    if not _ENABLED:
+        return
+    with _LOCK:
+        _HISTOGRAMS.setdefault(name, []).append(value)
+
+
+def span(name):
+    """ Time a block of code, for use as `with instrumentation.span(name):`.
+    The duration (in seconds) is recorded in the histogram `name`.
+    :return: context manager timing the block
+    """
+    if not _ENABLED:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def reset():
+    """ Discard everything recorded so far, eg. at the start of each run of a
+    long-running process.
+    """
+    global _START_TIME
+    with _LOCK:
+        _START_TIME = time.time()
+        _COUNTERS.clear()
+        _HISTOGRAMS.clear()
+        del _SPANS[:]
+
+
+def summary():
+    """
+    :return: String containing a table summarising every counter and
+        histogram recorded
+    """
+    report = get_report()
+    lines = ['%-44s %10s' % ('counter', 'value')]
+    for name in sorted(report['counters']):
+        lines.append('%-44s %10d' % (name, report['counters'][name]))
+    lines.append('')
+    lines.append('%-44s %7s %9s %9s %9s %9s' % ('histogram', 'count', 'total',
+                                                 'mean', 'p95', 'max'))
+    for name in sorted(report['histograms']):
+        histogram = report['histograms'][name]
+        lines.append('%-44s %7d %9.3f %9.3f %9.3f %9.3f' % (
+            name, histogram['count'], histogram['total'], histogram['mean'],
+            histogram['p95'], histogram['max']))
+    return '\n'.join(lines)
+
+
+def write_json(file_path):
+    """ Write every counter and histogram summary recorded to `file_path`, as
+    JSON.
+    """
+    with open(file_path, 'w') as json_file:
+        json.dump(get_report(), json_file, indent=4, sort_keys=True)
+
+
+def write_chrome_trace(file_path):
+    """ Write every span recorded to `file_path`, in the Chrome trace event
+    format (viewable with chrome://tracing).
+    """
+    with _LOCK:
+        spans = list(_SPANS)
+    trace_events = []
+    for name, start_time, duration, thread_id in spans:
+        trace_events.append({'name': name,
+                             'ph': 'X',
+                             'ts': int((start_time - _START_TIME) * 1e6),
+                             'dur': int(duration * 1e6),
+                             'pid': os.getpid(),
+                             'tid': thread_id})
+    with open(file_path, 'w') as trace_file:
+        json.dump({'traceEvents': trace_events}, trace_file)
+
+
+def get_report():
+    """
+    :return: dictionary containing every counter, and a summary of every
+        histogram
+    """
+    with _LOCK:
+        counters = dict(_COUNTERS)
+        histograms = dict((name, sorted(values))
+                          for name, values in _HISTOGRAMS.items())
+    histogram_summaries = {}
+    for name, values in histograms.items():
+        histogram_summaries[name] = {
+            'count': len(values),
+            'total': sum(values),
+            'mean': sum(values) / len(values),
+            'p50': values[int(0.5 * (len(values) - 1))],
+            'p95': values[int(0.95 * (len(values) - 1))],
+            'max': values[-1]
+        }
+    return {'counters': counters, 'histograms': histogram_summaries}
\ No newline at end of file
@@ -1,12 +1,39 @@
 """ Responsible for interacting directly with the Raven service. """
 
 import cookielib
+import os
+import re
+import threading
+import urlparse
 import mechanize
 from error import RavenAuthenticationError
+from service import instrumentation, transport
 
 RAVEN_URL = 'https://raven.cam.ac.uk/auth/login.html'
 _DEFAULT_AUTHENTICATED_BROWSER = None
 _CACHED_BROWSERS = {}
+# Maps each browser to a (cookie_jar, crsid, password) tuple, so that it can
+# log in again once its session expires.
+_BROWSER_SESSIONS = {}
+# Maps each browser to the number of times it has logged in again, so that
+# threads finding the same session expired only log in once.
+_SESSION_GENERATIONS = {}
+_SESSION_DIRECTORY = None
+_CRSID_LOCKS = {}
+_CRSID_LOCKS_LOCK = threading.Lock()
+
+
+def set_session_directory(session_directory):
+    """ Persist Raven sessions in `session_directory`, so that they can be
+    reused by later runs instead of logging in again. Only the current user
+    is given access to the directory and its contents.
+    :param session_directory: path to the directory to store sessions in
+    """
+    global _SESSION_DIRECTORY
+    if not os.path.isdir(session_directory):
+        os.makedirs(session_directory)
+    os.chmod(session_directory, 0o700)
+    _SESSION_DIRECTORY = session_directory
 
 
 def set_default_credentials(crsid, password):
@@ -15,7 +42,9 @@ def set_default_credentials(crsid, password):
     :raises: RavenAuthenticationError if crsid/password isn't accepted by Raven
     """
     global _DEFAULT_AUTHENTICATED_BROWSER
-    browser = get_authenticated_browser(crsid, password)
+    # The default browser is kept separate from any per-user browser, so that
+    # it's never shared with a concurrent booking for the same crsid.
+    browser = _create_authenticated_browser(crsid, password)
     _DEFAULT_AUTHENTICATED_BROWSER = browser
 
 
@@ -36,37 +65,227 @@ def get_default_authenticated_browser():
 
 def get_authenticated_browser(crsid, password):
     """ Get a mechanize browser, authenticated against Raven using the supplied
-    credentials.
+    credentials. Each crsid gets its own browser, so browsers for different
+    users can be used concurrently.
     :return: mechanize.Browser() instance authenticated with Raven using
         `crsid` and `password`
     :raises: RavenAuthenticationError if crsid/password isn't accepted by Raven
     """
-    if crsid not in _CACHED_BROWSERS:
-        cookie_jar = cookielib.LWPCookieJar()
-        browser = mechanize.Browser()
-        browser.set_cookiejar(cookie_jar)
-        browser.set_handle_equiv(True)
-        browser.set_handle_redirect(True)
-        browser.set_handle_referer(True)
-        browser.set_handle_robots(False)
-        browser.set_handle_refresh(mechanize._http.HTTPRefreshProcessor(),
-                                   max_time=1)
-
-        browser.addheaders = [('User-agent',
-                               'Mozilla/5.0 '
-                               '(X11; U; Linux i686; en-US; rv:1.9.0.1) '
-                               'Gecko/2008071615 Fedora/3.0.1-1.fc9 '
-                               'Firefox/3.0.1')]
-
-        browser.open(RAVEN_URL)
+    with _get_crsid_lock(crsid):
+        if crsid not in _CACHED_BROWSERS:
+            browser = _create_authenticated_browser(crsid, password)
+            _CACHED_BROWSERS[crsid] = browser
+    return _CACHED_BROWSERS[crsid]
+
+
+def discard_browser(crsid):
+    """ Forget the cached browser for `crsid` (if there is one), and its lock,
+    freeing their memory. Its session is still persisted if sessions are
+    being persisted. The browser must no longer be in use.
+    :param crsid: crsid whose browser to discard
+    """
+    with _get_crsid_lock(crsid):
+        browser = _CACHED_BROWSERS.pop(crsid, None)
+        if browser is not None:
+            _BROWSER_SESSIONS.pop(browser, None)
+            _SESSION_GENERATIONS.pop(browser, None)
+    with _CRSID_LOCKS_LOCK:
+        _CRSID_LOCKS.pop(crsid, None)
+
+
+def get_browser_crsid(browser):
+    """
+    :param browser: mechanize.Browser() instance
+    :return: crsid `browser` is (or is being) authenticated as, or None if
+        it isn't known
+    """
+    session = _BROWSER_SESSIONS.get(browser)
+    if session is None:
+        return None
+    return session[1]
+
+
+def get_authenticated_browser_async(crsid, password):
+    """ Asynchronous counterpart to `get_authenticated_browser()`.
+    :return: multiprocessing.pool.AsyncResult instance, whose `get()` returns
+        the authenticated browser
+    """
+    return transport.run_async(get_authenticated_browser, crsid, password)
+
+
+def _get_crsid_lock(crsid):
+    """
+    :return: threading.Lock instance guarding the cached browser for `crsid`
+    """
+    with _CRSID_LOCKS_LOCK:
+        if crsid not in _CRSID_LOCKS:
+            _CRSID_LOCKS[crsid] = threading.Lock()
+        return _CRSID_LOCKS[crsid]
+
+
+def open_url(browser, url):
+    """ Open `url` in `browser` (so that its forms can be used), logging the
+    browser in to Raven again if its session has expired.
+    :param browser: mechanize.Browser() instance, as returned by
+        `get_authenticated_browser()` or `get_default_authenticated_browser()`
+    :param url: URL to open
+    :return: response for `url`
+    :raises: RavenAuthenticationError if the browser's session had expired,
+        and it could not log in again
+    """
+    def open_with_browser():
+        return transport.get_transport().open(browser, url)
+
+    return _with_valid_session(browser, open_with_browser)
+
+
+def read_url(browser, url, headers=None):
+    """ Fetch `url` with the session of `browser`, without using the page's
+    forms, logging the browser in to Raven again if its session has expired.
+    This may be called concurrently for the same browser if the current
+    transport is thread-safe.
+    :param browser: mechanize.Browser() instance, as returned by
+        `get_authenticated_browser()` or `get_default_authenticated_browser()`
+    :param url: URL to fetch
+    :param headers: dictionary of extra request headers (eg. for a
+        conditional request), or None
+    :return: response for `url`, as returned by the transport's `read()`
+    :raises: RavenAuthenticationError if the browser's session had expired,
+        and it could not log in again
+    """
+    def read_with_session():
+        cookie_jar = _BROWSER_SESSIONS[browser][0]
+        return transport.get_transport().read(browser, cookie_jar, url,
+                                              headers)
+
+    return _with_valid_session(browser, read_with_session)
+
+
+def _with_valid_session(browser, fetch):
+    """ Call `fetch`, and if it was redirected to Raven (as the session for
+    `browser` has expired) log `browser` in again and retry.
+    :param browser: mechanize.Browser() instance whose session `fetch` uses
+    :param fetch: function taking no arguments, returning a response
+    :return: response returned by `fetch`
+    :raises: RavenAuthenticationError if the browser could not log in again
+    """
+    generation = _SESSION_GENERATIONS.get(browser, 0)
+    instrumentation.increment('http.fetches')
+    with instrumentation.span('http.fetch'):
+        response = fetch()
+    if _is_raven_url(response.geturl()) and browser in _BROWSER_SESSIONS:
+        instrumentation.increment('raven.expired_sessions')
+        cookie_jar, crsid, password = _BROWSER_SESSIONS[browser]
+        with _get_crsid_lock(crsid):
+            # Another thread may have logged in again while this one waited.
+            if _SESSION_GENERATIONS.get(browser, 0) == generation:
+                cookie_jar.clear()
+                _login(browser, cookie_jar, crsid, password)
+                _SESSION_GENERATIONS[browser] = generation + 1
+        instrumentation.increment('http.fetches')
+        with instrumentation.span('http.fetch'):
+            response = fetch()
+    return response
+
+
+def _is_raven_url(url):
+    """
+    :return: bool, True if `url` is a page on the Raven service
+    """
+    raven_host = urlparse.urlparse(RAVEN_URL).netloc
+    return urlparse.urlparse(url).netloc == raven_host
+
+
+def _create_authenticated_browser(crsid, password):
+    """ Create a new mechanize browser, authenticated with Raven. A persisted
+    session is reused if there is one, otherwise the browser logs in.
+    :return: mechanize.Browser() instance authenticated with Raven using
+        `crsid` and `password`
+    :raises: RavenAuthenticationError if crsid/password isn't accepted by Raven
+    """
+    cookie_jar = cookielib.LWPCookieJar()
+    browser = mechanize.Browser()
+    browser.set_cookiejar(cookie_jar)
+    browser.set_handle_equiv(True)
+    browser.set_handle_redirect(True)
+    browser.set_handle_referer(True)
+    browser.set_handle_robots(False)
+    browser.set_handle_refresh(mechanize._http.HTTPRefreshProcessor(),
+                               max_time=1)
+
+    browser.addheaders = [('User-agent', transport.USER_AGENT)]
+
+    # Registered before logging in, so the login's requests are attributed to
+    # `crsid`.
+    _BROWSER_SESSIONS[browser] = (cookie_jar, crsid, password)
+    _load_session(cookie_jar, crsid)
+    if len(cookie_jar) == 0:
+        try:
+            _login(browser, cookie_jar, crsid, password)
+        except Exception:
+            _BROWSER_SESSIONS.pop(browser, None)
+            raise
+    else:
+        instrumentation.increment('raven.sessions_reused')
+    return browser
+
+
+def _login(browser, cookie_jar, crsid, password):
+    """ Log `browser` in to Raven, and persist the resulting session.
+    :param browser: mechanize.Browser() instance to log in
+    :param cookie_jar: cookielib.LWPCookieJar instance used by `browser`
+    :raises: RavenAuthenticationError if crsid/password isn't accepted by Raven
+    """
+    instrumentation.increment('raven.logins')
+    with instrumentation.span('raven.login'):
+        transport.get_transport().open(browser, RAVEN_URL)
         browser.select_form(nr=0)
         browser.form['userid'] = crsid
         browser.form['pwd'] = password
-        browser.submit()
+        transport.get_transport().submit(browser)
 
-        if len(cookie_jar) == 0:
-            error_message = 'Incorrect crsid/password combination'
-            raise RavenAuthenticationError(error_message)
-        else:
-            _CACHED_BROWSERS[crsid] = browser
-    return _CACHED_BROWSERS[crsid]
\ No newline at end of file
+    if transport.get_transport().is_replaying:
+        # Replayed responses don't set cookies, and there's no real session
+        # to persist.
+        return
+    if len(cookie_jar) == 0:
+        error_message = 'Incorrect crsid/password combination'
+        raise RavenAuthenticationError(error_message)
+    _save_session(cookie_jar, crsid)
+
+
+def _session_file_path(crsid):
+    """
+    :return: path to the persisted session for `crsid`, or None if sessions
+        aren't being persisted
+    """
+    if _SESSION_DIRECTORY is None:
+        return None
+    file_name = re.sub(r'[^A-Za-z0-9]', '_', crsid) + '.lwp'
+    return os.path.join(_SESSION_DIRECTORY, file_name)
+
+
+def _load_session(cookie_jar, crsid):
+    """ Load the persisted session for `crsid` (if one exists) into
+    `cookie_jar`, discarding any cookies that have expired.
+    """
+    session_file_path = _session_file_path(crsid)
+    if session_file_path is None or not os.path.exists(session_file_path):
+        return
+    try:
+        cookie_jar.load(session_file_path, ignore_discard=True)
+    except (IOError, cookielib.LoadError):
+        cookie_jar.clear()
+    cookie_jar.clear_expired_cookies()
+
+
+def _save_session(cookie_jar, crsid):
+    """ Persist the session in `cookie_jar` for `crsid`, if sessions are being
+    persisted.
+    """
+    session_file_path = _session_file_path(crsid)
+    if session_file_path is None:
+        return
+    # Create the file readable by only the current user before writing to it.
+    os.close(os.open(session_file_path, os.O_WRONLY | os.O_CREAT, 0o600))
+    cookie_jar.save(session_file_path, ignore_discard=True)
\ No newline at end of file
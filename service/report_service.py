@@ -0,0 +1,90 @@
+""" Responsible for rendering users' HTML reports. The parts of a report that
+are the same for every user (the date heading, each booked event's menu, and
+each event's heading in the friends section) are rendered once per date and
+shared, so rendering every report takes time proportional to the number of
+events plus the number of users.
+"""
+
+import threading
+from service import booking_service
+
+_FRAGMENTS_CACHE = {}
+_FRAGMENTS_LOCK = threading.Lock()
+
+
+def render_report(user, date):
+    """ Generate `user`'s HTML report for `date`.
+    :param user: User instance the report is for
+    :param date: datetime.date instance for the report to reflect
+    :return: String containing the HTML for the report
+    """
+    fragments = _get_fragments(date)
+    report_parts = [r'<center>', fragments['heading'],
+                    '<h2>~ Bookings ~</h2>']
+    bookings = user.get_all_bookings(date)
+    if len(bookings) > 0:
+        for booking in bookings:
+            report_parts.append(_get_booking_fragment(fragments, booking))
+    else:
+        report_parts.append(r'<i>No bookings</i><br /><br />')
+
+    report_parts.append('<h2>~ Friends ~</h2>')
+    friends_attending = user.friends_attending(date)
+    if len(friends_attending) > 0:
+        for event, friend_names in friends_attending:
+            report_parts.append(fragments['friend_headings'][event])
+            report_parts.append(r'<br />'.join(friend_names))
+            report_parts.append(r'<br /><br />')
+    else:
+        report_parts.append(r'<i>No friends in any hall</i>')
+    report_parts.append(r'</center>')
+    return ''.join(report_parts)
+
+
+def discard_date(date):
+    """ Forget the fragments rendered for `date`, once no more reports will be
+    rendered for it.
+    :param date: datetime.date instance for the date to forget
+    """
+    with _FRAGMENTS_LOCK:
+        _FRAGMENTS_CACHE.pop(date, None)
+
+
+def _get_fragments(date):
+    """
+    :param date: datetime.date instance for the date of the reports
+    :return: dictionary of the fragments shared by every report for `date`.
+        'heading' is the date heading, 'friend_headings' maps events to the
+        event's heading in the friends section, and 'bookings' maps events
+        to the (lazily rendered) booking and menu block for the event
+    """
+    with _FRAGMENTS_LOCK:
+        if date not in _FRAGMENTS_CACHE:
+            date_string = date.strftime('Report for %A, %B %d')
+            friend_headings = {}
+            for event in booking_service.get_available_events():
+                friend_headings[event] = (
+                    r'<u><b>%s:</u></b><br /><br />' % event.name)
+            _FRAGMENTS_CACHE[date] = {
+                'heading': '<h3><i>%s</i></h3>' % date_string,
+                'friend_headings': friend_headings,
+                'bookings': {}
+            }
+        return _FRAGMENTS_CACHE[date]
+
+
+def _get_booking_fragment(fragments, booking):
+    """
+    :param fragments: dictionary returned by `_get_fragments()` for the date
+        of `booking`
+    :param booking: Booking instance to render the block for
+    :return: String containing the HTML block for `booking`'s event, with its
+        menu (rendered once per event and date, however many are booked in)
+    """
+    event = booking.event
+    booking_fragments = fragments['bookings']
+    if event not in booking_fragments:
+        menu_text = booking_service.get_menu_text(event, booking.date)
+        # Rendering is idempotent, so a race here only wastes a little work.
+        booking_fragments[event] = booking.html_report(menu_text)
+    return booking_fragments[event]
\ No newline at end of file
@@ -0,0 +1,125 @@
+""" Responsible for limiting the rate at which requests are made, and for
+backing off from hosts that are failing.
+"""
+
+import threading
+import time
+
+
+class RateLimiter:
+    """ A RateLimiter spaces out calls to `wait()` (from any number of
+    threads) so that they return at no more than a fixed rate.
+    """
+
+    def __init__(self, max_rate):
+        """ Construct a new RateLimiter.
+        :param max_rate: maximum number of calls per second to allow, or None
+            for no limit
+        """
+        self._interval = 0 if max_rate is None else 1.0 / max_rate
+        self._next_time = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """ Block until the next call is allowed. """
+        if self._interval == 0:
+            return
+        with self._lock:
+            now = time.time()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self._interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class TokenBucket:
+    """ A TokenBucket limits calls to `wait()` (from any number of threads) to
+    an average rate, while allowing short bursts.
+    """
+
+    def __init__(self, rate, burst=1):
+        """ Construct a new TokenBucket, starting full.
+        :param rate: number of tokens added per second, or None for no limit
+        :param burst: maximum number of tokens the bucket can hold, ie. how
+            many calls may be made at once after a quiet period
+        """
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._last_time = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """ Block until a token is available, and take it.
+        :return: float, number of seconds spent waiting
+        """
+        if self._rate is None:
+            return 0
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self._burst, self._tokens +
+                               (now - self._last_time) * self._rate)
+            self._last_time = now
+            # Taking a token the bucket doesn't have yet reserves it, so that
+            # waiting threads are served in the order they arrived.
+            self._tokens -= 1
+            wait_time = -self._tokens / self._rate
+        if wait_time > 0:
+            time.sleep(wait_time)
+            return wait_time
+        return 0
+
+
+class CircuitBreaker:
+    """ A CircuitBreaker stops calls to a failing host. After enough
+    consecutive failures the circuit opens, and calls are refused until a
+    timeout has passed. A single trial call is then allowed through, which
+    closes the circuit again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        """ Construct a new (closed) CircuitBreaker.
+        :param failure_threshold: number of consecutive failures that open the
+            circuit
+        :param reset_timeout: seconds to refuse calls for once the circuit has
+            opened
+        """
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Determine whether a call may be made now. If the circuit is open,
+        but its timeout has passed, the caller is allowed to make the trial
+        call.
+        :return: bool, True if the call may be made
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if (self._trial_in_progress or
+                    time.time() - self._opened_at < self._reset_timeout):
+                return False
+            self._trial_in_progress = True
+            return True
+
+    def record_success(self):
+        """ Record that a call succeeded, closing the circuit. """
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        """ Record that a call failed, opening the circuit if enough calls
+        have failed in a row (or if it was the trial call).
+        """
+        with self._lock:
+            self._failures += 1
+            if (self._trial_in_progress or
+                    self._failures >= self._failure_threshold):
+                self._opened_at = time.time()
+            self._trial_in_progress = False
\ No newline at end of file
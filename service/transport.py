@@ -0,0 +1,576 @@
+""" Responsible for performing the HTTP requests made by raven_service and
+booking_service (or recording and replaying them), and for running service
+calls asynchronously.
+"""
+
+import httplib
+import json
+import mechanize
+import mmap
+import os
+import random
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+import zlib
+from multiprocessing.pool import ThreadPool
+from error import ServiceUnavailableError
+from service import instrumentation, throttle
+
+USER_AGENT = ('Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.0.1) '
+              'Gecko/2008071615 Fedora/3.0.1-1.fc9 Firefox/3.0.1')
+MAX_REDIRECTS = 5
+# Retries back off exponentially from RETRY_BACKOFF seconds, up to
+# MAX_RETRY_BACKOFF, with full jitter.
+RETRY_BACKOFF = 0.5
+MAX_RETRY_BACKOFF = 10
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 60
+
+_TRANSPORT = None
+_ASYNC_POOL = None
+_ASYNC_WORKERS = 8
+_ASYNC_POOL_LOCK = threading.Lock()
+
+
+class BrowserTransport:
+    """ Performs every request using the mechanize browser itself. Browsers
+    aren't thread-safe, so a browser must only be used by one thread at once.
+    """
+
+    is_thread_safe = False
+    is_replaying = False
+
+    def __init__(self, timeout=None):
+        """ Construct a new BrowserTransport.
+        :param timeout: socket timeout for requests (applying to both
+            connecting and reading), in seconds, or None for no timeout
+        """
+        self._timeout = timeout
+
+    def open(self, browser, url):
+        """ Open `url` in `browser`, so that its forms can be used.
+        :param browser: mechanize.Browser() instance to open `url` with
+        :param url: URL to open
+        :return: response for `url`, supporting `read()` and `geturl()`
+        """
+        if self._timeout is None:
+            return browser.open(url)
+        return browser.open(url, timeout=self._timeout)
+
+    def read(self, browser, cookie_jar, url, headers=None):
+        """ Fetch `url` with the session of `browser`, without using the
+        page's forms.
+        :param browser: mechanize.Browser() instance whose session to use
+        :param cookie_jar: cookielib.CookieJar instance used by `browser`
+        :param url: URL to fetch
+        :param headers: dictionary of extra request headers (eg. for a
+            conditional request), or None
+        :return: response for `url`, supporting `read()`, `geturl()` and
+            `info()`, with the HTTP status in `code` (304 if a conditional
+            request found the page unmodified)
+        """
+        if not headers:
+            return self.open(browser, url)
+        try:
+            return self.open(browser, mechanize.Request(url, headers=headers))
+        except IOError as error:
+            if getattr(error, 'code', None) != 304:
+                raise
+            return _Response('', url, 304, error.info())
+
+    def submit(self, browser):
+        """ Submit the form currently selected in `browser`.
+        :param browser: mechanize.Browser() instance with a selected form
+        :return: response to the form submission
+        """
+        if self._timeout is None:
+            return browser.submit()
+        return browser.open(browser.click(), timeout=self._timeout)
+
+
+class KeepAliveTransport(BrowserTransport):
+    """ Performs read-only requests over persistent, pooled HTTP connections,
+    sharing each browser's cookie jar. Pages whose forms are used are still
+    opened by the browser. Reads are thread-safe, as each thread has its own
+    pool of connections.
+    """
+
+    is_thread_safe = True
+
+    def __init__(self, connect_timeout=10, read_timeout=30):
+        """ Construct a new KeepAliveTransport.
+        :param connect_timeout: timeout for connecting, in seconds
+        :param read_timeout: socket timeout for reading responses (and for
+            requests opened by the browser), in seconds
+        """
+        BrowserTransport.__init__(self, read_timeout)
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._local = threading.local()
+
+    def read(self, browser, cookie_jar, url, headers=None):
+        request_headers = {'User-agent': USER_AGENT}
+        request_headers.update(headers or {})
+        for _ in range(MAX_REDIRECTS + 1):
+            request = urllib2.Request(url, headers=request_headers)
+            cookie_jar.add_cookie_header(request)
+            response = self._request(request)
+            cookie_jar.extract_cookies(_CookieResponse(response), request)
+            if response.status in (301, 302, 303, 307):
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+            if response.status >= 400:
+                raise urllib2.HTTPError(url, response.status, response.reason,
+                                        response.msg, None)
+            return _Response(response.body, url, response.status,
+                             response.msg)
+        raise urllib2.URLError('Too many redirects fetching %s' % url)
+
+    def _request(self, request):
+        """ Perform a GET `request` on a pooled connection, reconnecting once
+        if the pooled connection has been closed by the server.
+        :param request: urllib2.Request instance describing the request
+        :return: httplib.HTTPResponse instance, with its body read into `body`
+        """
+        parsed_url = urlparse.urlparse(request.get_full_url())
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path += '?' + parsed_url.query
+        headers = dict(request.header_items())
+
+        for attempt in range(2):
+            connection = self._get_connection(parsed_url.scheme,
+                                              parsed_url.netloc)
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                    connection.sock.settimeout(self._read_timeout)
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                response.body = response.read()
+                return response
+            except (httplib.HTTPException, socket.error):
+                self._drop_connection(parsed_url.scheme, parsed_url.netloc)
+                if attempt == 1:
+                    raise
+
+    def _get_connection(self, scheme, host):
+        """
+        :return: this thread's persistent connection to `host`
+        """
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        key = (scheme, host)
+        if key not in self._local.connections:
+            if scheme == 'https':
+                connection_class = httplib.HTTPSConnection
+            else:
+                connection_class = httplib.HTTPConnection
+            self._local.connections[key] = connection_class(
+                host, timeout=self._connect_timeout)
+        return self._local.connections[key]
+
+    def _drop_connection(self, scheme, host):
+        """ Close and forget this thread's connection to `host`. """
+        connection = self._local.connections.pop((scheme, host), None)
+        if connection is not None:
+            connection.close()
+
+
+class ResilientTransport:
+    """ Wraps another transport, limiting the rate of requests to each host,
+    retrying failed GET requests with jittered exponential backoff, and
+    refusing requests to a host that keeps failing. The time spent waiting
+    (for the rate limit, or to retry) and transferring is recorded in the
+    'fetch.wait' and 'fetch.transfer' histograms.
+    """
+
+    def __init__(self, transport, max_rate_per_host=None, retries=3):
+        """ Construct a new ResilientTransport.
+        :param transport: BrowserTransport or KeepAliveTransport instance to
+            perform requests with
+        :param max_rate_per_host: maximum average number of requests per
+            second to make to each host, or None for no limit
+        :param retries: number of times to retry a failed GET request
+        """
+        self._transport = transport
+        self._max_rate_per_host = max_rate_per_host
+        self._retries = retries
+        self._token_buckets = {}
+        self._circuit_breakers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def is_thread_safe(self):
+        return self._transport.is_thread_safe
+
+    @property
+    def is_replaying(self):
+        return self._transport.is_replaying
+
+    def open(self, browser, url):
+        def open_url():
+            return _read_response(self._transport.open(browser, url))
+
+        return self._fetch(url, open_url, self._retries)
+
+    def read(self, browser, cookie_jar, url, headers=None):
+        def read_url():
+            return _read_response(self._transport.read(browser, cookie_jar,
+                                                       url, headers))
+
+        return self._fetch(url, read_url, self._retries)
+
+    def submit(self, browser):
+        # Submissions aren't idempotent, so are never retried.
+        def submit_form():
+            return self._transport.submit(browser)
+
+        return self._fetch(browser.form.action, submit_form, 0)
+
+    def _fetch(self, url, fetch, retries):
+        """ Call `fetch` under the rate limit and circuit breaker for the host
+        of `url`, retrying up to `retries` times if it fails.
+        :param url: URL that `fetch` requests
+        :param fetch: function taking no arguments, performing the request
+            and returning its response
+        :param retries: maximum number of times to retry `fetch`
+        :return: response returned by `fetch`
+        :raises: ServiceUnavailableError if the host's circuit is open
+        """
+        host = urlparse.urlparse(url).netloc
+        token_bucket, circuit_breaker = self._get_host_state(host)
+        for attempt in range(retries + 1):
+            if not circuit_breaker.allow():
+                instrumentation.increment('fetch.circuit_rejections')
+                raise ServiceUnavailableError(
+                    'Too many failed requests to %s' % host)
+            instrumentation.observe('fetch.wait', token_bucket.wait())
+            try:
+                with instrumentation.span('fetch.transfer'):
+                    response = fetch()
+            except (IOError, httplib.HTTPException) as error:
+                if not _is_retryable(error):
+                    circuit_breaker.record_success()
+                    raise
+                circuit_breaker.record_failure()
+                instrumentation.increment('fetch.failures')
+                if attempt == retries:
+                    raise
+                instrumentation.increment('fetch.retries')
+                backoff = random.uniform(0, min(MAX_RETRY_BACKOFF,
+                                                RETRY_BACKOFF * 2 ** attempt))
+                time.sleep(backoff)
+                instrumentation.observe('fetch.wait', backoff)
+            else:
+                circuit_breaker.record_success()
+                return response
+
+    def _get_host_state(self, host):
+        """
+        :return: tuple of (token_bucket, circuit_breaker) for `host`
+        """
+        with self._lock:
+            if host not in self._token_buckets:
+                self._token_buckets[host] = throttle.TokenBucket(
+                    self._max_rate_per_host)
+                self._circuit_breakers[host] = throttle.CircuitBreaker(
+                    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+            return self._token_buckets[host], self._circuit_breakers[host]
+
+
+def _read_response(response):
+    """
+    :param response: response returned by a transport
+    :return: _Response instance with the same contents, read in full
+    """
+    return _Response(response.read(), response.geturl(),
+                     getattr(response, 'code', 200), response.info())
+
+
+def _is_retryable(error):
+    """
+    :param error: exception raised by a request
+    :return: bool, True if the request may succeed if retried. HTTP errors
+        are only retried for server errors and rate limiting
+    """
+    status = getattr(error, 'code', None)
+    if isinstance(status, int):
+        return status >= 500 or status == 429
+    return True
+
+
+class RecordingTransport:
+    """ Wraps another transport, recording every response to an archive that
+    a ReplayTransport can replay. Each response body is compressed and
+    appended to the archive file, and its location is appended to an index
+    file (the archive path with '.index' added), as a line of JSON.
+    Responses are keyed by method, URL and the session they were fetched
+    with, so each user's view of a page is kept, and a later response for
+    the same key replaces an earlier one.
+    """
+
+    def __init__(self, transport, archive_path, get_session_key=None):
+        """ Construct a new RecordingTransport, appending to any existing
+        archive at `archive_path`.
+        :param transport: BrowserTransport or KeepAliveTransport instance to
+            perform requests with
+        :param archive_path: path to the archive file to record to
+        :param get_session_key: function mapping a browser to a String
+            identifying whose session it has (eg. its crsid), or None. If
+            None, responses aren't keyed by session
+        """
+        self._transport = transport
+        self._get_session_key = get_session_key
+        self._archive_file = open(archive_path, 'ab')
+        self._index_file = open(archive_path + '.index', 'a')
+        self._lock = threading.Lock()
+
+    @property
+    def is_thread_safe(self):
+        return self._transport.is_thread_safe
+
+    @property
+    def is_replaying(self):
+        return False
+
+    def open(self, browser, url):
+        response = _read_response(self._transport.open(browser, url))
+        self._record(browser, 'GET', url, response)
+        return response
+
+    def read(self, browser, cookie_jar, url, headers=None):
+        response = _read_response(self._transport.read(browser, cookie_jar,
+                                                       url, headers))
+        self._record(browser, 'GET', url, response)
+        return response
+
+    def submit(self, browser):
+        url = browser.form.action
+        response = _read_response(self._transport.submit(browser))
+        self._record(browser, 'POST', url, response)
+        return response
+
+    def _record(self, browser, method, url, response):
+        """ Append `response` to the archive.
+        :param browser: browser the request was made with
+        :param method: String for the HTTP method of the request
+        :param url: URL that was requested
+        :param response: _Response instance for the response
+        """
+        if response.code == 304:
+            # The body recorded for the page already is still current.
+            return
+        body = zlib.compress(response.read())
+        headers = {}
+        for name in ('Content-Type', 'ETag', 'Last-Modified'):
+            value = get_header(response, name)
+            if value is not None:
+                headers[name] = value
+        with self._lock:
+            self._archive_file.seek(0, os.SEEK_END)
+            offset = self._archive_file.tell()
+            self._archive_file.write(body)
+            self._archive_file.flush()
+            self._index_file.write(json.dumps({
+                'key': _archive_key(self._get_session_key, browser, method,
+                                    url),
+                'offset': offset,
+                'length': len(body),
+                'code': response.code,
+                'url': response.geturl(),
+                'headers': headers
+            }) + '\n')
+            self._index_file.flush()
+
+
+class ReplayTransport:
+    """ Replays the responses recorded by a RecordingTransport, instead of
+    using the network. The archive is memory-mapped, and its index loaded
+    into memory, so each response is found with a dictionary lookup and
+    decompressed. Pages opened by a browser are loaded into the browser, so
+    its forms can be used. Conditional request headers are ignored, and
+    requests that weren't recorded fail with a 404 error.
+    """
+
+    is_thread_safe = True
+    is_replaying = True
+
+    def __init__(self, archive_path, get_session_key=None):
+        """ Construct a new ReplayTransport.
+        :param archive_path: path to an archive written by a
+            RecordingTransport
+        :param get_session_key: function mapping a browser to a String
+            identifying whose session it has, as given to the
+            RecordingTransport, or None
+        """
+        self._get_session_key = get_session_key
+        self._index = {}
+        with open(archive_path + '.index', 'r') as index_file:
+            for line in index_file:
+                entry = json.loads(line)
+                self._index[entry['key']] = entry
+        self._archive = ''
+        if os.path.getsize(archive_path) > 0:
+            with open(archive_path, 'rb') as archive_file:
+                self._archive = mmap.mmap(archive_file.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+
+    def open(self, browser, url):
+        response = self._replay(browser, 'GET', url)
+        browser.set_response(_make_browser_response(response))
+        return response
+
+    def read(self, browser, cookie_jar, url, headers=None):
+        return self._replay(browser, 'GET', url)
+
+    def submit(self, browser):
+        response = self._replay(browser, 'POST', browser.form.action)
+        browser.set_response(_make_browser_response(response))
+        return response
+
+    def _replay(self, browser, method, url):
+        """
+        :param browser: browser the request is made with
+        :param method: String for the HTTP method of the request
+        :param url: URL requested
+        :return: _Response instance for the recorded response
+        :raises: urllib2.HTTPError if no response was recorded for `url`
+        """
+        entry = self._index.get(_archive_key(self._get_session_key, browser,
+                                             method, url))
+        if entry is None:
+            raise urllib2.HTTPError(url, 404, 'Not in the replay archive',
+                                    None, None)
+        instrumentation.increment('transport.replayed')
+        offset = entry['offset']
+        body = zlib.decompress(self._archive[offset:offset + entry['length']])
+        return _Response(body, entry['url'], entry['code'],
+                         _Headers(entry['headers']))
+
+
+def _archive_key(get_session_key, browser, method, url):
+    """
+    :param get_session_key: function mapping a browser to a String
+        identifying whose session it has, or None
+    :return: String keying the response to a `method` request for `url`,
+        made with `browser`, within an archive
+    """
+    session_key = None
+    if get_session_key is not None:
+        session_key = get_session_key(browser)
+    return '%s %s %s' % (method, url, session_key or '')
+
+
+def _make_browser_response(response):
+    """
+    :param response: _Response instance to load into a browser
+    :return: mechanize response with the same contents as `response`
+    """
+    content_type = get_header(response, 'Content-Type') or 'text/html'
+    return mechanize.make_response(response.read(),
+                                   [('Content-Type', content_type)],
+                                   response.geturl(), response.code, 'OK')
+
+
+class _Headers:
+    """ Minimal response headers, matching the parts of the mimetools.Message
+    interface used by the services.
+    """
+
+    def __init__(self, headers):
+        """
+        :param headers: dictionary mapping header names to values
+        """
+        self._headers = dict((name.lower(), value)
+                             for name, value in headers.items())
+
+    def getheader(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+
+class _Response:
+    """ Minimal response, matching the parts of the mechanize response
+    interface used by the services.
+    """
+
+    def __init__(self, body, url, code=200, headers=None):
+        self._body = body
+        self._url = url
+        self._headers = headers
+        self.code = code
+
+    def read(self):
+        return self._body
+
+    def geturl(self):
+        return self._url
+
+    def info(self):
+        return self._headers
+
+
+class _CookieResponse:
+    """ Adapts a httplib.HTTPResponse to the interface cookielib expects. """
+
+    def __init__(self, response):
+        self._response = response
+
+    def info(self):
+        return self._response.msg
+
+
+def get_header(response, name):
+    """
+    :param response: response returned by a transport
+    :param name: String for the name of the header
+    :return: String for the value of header `name` in `response`, or None if
+        it isn't present
+    """
+    headers = response.info()
+    if headers is None:
+        return None
+    return headers.getheader(name)
+
+
+def set_transport(transport):
+    """ Specify the transport to use for all requests.
+    :param transport: BrowserTransport or KeepAliveTransport instance
+    """
+    global _TRANSPORT
+    _TRANSPORT = transport
+
+
+def get_transport():
+    """
+    :return: the transport to use for all requests (BrowserTransport by
+        default)
+    """
+    global _TRANSPORT
+    if _TRANSPORT is None:
+        _TRANSPORT = BrowserTransport()
+    return _TRANSPORT
+
+
+def set_async_workers(async_workers):
+    """ Specify how many asynchronous calls may run at once. Must be called
+    before the first asynchronous call.
+    :param async_workers: maximum number of concurrent asynchronous calls
+    """
+    global _ASYNC_WORKERS
+    _ASYNC_WORKERS = max(1, async_workers)
+
+
+def run_async(function, *args):
+    """ Run `function(*args)` on a shared pool of worker threads.
+    :return: multiprocessing.pool.AsyncResult instance for the call. Its
+        `get()` returns the result, or re-raises any exception raised
+    """
+    global _ASYNC_POOL
+    with _ASYNC_POOL_LOCK:
+        if _ASYNC_POOL is None:
+            _ASYNC_POOL = ThreadPool(_ASYNC_WORKERS)
+    return _ASYNC_POOL.apply_async(function, args)
\ No newline at end of file
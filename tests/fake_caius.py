@@ -0,0 +1,42 @@
+""" A test case base class running Raven and the booking system as local fake
+servers (from the benchmark), with every service pointed at them.
+"""
+
+import unittest
+from benchmark import fake_servers
+from service import booking_service, raven_service, transport
+
+DEFAULT_CRSID = 'default'
+
+
+class FakeCaiusTestCase(unittest.TestCase):
+    """ Each test gets fresh fake servers, a BrowserTransport and a logged in
+    default browser, and every cache is cleared afterwards.
+    """
+
+    fake_caius_options = {}
+
+    def setUp(self):
+        self.fake_caius = fake_servers.FakeCaius(**self.fake_caius_options)
+        raven_url, booking_service_url, self.servers = (
+            fake_servers.start_fake_caius(self.fake_caius))
+        self.urls = (raven_service.RAVEN_URL,
+                     booking_service.BOOKING_SERVICE_URL)
+        raven_service.RAVEN_URL = raven_url
+        booking_service.BOOKING_SERVICE_URL = booking_service_url
+        self.transport = transport._TRANSPORT
+        transport.set_transport(transport.BrowserTransport(5))
+        raven_service.set_default_credentials(DEFAULT_CRSID, 'password')
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        raven_service.RAVEN_URL, booking_service.BOOKING_SERVICE_URL = (
+            self.urls)
+        transport.set_transport(self.transport)
+        booking_service.clear_page_caches()
+        for crsid in list(raven_service._CACHED_BROWSERS):
+            booking_service.discard_user(crsid)
+        raven_service._BROWSER_SESSIONS.clear()
+        raven_service._DEFAULT_AUTHENTICATED_BROWSER = None
\ No newline at end of file
@@ -0,0 +1,58 @@
+""" Tests for the availability snapshot bookings are planned against. """
+
+import unittest
+from model.availability import Availability
+from model.event import get_event
+
+FIRST_HALL = get_event(1, 'First Hall')
+FORMAL_HALL = get_event(2, 'Formal Hall')
+
+
+class AvailabilityTest(unittest.TestCase):
+
+    def test_reserve_and_release(self):
+        availability = Availability()
+        availability.add_event(FIRST_HALL, True, 1)
+        availability.add_event(FORMAL_HALL, True, 1)
+        self.assertEqual(availability.reserve([FIRST_HALL, FORMAL_HALL]),
+                         FIRST_HALL)
+        # The only place is reserved, so the next preference is given.
+        self.assertEqual(availability.reserve([FIRST_HALL, FORMAL_HALL]),
+                         FORMAL_HALL)
+        self.assertIsNone(availability.reserve([FIRST_HALL, FORMAL_HALL]))
+        availability.release(FIRST_HALL)
+        self.assertEqual(availability.reserve([FIRST_HALL, FORMAL_HALL]),
+                         FIRST_HALL)
+
+    def test_unknown_capacity(self):
+        availability = Availability()
+        availability.add_event(FIRST_HALL, True)
+        for _ in range(3):
+            self.assertEqual(availability.reserve([FIRST_HALL]), FIRST_HALL)
+        availability.release(FIRST_HALL)
+        self.assertEqual(availability.reserve([FIRST_HALL]), FIRST_HALL)
+
+    def test_unknown_if_bookable(self):
+        availability = Availability()
+        availability.add_event(FIRST_HALL, None)
+        self.assertEqual(availability.reserve([FIRST_HALL]), FIRST_HALL)
+
+    def test_closed_and_full_events_are_skipped(self):
+        availability = Availability()
+        availability.add_event(FIRST_HALL, False)
+        availability.add_event(FORMAL_HALL, True)
+        self.assertEqual(availability.reserve([FORMAL_HALL]), FORMAL_HALL)
+        availability.mark_full(FORMAL_HALL)
+        self.assertIsNone(availability.reserve([FIRST_HALL, FORMAL_HALL]))
+
+    def test_events_are_only_added_once(self):
+        availability = Availability()
+        availability.add_event(FIRST_HALL, True, 1)
+        availability.reserve([FIRST_HALL])
+        availability.add_event(FIRST_HALL, True, 1)
+        self.assertIsNone(availability.reserve([FIRST_HALL]))
+        self.assertFalse(availability.has_event(FORMAL_HALL))
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
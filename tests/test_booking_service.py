@@ -0,0 +1,157 @@
+""" Tests for reading users' bookings from attendee lists by name, and for
+revalidating cached values against the fake servers.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import date, timedelta
+from configuration import Configuration
+from model.attendance_index import AttendanceIndex
+from model.event import get_event
+from model.user import User
+from service import booking_service, cache_service
+from tests.fake_caius import FakeCaiusTestCase
+
+FIRST_HALL = get_event(1, 'First Hall')
+FORMAL_HALL = get_event(2, 'Formal Hall')
+
+
+def _create_user(name):
+    return User('abc1', 'password', [], [()] * 7, name)
+
+
+def _resolve(attendance_index, name):
+    return dict((event.code, is_booked) for event, is_booked in
+                booking_service._resolve_bookings(attendance_index,
+                                                  _create_user(name)))
+
+
+class ResolveBookingsTest(unittest.TestCase):
+
+    def test_name_listed_once_is_booked(self):
+        attendance_index = AttendanceIndex([
+            (FIRST_HALL, ['Smith, J', 'Jones, A']),
+            (FORMAL_HALL, ['Jones, A'])])
+        self.assertEqual(_resolve(attendance_index, 'smith, j'),
+                         {1: True, 2: False})
+
+    def test_name_listed_twice_is_unresolved(self):
+        attendance_index = AttendanceIndex([
+            (FIRST_HALL, ['Smith, J', 'Smith, J'])])
+        self.assertEqual(_resolve(attendance_index, 'Smith, J'), {1: None})
+
+    def test_hidden_attendees_leave_absence_unresolved(self):
+        attendance_index = AttendanceIndex([
+            (FIRST_HALL, ['Jones, A']), (FORMAL_HALL, ['Jones, A'])],
+            incomplete_event_codes=[2])
+        self.assertEqual(_resolve(attendance_index, 'Smith, J'),
+                         {1: False, 2: None})
+
+    def test_unknown_name_is_unresolved(self):
+        attendance_index = AttendanceIndex([(FIRST_HALL, ['Smith, J'])])
+        self.assertEqual(_resolve(attendance_index, None), {1: None})
+
+
+class SharedNameTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_shared_names_are_ignored(self):
+        users = [{'crsid': crsid, 'password': 'password', 'friends': [],
+                  'events': {}, 'name': name}
+                 for crsid, name in [('abc1', 'Smith, J'),
+                                     ('abc2', 'SMITH, J'),
+                                     ('abc3', 'Jones, A')]]
+        configuration_file_path = os.path.join(self.directory,
+                                               'configuration.json')
+        with open(configuration_file_path, 'w') as configuration_file:
+            json.dump({'default_crsid': 'abc0', 'default_password': 'password',
+                       'gmail_username': 'test@example.com',
+                       'gmail_password': 'password', 'users': users},
+                      configuration_file)
+        configuration = Configuration(configuration_file_path)
+        self.assertEqual([user.name for user in configuration.users],
+                         [None, None, 'Jones, A'])
+
+
+class _Clock:
+    """ Stands in for the time module, so that cached values can be aged. """
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+
+class RevalidationTest(FakeCaiusTestCase):
+
+    fake_caius_options = {'event_count': 2, 'attendee_count': 2,
+                          'names': {'abc1': 'Smith, J'}}
+
+    def setUp(self):
+        FakeCaiusTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.clock = _Clock()
+        cache_service.time = self.clock
+        cache_service.open_cache(os.path.join(self.directory, 'cache'),
+                                 date.today())
+        self.date = date.today() + timedelta(days=3)
+        self.event = [event for event
+                      in booking_service.get_available_events()
+                      if self.fake_caius.is_event_running(
+                          event.code, self.date.isoformat())][0]
+        self.attendee_names = booking_service.get_attendee_names(self.event,
+                                                                 self.date)
+        self.menu_text = booking_service.get_menu_text(self.event, self.date)
+        # Start a later run, once the cached attendee list has expired.
+        booking_service.clear_page_caches()
+        self.clock.now += cache_service.ATTENDEES_TTL + 1
+        self.request_count = self._request_count()
+
+    def tearDown(self):
+        cache_service.time = time
+        cache_service._CONNECTION.close()
+        cache_service._CONNECTION = None
+        shutil.rmtree(self.directory)
+        FakeCaiusTestCase.tearDown(self)
+
+    def _request_count(self):
+        return self.fake_caius.counter.as_dict()['requests']
+
+    def test_unchanged_page_is_kept(self):
+        attendee_names = booking_service.get_attendee_names(self.event,
+                                                            self.date)
+        self.assertEqual(attendee_names, self.attendee_names)
+        # A single conditional request, answered with 304 Not Modified.
+        self.assertEqual(self._request_count(), self.request_count + 1)
+        cache_key = (self.event, self.date)
+        self.assertIn(cache_key, booking_service._UNCHANGED_EVENT_PAGES)
+        self.assertNotIn(cache_key, booking_service._EVENT_PAGE_CACHE)
+        # Other expired values from the page are reused without fetching.
+        self.clock.now += cache_service.MENU_TTL
+        self.assertEqual(booking_service.get_menu_text(self.event, self.date),
+                         self.menu_text)
+        self.assertEqual(self._request_count(), self.request_count + 1)
+
+    def test_changed_page_is_read_again(self):
+        self.fake_caius.book('abc1', self.event.code, self.date.isoformat())
+        attendee_names = booking_service.get_attendee_names(self.event,
+                                                            self.date)
+        self.assertEqual(attendee_names, self.attendee_names + ['Smith, J'])
+        # The changed page is kept, so it isn't fetched again.
+        self.assertEqual(self._request_count(), self.request_count + 1)
+        self.assertIn((self.event, self.date),
+                      booking_service._EVENT_PAGE_CACHE)
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
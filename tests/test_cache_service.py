@@ -0,0 +1,105 @@
+""" Tests for the persistent SQLite cache. """
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import date, timedelta
+from service import cache_service
+
+TODAY = date(2016, 3, 1)
+
+
+class _Clock:
+    """ Stands in for the time module, so that values can be aged. """
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+
+class CacheServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_file_path = os.path.join(self.directory, 'cache.sqlite')
+        self.clock = _Clock()
+        cache_service.time = self.clock
+        cache_service.open_cache(self.cache_file_path, TODAY)
+
+    def tearDown(self):
+        cache_service.time = time
+        cache_service._CONNECTION.close()
+        cache_service._CONNECTION = None
+        cache_service._REFRESH = False
+        shutil.rmtree(self.directory)
+
+    def test_values_expire_by_kind(self):
+        cache_service.put('menu', 'Soup', 1, TODAY)
+        cache_service.put('attendees', ['Smith, J'], 1, TODAY)
+        self.clock.now += cache_service.ATTENDEES_TTL + 1
+        self.assertEqual(cache_service.get('menu', 1, TODAY), 'Soup')
+        self.assertIs(cache_service.get('attendees', 1, TODAY),
+                      cache_service.MISSING)
+        # Expired values can still be revalidated.
+        self.assertEqual(cache_service.get('attendees', 1, TODAY,
+                                           allow_expired=True), ['Smith, J'])
+        self.clock.now += cache_service.MENU_TTL
+        self.assertIs(cache_service.get('menu', 1, TODAY),
+                      cache_service.MISSING)
+
+    def test_none_is_cached(self):
+        cache_service.put('menu', None, 1, TODAY)
+        self.assertIsNone(cache_service.get('menu', 1, TODAY))
+        self.assertIs(cache_service.get('menu', 2, TODAY),
+                      cache_service.MISSING)
+
+    def test_evict(self):
+        cache_service.put('menu', 'Soup', 1, TODAY)
+        cache_service.put('attendees', [], 1, TODAY)
+        cache_service.put('menu', 'Fish', 2, TODAY)
+        cache_service.evict(1, TODAY)
+        self.assertIs(cache_service.get('menu', 1, TODAY),
+                      cache_service.MISSING)
+        self.assertIs(cache_service.get('attendees', 1, TODAY),
+                      cache_service.MISSING)
+        self.assertEqual(cache_service.get('menu', 2, TODAY), 'Fish')
+
+    def test_reused_after_reopening(self):
+        cache_service.put('events', [[1, 'First Hall']])
+        cache_service.put('menu', 'Soup', 1, TODAY)
+        cache_service.put_page_validators('url', '"etag"', None, 'hash',
+                                          TODAY)
+        cache_service.open_cache(self.cache_file_path, TODAY)
+        self.assertEqual(cache_service.get('events'), [[1, 'First Hall']])
+        self.assertEqual(cache_service.get('menu', 1, TODAY), 'Soup')
+        self.assertEqual(cache_service.get_page_validators('url'),
+                         ('"etag"', None, 'hash'))
+
+    def test_past_dates_evicted_on_reopening(self):
+        cache_service.put('events', [[1, 'First Hall']])
+        cache_service.put('menu', 'Soup', 1, TODAY)
+        cache_service.put_page_validators('url', '"etag"', None, 'hash',
+                                          TODAY)
+        cache_service.open_cache(self.cache_file_path,
+                                 TODAY + timedelta(days=1))
+        self.assertEqual(cache_service.get('events'), [[1, 'First Hall']])
+        self.assertIs(cache_service.get('menu', 1, TODAY),
+                      cache_service.MISSING)
+        self.assertIsNone(cache_service.get_page_validators('url'))
+
+    def test_refresh_ignores_but_still_stores_values(self):
+        cache_service.put('menu', 'Soup', 1, TODAY)
+        cache_service.open_cache(self.cache_file_path, TODAY, refresh=True)
+        self.assertIs(cache_service.get('menu', 1, TODAY),
+                      cache_service.MISSING)
+        cache_service.put('menu', 'Fish', 1, TODAY)
+        cache_service.open_cache(self.cache_file_path, TODAY)
+        self.assertEqual(cache_service.get('menu', 1, TODAY), 'Fish')
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,131 @@
+""" Tests for sending batches of emails, against a local stub SMTP server. """
+
+import SocketServer
+import threading
+import unittest
+from model.user import User
+from service import email_service
+
+REFUSED_RECIPIENT = 'refused@cam.ac.uk'
+
+
+class _StubSMTPHandler(SocketServer.StreamRequestHandler):
+    """ Accepts every message except those to REFUSED_RECIPIENT, recording
+    each connection and the recipient of each message accepted.
+    """
+
+    server_state = None
+
+    def handle(self):
+        state = self.server_state
+        with state['lock']:
+            state['connections'] += 1
+        self._reply('220 stub ESMTP')
+        recipient = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().upper()
+            if command.startswith('EHLO'):
+                self._reply('250-stub\r\n250 AUTH PLAIN')
+            elif command.startswith('AUTH'):
+                self._reply('235 Authenticated')
+            elif command.startswith('RCPT TO:'):
+                recipient = line.strip()[len('RCPT TO:'):].strip('<> ')
+                if recipient == REFUSED_RECIPIENT:
+                    self._reply('550 No such user')
+                else:
+                    self._reply('250 OK')
+            elif command == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in ('.\r\n', '.\n', ''):
+                    pass
+                with state['lock']:
+                    state['recipients'].append(recipient)
+                    disconnect = state['disconnects'] > 0
+                    state['disconnects'] -= 1
+                if disconnect:
+                    # Drop the session without acknowledging the message.
+                    return
+                self._reply('250 Queued')
+            elif command == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('250 OK')
+
+    def _reply(self, reply):
+        self.wfile.write(reply + '\r\n')
+
+
+class _StubSMTPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _create_user(crsid):
+    return User(crsid, 'password', [], [()] * 7)
+
+
+class SendEmailsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = {'lock': threading.Lock(), 'connections': 0,
+                      'recipients': [], 'disconnects': 0}
+
+        class Handler(_StubSMTPHandler):
+            pass
+        Handler.server_state = self.state
+        self.server = _StubSMTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.smtp_settings = (email_service.SMTP_SERVER,
+                              email_service.SMTP_PORT,
+                              email_service.SMTP_USE_TLS)
+        email_service.SMTP_SERVER = '127.0.0.1'
+        email_service.SMTP_PORT = self.server.server_address[1]
+        email_service.SMTP_USE_TLS = False
+        email_service.set_email_credentials('test@example.com', 'password')
+
+    def tearDown(self):
+        (email_service.SMTP_SERVER, email_service.SMTP_PORT,
+         email_service.SMTP_USE_TLS) = self.smtp_settings
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_single_session_for_all_emails(self):
+        users = [_create_user('abc%d' % number) for number in range(5)]
+        failed_users = email_service.send_emails(
+            [(user, u'<p>Report</p>') for user in users])
+        self.assertEqual(failed_users, [])
+        self.assertEqual(self.state['connections'], 1)
+        self.assertEqual(self.state['recipients'],
+                         ['abc%d@cam.ac.uk' % number for number in range(5)])
+
+    def test_refused_email_does_not_drop_the_rest(self):
+        refused_user = _create_user('refused')
+        users = [_create_user('abc1'), refused_user, _create_user('abc2')]
+        failed_users = email_service.send_emails(
+            [(user, u'<p>Report</p>') for user in users])
+        self.assertEqual(failed_users, [refused_user])
+        self.assertEqual(self.state['connections'], 1)
+        self.assertEqual(self.state['recipients'],
+                         ['abc1@cam.ac.uk', 'abc2@cam.ac.uk'])
+
+    def test_dropped_session_is_reopened(self):
+        self.state['disconnects'] = 1
+        users = [_create_user('abc1'), _create_user('abc2')]
+        failed_users = email_service.send_emails(
+            [(user, u'<p>Report</p>') for user in users])
+        self.assertEqual(failed_users, [])
+        self.assertEqual(self.state['connections'], 2)
+        # The first message is sent again on the new session.
+        self.assertEqual(self.state['recipients'],
+                         ['abc1@cam.ac.uk', 'abc1@cam.ac.uk',
+                          'abc2@cam.ac.uk'])
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,105 @@
+""" Golden-file tests for booking system page parsing. Each page in
+`tests/pages` is parsed both by EventPage (which only builds the parts of the
+page that are read) and as the whole page, the way pages were parsed before,
+to check the values read from them are the same.
+"""
+
+import os
+import re
+import unittest
+import warnings
+from bs4 import BeautifulSoup
+from model.event_page import EventPage, parse_page
+from service import booking_service
+
+PAGES_DIRECTORY = os.path.join(os.path.dirname(__file__), 'pages')
+
+
+def _read_page(file_name):
+    with open(os.path.join(PAGES_DIRECTORY, file_name), 'r') as page_file:
+        return page_file.read()
+
+
+def _parse_whole_page(html):
+    """ Parse `html` as pages were parsed before parse_page() existed. """
+    with warnings.catch_warnings():
+        # Beautiful Soup warns that no parser was named.
+        warnings.simplefilter('ignore')
+        return BeautifulSoup(html)
+
+
+def _whole_page_attendee_names(html):
+    attendance_table = _parse_whole_page(html).find_all(
+        'table', {'class': 'list'})[0]
+    attendee_names = [cell.get_text() for cell in
+                      attendance_table.find_all('td')]
+    return [name for name in attendee_names
+            if len(name) > 0 and name[0] != '(']
+
+
+def _whole_page_menu_text(html):
+    menu_divs = _parse_whole_page(html).find_all('div', {'class': 'menu'})
+    if len(menu_divs) == 0:
+        return None
+    menu_text = menu_divs[0].get_text().replace('\r', '\n')
+    menu_text = re.sub(r'  +', '', menu_text)
+    menu_text = re.sub(r' ?\n ?', r'\n', menu_text)
+    return re.sub(r'(^\n)|(\n$)', r'', menu_text)
+
+
+class EventPageTest(unittest.TestCase):
+
+    def test_attendee_names(self):
+        html = _read_page('event.html')
+        attendee_names = EventPage(html).attendee_names
+        self.assertEqual(attendee_names, _whole_page_attendee_names(html))
+        self.assertEqual(attendee_names, [u'Smith, J', u'Jones, \xc1',
+                                          u"O'Brien, K (Fellow)"])
+
+    def test_hidden_attendees(self):
+        self.assertTrue(EventPage(_read_page('event.html'))
+                        .has_hidden_attendees)
+        self.assertFalse(EventPage(_read_page('event_booked.html'))
+                         .has_hidden_attendees)
+
+    def test_menu_text(self):
+        for file_name in ('event.html', 'event_booked.html'):
+            html = _read_page(file_name)
+            self.assertEqual(EventPage(html).menu_text,
+                             _whole_page_menu_text(html))
+        self.assertEqual(EventPage(_read_page('event_booked.html')).menu_text,
+                         u'Soup\nMain course\nPudding')
+
+    def test_booking_state(self):
+        event_page = EventPage(_read_page('event.html'))
+        self.assertTrue(event_page.is_occurring)
+        self.assertFalse(event_page.is_booked)
+        self.assertTrue(event_page.has_booking_form)
+        booked_page = EventPage(_read_page('event_booked.html'))
+        self.assertTrue(booked_page.is_booked)
+        self.assertTrue(booked_page.has_booking_form)
+        # The only form updates the booking, so it can't tell if it's open.
+        self.assertIsNone(booked_page.is_open)
+
+    def test_not_running(self):
+        event_page = EventPage(_read_page('event_not_running.html'))
+        self.assertFalse(event_page.is_occurring)
+        self.assertFalse(event_page.has_booking_form)
+
+    def test_forms_match_whole_page(self):
+        for file_name in os.listdir(PAGES_DIRECTORY):
+            html = _read_page(file_name)
+            self.assertEqual(
+                [str(form) for form in parse_page(html).find_all('form')],
+                [str(form) for form in
+                 _parse_whole_page(html).find_all('form')])
+
+    def test_event_list(self):
+        self.assertEqual(
+            booking_service._parse_event_list(_read_page('event_list.html')),
+            [(1, u'First Hall'), (23, u'Formal Hall'),
+             (5, u'Caius Club Dinner')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+""" Tests for the phases of a run, against the fake servers. """
+
+import threading
+import time
+from datetime import date, timedelta
+import main
+from model.user import User
+from service import booking_service, transport
+from tests.fake_caius import FakeCaiusTestCase
+
+
+class _OverlapCheckingTransport(transport.BrowserTransport):
+    """ Records any browser used by more than one thread at once. """
+
+    def __init__(self):
+        transport.BrowserTransport.__init__(self, 5)
+        self.lock = threading.Lock()
+        self.browsers_in_use = set()
+        self.overlapping_browsers = set()
+
+    def open(self, browser, url):
+        with self.lock:
+            if browser in self.browsers_in_use:
+                self.overlapping_browsers.add(browser)
+            self.browsers_in_use.add(browser)
+        try:
+            # Give other threads a chance to use the browser too.
+            time.sleep(0.01)
+            return transport.BrowserTransport.open(self, browser, url)
+        finally:
+            with self.lock:
+                self.browsers_in_use.discard(browser)
+
+
+class PrefetchTest(FakeCaiusTestCase):
+
+    fake_caius_options = {'event_count': 4, 'attendee_count': 5}
+
+    def test_user_browser_used_by_one_thread_at_once(self):
+        checking_transport = _OverlapCheckingTransport()
+        transport.set_transport(checking_transport)
+        date_for_report = date.today() + timedelta(days=3)
+        users = [User('abc%d' % number, 'password', [], [()] * 7)
+                 for number in range(3)]
+        self.fake_caius.book('abc1', 1, date_for_report.isoformat())
+
+        main._prefetch(users, [], 3, max_workers=8)
+
+        self.assertEqual(checking_transport.overlapping_browsers, set())
+        for user in users:
+            for event in booking_service.get_available_events():
+                if booking_service.is_event_occurring(event,
+                                                      date_for_report):
+                    self.assertEqual(
+                        booking_service._IS_BOOKED_CACHE[user.crsid][
+                            (event, date_for_report)],
+                        self.fake_caius.is_booked(
+                            user.crsid, event.code,
+                            date_for_report.isoformat()))
\ No newline at end of file
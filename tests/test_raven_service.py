@@ -0,0 +1,85 @@
+""" Tests for re-logging in to Raven when a shared session expires. """
+
+import threading
+import time
+import unittest
+from service import raven_service
+
+
+class _Response:
+
+    def __init__(self, url):
+        self._url = url
+
+    def geturl(self):
+        return self._url
+
+
+class _CookieJar:
+
+    def clear(self):
+        pass
+
+
+class ExpiredSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.browser = object()
+        raven_service._BROWSER_SESSIONS[self.browser] = (_CookieJar(), 'abc1',
+                                                         'password')
+        self.login = raven_service._login
+        self.logins = []
+
+        def login(browser, cookie_jar, crsid, password):
+            time.sleep(0.05)
+            self.logins.append(crsid)
+        raven_service._login = login
+
+    def tearDown(self):
+        raven_service._login = self.login
+        raven_service.discard_browser('abc1')
+        raven_service._BROWSER_SESSIONS.pop(self.browser, None)
+        raven_service._SESSION_GENERATIONS.pop(self.browser, None)
+
+    def test_concurrent_readers_log_in_once(self):
+        ready = threading.Event()
+        responses = []
+
+        def fetch():
+            if len(self.logins) == 0:
+                # Every reader sees the expired session before any logs in.
+                ready.wait(1)
+                return _Response(raven_service.RAVEN_URL)
+            return _Response('https://www.mealbookings.cai.cam.ac.uk/')
+
+        def read():
+            responses.append(
+                raven_service._with_valid_session(self.browser, fetch))
+
+        threads = [threading.Thread(target=read) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        ready.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.logins, ['abc1'])
+        self.assertEqual(len(responses), 5)
+        for response in responses:
+            self.assertFalse(raven_service._is_raven_url(response.geturl()))
+
+
+class DiscardBrowserTest(unittest.TestCase):
+
+    def test_discard_frees_browser_and_lock(self):
+        browser = object()
+        raven_service._CACHED_BROWSERS['abc2'] = browser
+        raven_service._BROWSER_SESSIONS[browser] = (None, 'abc2', 'password')
+        raven_service._get_crsid_lock('abc2')
+        raven_service.discard_browser('abc2')
+        self.assertNotIn('abc2', raven_service._CACHED_BROWSERS)
+        self.assertNotIn(browser, raven_service._BROWSER_SESSIONS)
+        self.assertNotIn('abc2', raven_service._CRSID_LOCKS)
+
+
+if __name__ == '__main__':
+    unittest.main()
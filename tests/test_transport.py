@@ -0,0 +1,287 @@
+""" Tests for the transports, against a local stub HTTP server (or the fake
+servers, for replaying logins).
+"""
+
+import BaseHTTPServer
+import SocketServer
+import cookielib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib2
+from datetime import date, timedelta
+import mechanize
+from error import ServiceUnavailableError
+from model.user import User
+from service import booking_service, raven_service, transport
+from tests.fake_caius import FakeCaiusTestCase
+
+ETAG = '"page-1"'
+
+
+class _StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves a few fixed paths, recording each request and connection. """
+
+    protocol_version = 'HTTP/1.1'
+    server_state = None
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server_state['lock']:
+            self.server_state['connections'] += 1
+
+    def do_GET(self):
+        state = self.server_state
+        with state['lock']:
+            state['requests'].append((self.path, dict(self.headers)))
+        if self.path == '/page':
+            if self.headers.get('If-None-Match') == ETAG:
+                self._respond(304, '', [('ETag', ETAG)])
+            else:
+                self._respond(200, 'page body', [('ETag', ETAG)])
+        elif self.path == '/redirect':
+            self._respond(302, '', [('Location', '/cookie'),
+                                    ('Set-Cookie', 'session=abc; Path=/')])
+        elif self.path == '/cookie':
+            self._respond(200, self.headers.get('Cookie', ''))
+        elif self.path == '/flaky':
+            with state['lock']:
+                state['failures'] -= 1
+                failing = state['failures'] >= 0
+            if failing:
+                self._respond(503, 'unavailable')
+            else:
+                self._respond(200, 'recovered')
+        else:
+            self._respond(404, 'not found')
+
+    def _respond(self, status, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def _create_browser():
+    cookie_jar = cookielib.LWPCookieJar()
+    browser = mechanize.Browser()
+    browser.set_cookiejar(cookie_jar)
+    browser.set_handle_robots(False)
+    return browser, cookie_jar
+
+
+class _StubServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.state = {'lock': threading.Lock(), 'connections': 0,
+                      'requests': [], 'failures': 0}
+
+        class Handler(_StubHandler):
+            pass
+        Handler.server_state = self.state
+        self.server = _StubServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.retry_backoff = transport.RETRY_BACKOFF
+        transport.RETRY_BACKOFF = 0
+
+    def tearDown(self):
+        transport.RETRY_BACKOFF = self.retry_backoff
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TransportTest(_StubServerTestCase):
+
+    def test_keep_alive_reuses_connection(self):
+        keep_alive = transport.KeepAliveTransport()
+        browser, cookie_jar = _create_browser()
+        for _ in range(3):
+            response = keep_alive.read(browser, cookie_jar,
+                                       self.base_url + '/page')
+            self.assertEqual(response.read(), 'page body')
+        self.assertEqual(self.state['connections'], 1)
+        self.assertEqual(len(self.state['requests']), 3)
+
+    def test_keep_alive_conditional_read(self):
+        keep_alive = transport.KeepAliveTransport()
+        browser, cookie_jar = _create_browser()
+        response = keep_alive.read(browser, cookie_jar,
+                                   self.base_url + '/page',
+                                   {'If-None-Match': ETAG})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(transport.get_header(response, 'ETag'), ETAG)
+
+    def test_keep_alive_follows_redirects_with_cookies(self):
+        keep_alive = transport.KeepAliveTransport()
+        browser, cookie_jar = _create_browser()
+        response = keep_alive.read(browser, cookie_jar,
+                                   self.base_url + '/redirect')
+        self.assertEqual(response.read(), 'session=abc')
+        self.assertEqual(response.geturl(), self.base_url + '/cookie')
+        self.assertEqual(len(cookie_jar), 1)
+
+    def test_keep_alive_raises_http_errors(self):
+        keep_alive = transport.KeepAliveTransport()
+        browser, cookie_jar = _create_browser()
+        with self.assertRaises(urllib2.HTTPError):
+            keep_alive.read(browser, cookie_jar, self.base_url + '/missing')
+
+    def test_browser_conditional_read(self):
+        browser_transport = transport.BrowserTransport(timeout=5)
+        browser, cookie_jar = _create_browser()
+        response = browser_transport.read(browser, cookie_jar,
+                                          self.base_url + '/page')
+        self.assertEqual(response.read(), 'page body')
+        response = browser_transport.read(browser, cookie_jar,
+                                          self.base_url + '/page',
+                                          {'If-None-Match': ETAG})
+        self.assertEqual(response.code, 304)
+
+    def test_resilient_retries_server_errors(self):
+        self.state['failures'] = 2
+        resilient = transport.ResilientTransport(
+            transport.KeepAliveTransport(), retries=3)
+        browser, cookie_jar = _create_browser()
+        response = resilient.read(browser, cookie_jar,
+                                  self.base_url + '/flaky')
+        self.assertEqual(response.read(), 'recovered')
+        self.assertEqual(len(self.state['requests']), 3)
+
+    def test_resilient_does_not_retry_client_errors(self):
+        resilient = transport.ResilientTransport(
+            transport.KeepAliveTransport(), retries=3)
+        browser, cookie_jar = _create_browser()
+        with self.assertRaises(urllib2.HTTPError):
+            resilient.read(browser, cookie_jar, self.base_url + '/missing')
+        self.assertEqual(len(self.state['requests']), 1)
+
+    def test_resilient_opens_circuit(self):
+        self.state['failures'] = 100
+        resilient = transport.ResilientTransport(
+            transport.KeepAliveTransport(), retries=0)
+        browser, cookie_jar = _create_browser()
+        for _ in range(transport.CIRCUIT_FAILURE_THRESHOLD):
+            with self.assertRaises(urllib2.HTTPError):
+                resilient.read(browser, cookie_jar, self.base_url + '/flaky')
+        with self.assertRaises(ServiceUnavailableError):
+            resilient.read(browser, cookie_jar, self.base_url + '/flaky')
+        self.assertEqual(len(self.state['requests']),
+                         transport.CIRCUIT_FAILURE_THRESHOLD)
+
+
+class RecordReplayTest(_StubServerTestCase):
+
+    def setUp(self):
+        _StubServerTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.directory, 'archive')
+        self.session_keys = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        _StubServerTestCase.tearDown(self)
+
+    def _create_browser(self, session_key):
+        browser, cookie_jar = _create_browser()
+        self.session_keys[browser] = session_key
+        return browser, cookie_jar
+
+    def test_round_trip(self):
+        recording = transport.RecordingTransport(
+            transport.KeepAliveTransport(), self.archive_path,
+            self.session_keys.get)
+        browser, cookie_jar = self._create_browser('abc1')
+        other_browser, other_cookie_jar = self._create_browser('abc2')
+        recording.read(browser, cookie_jar, self.base_url + '/page')
+        recording.read(browser, cookie_jar, self.base_url + '/cookie')
+        recording.read(browser, cookie_jar, self.base_url + '/redirect')
+        recording.read(browser, cookie_jar, self.base_url + '/cookie')
+        recording.read(other_browser, other_cookie_jar,
+                       self.base_url + '/cookie')
+        request_count = len(self.state['requests'])
+
+        replay = transport.ReplayTransport(self.archive_path,
+                                           self.session_keys.get)
+        response = replay.read(browser, cookie_jar, self.base_url + '/page')
+        self.assertEqual(response.read(), 'page body')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(transport.get_header(response, 'ETag'), ETAG)
+        # The later response for the same session replaces the earlier one.
+        response = replay.read(browser, cookie_jar, self.base_url + '/cookie')
+        self.assertEqual(response.read(), 'session=abc')
+        # Each session's view of a page is kept.
+        response = replay.read(other_browser, other_cookie_jar,
+                               self.base_url + '/cookie')
+        self.assertEqual(response.read(), '')
+        self.assertEqual(len(self.state['requests']), request_count)
+
+    def test_missing_entry_raises(self):
+        recording = transport.RecordingTransport(
+            transport.KeepAliveTransport(), self.archive_path,
+            self.session_keys.get)
+        browser, cookie_jar = self._create_browser('abc1')
+        other_browser, other_cookie_jar = self._create_browser('abc2')
+        recording.read(browser, cookie_jar, self.base_url + '/page')
+
+        replay = transport.ReplayTransport(self.archive_path,
+                                           self.session_keys.get)
+        with self.assertRaises(urllib2.HTTPError) as context:
+            replay.read(browser, cookie_jar, self.base_url + '/cookie')
+        self.assertEqual(context.exception.code, 404)
+        with self.assertRaises(urllib2.HTTPError):
+            replay.read(other_browser, other_cookie_jar,
+                        self.base_url + '/page')
+
+
+class ReplayLoginTest(FakeCaiusTestCase):
+
+    def setUp(self):
+        FakeCaiusTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.directory, 'archive')
+
+    def tearDown(self):
+        FakeCaiusTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def test_replayed_login_needs_no_cookies(self):
+        date_to_check = date.today() + timedelta(days=3)
+        event = [event for event in booking_service.get_available_events()
+                 if booking_service.is_event_occurring(event,
+                                                       date_to_check)][0]
+        self.fake_caius.book('abc1', event.code, date_to_check.isoformat())
+        user = User('abc1', 'password', [], [()] * 7)
+        transport.set_transport(transport.RecordingTransport(
+            transport.BrowserTransport(5), self.archive_path,
+            raven_service.get_browser_crsid))
+        self.assertIsNotNone(booking_service.get_booking(event, user,
+                                                         date_to_check))
+        request_count = self.fake_caius.counter.as_dict()['requests']
+
+        transport.set_transport(transport.ReplayTransport(
+            self.archive_path, raven_service.get_browser_crsid))
+        booking_service.discard_user('abc1')
+        # Replayed logins set no cookies, but still succeed.
+        self.assertIsNotNone(booking_service.get_booking(event, user,
+                                                         date_to_check))
+        self.assertEqual(self.fake_caius.counter.as_dict()['requests'],
+                         request_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+""" Tests for booking users in against the availability snapshot, using the
+fake servers.
+"""
+
+from datetime import date, timedelta
+from error import BookingServiceError
+from model.user import User
+from service import booking_service
+from tests.fake_caius import DEFAULT_CRSID, FakeCaiusTestCase
+
+
+class CreateBookingTest(FakeCaiusTestCase):
+
+    fake_caius_options = {'event_count': 6, 'capacity': 1}
+
+    def setUp(self):
+        FakeCaiusTestCase.setUp(self)
+        self.date = date.today() + timedelta(days=3)
+        self.date_string = self.date.isoformat()
+        self.events = [event for event
+                       in booking_service.get_available_events()
+                       if self.fake_caius.is_event_running(
+                           event.code, self.date_string)][:2]
+
+    def _create_user(self, crsid):
+        return User(crsid, 'password', [], [self.events] * 7)
+
+    def test_full_event_falls_through(self):
+        self.fake_caius.book('xyz1', self.events[0].code, self.date_string)
+        booking = self._create_user('abc1').create_booking(self.date)
+        self.assertEqual(booking.event, self.events[1])
+        self.assertTrue(self.fake_caius.is_booked('abc1', self.events[1].code,
+                                                  self.date_string))
+
+    def test_event_filled_since_snapshot_is_marked_full(self):
+        availability = booking_service.get_availability(self.date,
+                                                        self.events)
+        self.fake_caius.book('xyz1', self.events[0].code, self.date_string)
+        booking = self._create_user('abc1').create_booking(self.date)
+        self.assertEqual(booking.event, self.events[1])
+        self.assertIsNone(availability.reserve(self.events[:1]))
+
+    def test_refused_user_does_not_fill_event(self):
+        submit_booking = booking_service.submit_booking
+
+        def refuse_abc1(event, user, date, browser):
+            if user.crsid == 'abc1':
+                raise BookingServiceError('Refused')
+            return submit_booking(event, user, date, browser)
+        booking_service.submit_booking = refuse_abc1
+        try:
+            first_booking = self._create_user('abc1').create_booking(
+                self.date)
+            second_booking = self._create_user('abc2').create_booking(
+                self.date)
+        finally:
+            booking_service.submit_booking = submit_booking
+        self.assertIsNone(first_booking)
+        self.assertEqual(second_booking.event, self.events[0])
+
+
+class BookedDefaultUserTest(FakeCaiusTestCase):
+
+    fake_caius_options = {'event_count': 6, 'capacity': 1,
+                          'shows_places_remaining': False}
+
+    def test_full_event_booked_by_default_user(self):
+        date_to_book = date.today() + timedelta(days=3)
+        date_string = date_to_book.isoformat()
+        events = [event for event in booking_service.get_available_events()
+                  if self.fake_caius.is_event_running(event.code,
+                                                      date_string)][:2]
+        self.fake_caius.book(DEFAULT_CRSID, events[0].code, date_string)
+        event_page = booking_service.get_event_page(events[0], date_to_book)
+        self.assertIsNone(event_page.is_open)
+
+        user = User('abc1', 'password', [], [events] * 7)
+        booking = user.create_booking(date_to_book)
+        self.assertEqual(booking.event, events[1])
\ No newline at end of file